@@ -3,9 +3,15 @@ import os
 import subprocess
 import argparse
 import base64
+import bisect
+import hashlib
+import io
 import json
 import re
+import tempfile
+import threading
 import time
+from collections import Counter, OrderedDict
 from typing import List, Optional, Any
 from pathlib import Path
 from openai import OpenAI
@@ -41,9 +47,83 @@ OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
 # 设置为False使用PyMuPDF（快速但无公式识别）
 USE_MARKER = True  # 启用Marker模式进行测试
 
+# Marker多页窗口配置
+# 每次调用Marker转换的页数（通过page_range实现），转换后按页拆分
+# 0 = 根据空闲显存/内存自动选择；1 = 逐页模式（4GB显存推荐，也是失败时的回退路径）
+MARKER_PAGE_WINDOW = 0
+MARKER_MAX_PAGE_WINDOW = 8       # 自动模式下的窗口上限
+MARKER_VRAM_PER_PAGE_GB = 1.0    # 每增加一页窗口大约需要的显存
+MARKER_VRAM_RESERVE_GB = 1.0     # 为模型推理保留的显存余量
+MARKER_RAM_PER_PAGE_GB = 1.5     # CPU模式下每页窗口大约需要的内存
+MARKER_RAM_RESERVE_GB = 4.0      # CPU模式下保留的内存余量
+
+# Marker转换选项（同时参与OCR缓存键计算，修改后旧缓存自动失效）
+MARKER_OPTIONS = {"output_format": "markdown"}
+
+# Marker OCR结果磁盘缓存
+# 键 = (单页PDF内容哈希, Marker版本, Marker转换选项)，重复分析同一PDF时跳过OCR
+OCR_CACHE_DIR = Path(os.getenv("PAPER_OCR_CACHE_DIR", str(Path.home() / ".cache" / "paper-analysis-tool" / "ocr")))
+OCR_CACHE_MAX_MB = 500  # 缓存总大小上限，超出后按最近使用时间（LRU）淘汰
+
+# Marker多进程OCR配置（CPU服务器）
+# 0或1 = 在主进程内转换；N>1 = 启动N个常驻工作进程，各自加载一次模型并分片处理页面
+OCR_WORKERS = 0
+OCR_MAX_ATTEMPTS = 3  # 单页最多尝试次数（失败后优先换一个工作进程重试）
+# 流水线模式（--stream-pages）：OCR最多领先下游（公式扫描/Architect装箱）的页数，队列满时OCR暂停等待
+PAGE_STREAM_QUEUE_SIZE = 4
+
+# 页面图片缓存配置
+# 多个section常指向同一页，缓存渲染+base64编码结果避免重复渲染
+PAGE_IMAGE_CACHE_SIZE = 16    # 内存中最多缓存的图片数（300DPI PNG约3-6MB/张）
+PAGE_IMAGE_SPILL_DIR = None   # 设置目录后，被LRU淘汰的图片写入磁盘，再次使用时从磁盘读取
+PAGE_IMAGE_SPILL_MAX_MB = 1000  # 溢出目录总大小上限，超出后按最近使用时间（LRU）淘汰
+
+# 分析图片编码配置（所有Analyst请求共用）
+# 大多数VLM接口会自行缩放图片，300DPI无损PNG（约2550×3300像素）上传开销大且收益有限
+IMAGE_FORMAT = "png"      # png | jpeg | webp（webp需要Pillow）
+IMAGE_QUALITY = 85        # jpeg/webp质量 (1-100)
+IMAGE_MAX_DIM = None      # 图片最长边像素上限，None表示不限制（仅由DPI决定）
+IMAGE_DPI = 300           # 渲染DPI（受IMAGE_MAX_DIM约束）
+
+# Analyst字数重试的上下文策略
+# full = 保留所有历史回答（原行为，请求随重试次数线性增长）
+# last = 只保留最近一次回答 + 修改意见
+# summary = 只发送上次回答的提纲摘要和字数差（最省token）
+ANALYST_RETRY_CONTEXT = "last"
+RETRY_SUMMARY_MAX_CHARS = 600  # summary策略下提纲摘要的最大字符数
+
+# Analyst并发配置
+# 同时进行的Analyst请求数（线程池），1 = 串行；spoke note仍按大纲顺序写入
+ANALYST_CONCURRENCY = 4
+
+# API速率限制配置（令牌桶，所有并发调用共享）
+# 按服务商的真实配额设置；会根据响应中的Retry-After / x-ratelimit-*头自动暂停
+API_REQUESTS_PER_MIN = 40
+API_TOKENS_PER_MIN = None   # None表示不限制token速率
+API_MAX_BACKOFF = 60        # 无Retry-After时指数退避的上限（秒）
+IMAGE_TOKEN_ESTIMATE = 1500 # 每张图片的token估算值（用于token桶预扣）
+
+# LLM响应磁盘缓存（SQLite）
+# 键 = (模型ID, 规范化后的messages（图片替换为内容哈希）, response_format)，相同提示词重跑时不发起网络请求
+LLM_CACHE_PATH = Path(os.getenv("PAPER_LLM_CACHE_PATH", str(Path.home() / ".cache" / "paper-analysis-tool" / "llm_cache.sqlite3")))
+LLM_CACHE_TTL_DAYS = 30   # 条目过期时间（天），None表示永不过期
+LLM_CACHE_MAX_MB = 200    # 缓存总大小上限，超出后按最近使用时间（LRU）淘汰
+
+# 公式关联度计算方式（用于公式智能分组）
+# exact = 分组结果与旧版完全一致：NumPy字符计数矩阵一次算出所有公式对的关联度上界，只有组内平均上界
+#         仍可能超过阈值的候选才计算精确分数（与SequenceMatcher.ratio逐位一致的快速实现）；未安装NumPy时不做上界预筛
+# sequence = 旧版SequenceMatcher（按需计算并缓存），用于对照
+# tfidf = 字符3-gram TF-IDF余弦相似度矩阵（NumPy向量化，一次计算）；分数整体偏高，0.4阈值下分组明显变大，
+#         仅在公式极多、可接受分组差异时显式选用；未安装NumPy时自动退回exact
+EQUATION_SIMILARITY_METHOD = "exact"
+EQUATION_SHINGLE_SIZE = 3
+EQUATION_HASH_DIM = 4096   # 3-gram特征哈希的维度
+
 # Architect分批处理配置
 # Marker会逐页识别整个PDF，然后Architect每N页分批提取问题
-PAGES_PER_BATCH = 22  # 每批处理的页数，建议2-5页
+PAGES_PER_BATCH = 22  # 每批最多页数（实际批次由token预算决定）
+ARCHITECT_TOKEN_BUDGET = 8000  # 每批论文文本的token预算（估算值），按页装箱；单页超出预算时截断并提示
+ARCHITECT_CONCURRENCY = 4  # 同时进行的Architect批次请求数，1 = 串行；结果始终按批次顺序合并
 
 # --- PDF Extraction Strategy ---
 # Using PyMuPDF (fitz) for text extraction
@@ -123,22 +203,284 @@ class Outline(BaseModel):
 
 # --- Components ---
 
+# PyMuPDF不是线程安全的：批量模式下后台线程处理下一篇论文时，与主线程的fitz调用互斥
+FITZ_LOCK = threading.RLock()
+
+class DocumentRegistry:
+    """
+    单次运行内共享的fitz.Document句柄注册表
+    PDFProcessor / MarkerProcessor / FigureScanner 通过acquire借用同一个句柄，
+    每个PDF在一次运行中只解析一次；句柄在close_all()（运行结束）时统一关闭
+    """
+    
+    def __init__(self):
+        self._docs = {}   # 规范化路径 -> fitz.Document
+        self._refs = {}   # 规范化路径 -> 当前借用数
+        self._fingerprints = {}   # 规范化路径 -> 文件内容哈希
+        self._lock = threading.Lock()
+        self.open_count = 0     # 实际调用fitz.open的次数
+        self.borrow_count = 0   # 借用次数（含首次打开）
+    
+    @staticmethod
+    def _key(pdf_path) -> str:
+        return str(Path(pdf_path).resolve())
+    
+    def acquire(self, pdf_path) -> fitz.Document:
+        """借用PDF句柄，首次借用时打开"""
+        key = self._key(pdf_path)
+        with self._lock:
+            doc = self._docs.get(key)
+            if doc is None:
+                doc = fitz.open(key)
+                self._docs[key] = doc
+                self._refs[key] = 0
+                self.open_count += 1
+            self._refs[key] += 1
+            self.borrow_count += 1
+            return doc
+    
+    def release(self, pdf_path):
+        """归还借用（不关闭句柄，保证同一运行内后续借用不会重新解析）"""
+        key = self._key(pdf_path)
+        with self._lock:
+            if self._refs.get(key, 0) > 0:
+                self._refs[key] -= 1
+    
+    def close(self, pdf_path):
+        """显式关闭某个PDF的句柄（批量处理多篇论文时，处理完一篇即可释放）"""
+        key = self._key(pdf_path)
+        with self._lock:
+            doc = self._docs.pop(key, None)
+            self._refs.pop(key, None)
+            self._fingerprints.pop(key, None)
+        if doc is not None:
+            doc.close()
+    
+    def close_all(self):
+        """关闭所有句柄（运行结束时调用）"""
+        with self._lock:
+            docs = list(self._docs.values())
+            self._docs.clear()
+            self._refs.clear()
+            self._fingerprints.clear()
+        for doc in docs:
+            doc.close()
+    
+    def fingerprint(self, pdf_path) -> str:
+        """PDF文件内容的sha256（每个PDF在一次运行中只计算一次），用作页面图片缓存键，文件被替换后旧缓存不再命中"""
+        key = self._key(pdf_path)
+        with self._lock:
+            digest = self._fingerprints.get(key)
+            if digest is None:
+                sha = hashlib.sha256()
+                with open(key, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        sha.update(chunk)
+                digest = self._fingerprints[key] = sha.hexdigest()
+            return digest
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close_all()
+    
+    def summary(self) -> str:
+        return f"PDF打开{self.open_count}次，借用{self.borrow_count}次"
+
+class ImageEncoder:
+    """
+    分析图片编码阶段（PDFProcessor和MarkerProcessor共用）
+    控制输出格式、有损压缩质量和最长边像素上限，在满足上限的前提下按DPI渲染
+    """
+    
+    MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+    
+    def __init__(self, fmt: str = IMAGE_FORMAT, quality: int = IMAGE_QUALITY,
+                 max_dim: Optional[int] = IMAGE_MAX_DIM, dpi: int = IMAGE_DPI):
+        fmt = fmt.lower()
+        if fmt == "jpg":
+            fmt = "jpeg"
+        if fmt not in self.MIME_TYPES:
+            raise ValueError(f"不支持的图片格式: {fmt}（可选: png, jpeg, webp）")
+        if fmt == "webp":
+            try:
+                import PIL  # noqa: F401
+            except ImportError:
+                print("⚠️ 未安装Pillow，无法编码WebP，改用JPEG")
+                fmt = "jpeg"
+        self.fmt = fmt
+        self.quality = quality
+        self.max_dim = max_dim
+        self.dpi = dpi
+    
+    @property
+    def mime_type(self) -> str:
+        return self.MIME_TYPES[self.fmt]
+    
+    def cache_key(self) -> tuple:
+        """影响输出字节的全部参数，用作页面图片缓存键的一部分"""
+        return (self.fmt, self.quality, self.max_dim, self.dpi)
+    
+    def _zoom(self, rect: fitz.Rect) -> float:
+        """计算缩放比例：默认按DPI，超过最长边上限时按上限缩小"""
+        zoom = self.dpi / 72
+        if self.max_dim:
+            longest = max(rect.width, rect.height) * zoom
+            if longest > self.max_dim:
+                zoom = self.max_dim / max(rect.width, rect.height)
+        return zoom
+    
+    def encode_bytes(self, doc: fitz.Document, page_number: int, clip: Optional[tuple] = None) -> bytes:
+        """渲染并编码页面（或clip区域），返回图片字节"""
+        page = doc.load_page(page_number)
+        rect = fitz.Rect(clip) if clip else page.rect
+        zoom = self._zoom(rect)
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=fitz.Rect(clip) if clip else None)
+        
+        if self.fmt == "png":
+            return pix.tobytes("png")
+        if self.fmt == "jpeg":
+            return pix.tobytes("jpeg", jpg_quality=self.quality)
+        
+        from PIL import Image
+        img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+        buffer = io.BytesIO()
+        img.save(buffer, format="WEBP", quality=self.quality)
+        return buffer.getvalue()
+    
+    def encode(self, doc: fitz.Document, page_number: int, clip: Optional[tuple] = None) -> str:
+        """渲染并编码页面（或clip区域），返回base64字符串"""
+        return base64.b64encode(self.encode_bytes(doc, page_number, clip)).decode("utf-8")
+
+def _evict_dir_lru(directory: Path, pattern: str, max_bytes: int):
+    """目录中匹配pattern的文件总大小超过max_bytes时，按mtime从旧到新删除（读取时刷新mtime即为LRU）"""
+    entries = []
+    total = 0
+    for entry in directory.glob(pattern):
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry))
+        total += stat.st_size
+    
+    if total <= max_bytes:
+        return
+    
+    entries.sort(key=lambda e: e[0])
+    for _, size, entry in entries:
+        if total <= max_bytes:
+            break
+        try:
+            entry.unlink()
+            total -= size
+        except OSError:
+            pass
+
+class PageImageCache:
+    """
+    渲染页面图片的LRU内存缓存，键为 (PDF内容哈希, 页码, 裁剪区域, 编码参数)
+    可选磁盘溢出：内存淘汰的条目写入spill_dir，再次命中时读回内存；
+    溢出目录可跨运行复用，总大小超过spill_max_mb后按mtime淘汰（同OCRCache）
+    """
+    
+    def __init__(self, max_items: int = PAGE_IMAGE_CACHE_SIZE, spill_dir: Optional[Path] = PAGE_IMAGE_SPILL_DIR,
+                 spill_max_mb: int = PAGE_IMAGE_SPILL_MAX_MB):
+        self.max_items = max_items
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+        if self.spill_dir:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+        self.spill_max_bytes = spill_max_mb * 1024 * 1024
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+    
+    def _spill_path(self, key: tuple) -> Path:
+        digest = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+        return self.spill_dir / f"{digest}.b64"
+    
+    def get_or_render(self, key: tuple, render_fn) -> str:
+        """命中则返回缓存的base64图片，否则调用render_fn()渲染并缓存"""
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+        
+        image_b64 = None
+        if self.spill_dir:
+            spill_path = self._spill_path(key)
+            try:
+                image_b64 = spill_path.read_text(encoding="ascii")
+            except OSError:
+                pass
+            else:
+                # 刷新mtime作为LRU的"最近使用"时间
+                try:
+                    os.utime(spill_path)
+                except OSError:
+                    pass
+                with self._lock:
+                    self.disk_hits += 1
+        
+        if image_b64 is None:
+            image_b64 = render_fn()
+            with self._lock:
+                self.misses += 1
+        
+        self._store(key, image_b64)
+        return image_b64
+    
+    def _store(self, key: tuple, image_b64: str):
+        evicted = []
+        with self._lock:
+            self._items[key] = image_b64
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                evicted.append(self._items.popitem(last=False))
+        
+        if self.spill_dir and evicted:
+            for old_key, old_b64 in evicted:
+                spill_path = self._spill_path(old_key)
+                if spill_path.exists():
+                    continue
+                # 先写临时文件再原子替换，避免并发运行读到半个文件
+                tmp_path = spill_path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+                try:
+                    tmp_path.write_text(old_b64, encoding="ascii")
+                    os.replace(tmp_path, spill_path)
+                except OSError:
+                    pass
+            _evict_dir_lru(self.spill_dir, "*.b64", self.spill_max_bytes)
+    
+    def summary(self) -> str:
+        total = self.hits + self.disk_hits + self.misses
+        hit_rate = (self.hits + self.disk_hits) / total if total else 0.0
+        return f"页面图片缓存: 命中{self.hits}次（磁盘{self.disk_hits}次），未命中{self.misses}次，命中率{hit_rate:.0%}"
+
 class PDFProcessor:
-    def __init__(self, pdf_path: str):
+    def __init__(self, pdf_path: str, registry: Optional[DocumentRegistry] = None,
+                 image_cache: Optional[PageImageCache] = None, image_encoder: Optional[ImageEncoder] = None):
         self.pdf_path = pdf_path
-        self.doc = fitz.open(pdf_path)
+        # 未提供共享注册表时使用私有注册表，close()时一并关闭
+        self._owns_registry = registry is None
+        self.registry = registry or DocumentRegistry()
+        self.doc = self.registry.acquire(pdf_path)
+        self.image_cache = image_cache or PageImageCache()
+        self.image_encoder = image_encoder or ImageEncoder()
         # Note: MinerU integration requires significant refactoring
         # For now, using PyMuPDF which is stable and accurate for text PDFs 
 
-    def get_page_image(self, page_number: int, dpi: int = 300) -> str:
-        """Render page to base64 image."""
+    def get_page_image(self, page_number: int, clip: Optional[tuple] = None) -> str:
+        """Render page (or the clip region of it) to base64 image with the shared encoder, cached."""
         if not (0 <= page_number < len(self.doc)):
             raise ValueError(f"Page {page_number} out of range")
         
-        page = self.doc.load_page(page_number)
-        pix = page.get_pixmap(dpi=dpi)
-        img_data = pix.tobytes("png")
-        return base64.b64encode(img_data).decode("utf-8")
+        key = (self.registry.fingerprint(self.pdf_path), page_number, clip) + self.image_encoder.cache_key()
+        return self.image_cache.get_or_render(key, lambda: self.image_encoder.encode(self.doc, page_number, clip))
 
     def get_text(self, start_page: int = 0, num_pages: int = 3) -> str:
         """Extract text from the first few pages for abstract/TOC analysis."""
@@ -153,32 +495,357 @@ class PDFProcessor:
         return combined_text
 
     def close(self):
-        self.doc.close()
+        self.registry.release(self.pdf_path)
+        if self._owns_registry:
+            self.registry.close_all()
 
-class MarkerProcessor:
-    """使用Marker处理PDF - 支持公式识别，使用Python API + 临时文件逐页处理"""
+def _get_free_ram_gb() -> Optional[float]:
+    """获取空闲内存（GB），无法检测时返回None"""
+    try:
+        import psutil
+        return psutil.virtual_memory().available / 1024**3
+    except ImportError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 1024**3
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def detect_marker_page_window() -> int:
+    """
+    根据空闲显存/内存自动选择Marker每次转换的页数
+    应在模型加载之后调用，此时的空闲显存才反映真实可用量
+    """
+    try:
+        import torch
+        if torch.cuda.is_available():
+            free_bytes, _ = torch.cuda.mem_get_info()
+            free_gb = free_bytes / 1024**3
+            window = int((free_gb - MARKER_VRAM_RESERVE_GB) // MARKER_VRAM_PER_PAGE_GB)
+            return max(1, min(MARKER_MAX_PAGE_WINDOW, window))
+    except ImportError:
+        pass
     
-    def __init__(self, pdf_path: str):
-        self.pdf_path = Path(pdf_path)
+    free_gb = _get_free_ram_gb()
+    if free_gb is None:
+        return 1
+    window = int((free_gb - MARKER_RAM_RESERVE_GB) // MARKER_RAM_PER_PAGE_GB)
+    return max(1, min(MARKER_MAX_PAGE_WINDOW, window))
+
+# Marker在paginate_output模式下为每页插入的分隔符: "{页码}" + "-"*48
+MARKER_PAGE_SEPARATOR_RE = re.compile(r"\{(\d+)\}-{48}")
+
+def split_paginated_markdown(markdown: str, page_nums: List[int]) -> Optional[List[str]]:
+    """
+    将Marker多页输出按页拆分
+    返回与page_nums顺序一致的文本列表；若分隔符与预期页码不符，返回None
+    """
+    parts = MARKER_PAGE_SEPARATOR_RE.split(markdown)
+    # re.split带捕获组: [前导文本, 页码1, 文本1, 页码2, 文本2, ...]
+    page_texts = {}
+    for i in range(1, len(parts) - 1, 2):
+        page_texts[int(parts[i])] = parts[i + 1].strip()
+    
+    if sorted(page_texts) != sorted(page_nums):
+        return None
+    return [page_texts[p] for p in page_nums]
+
+def make_run_temp_dir(prefix: str = "marker_run_") -> Path:
+    """
+    为本次运行创建独立的临时目录（优先使用tmpfs /dev/shm）
+    同一工作目录下并发运行时不会互相覆盖或删除对方的临时文件
+    """
+    shm = Path("/dev/shm")
+    base_dir = str(shm) if shm.is_dir() and os.access(shm, os.W_OK) else None
+    return Path(tempfile.mkdtemp(prefix=prefix, dir=base_dir))
+
+def get_marker_version() -> str:
+    """获取已安装的marker-pdf版本（未安装时返回'unknown'）"""
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+        return version("marker-pdf")
+    except PackageNotFoundError:
+        return "unknown"
+
+class OCRCache:
+    """
+    Marker页面OCR结果的磁盘缓存（内容寻址 + 大小受限的LRU淘汰）
+    每个条目是一个 <key>.md 文件；命中时刷新文件mtime，淘汰时删除mtime最旧的条目
+    """
+    
+    def __init__(self, cache_dir: Path = OCR_CACHE_DIR, max_mb: int = OCR_CACHE_MAX_MB):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def make_key(page_hash: str, marker_version: str, options: dict) -> str:
+        """根据页面内容哈希、Marker版本和转换选项生成缓存键"""
+        options_str = json.dumps(options, sort_keys=True, ensure_ascii=False)
+        raw = f"{page_hash}|{marker_version}|{options_str}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.md"
+    
+    def get(self, key: str) -> Optional[str]:
+        """读取缓存，未命中返回None"""
+        path = self._path(key)
+        try:
+            text = path.read_text(encoding="utf-8")
+        except (FileNotFoundError, OSError):
+            self.misses += 1
+            return None
+        # 刷新mtime作为LRU的"最近使用"时间
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return text
+    
+    def put(self, key: str, text: str):
+        """写入缓存（先写临时文件再原子替换，避免并发运行读到半个文件），然后按需淘汰"""
+        path = self._path(key)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            tmp_path.write_text(text, encoding="utf-8")
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"  ⚠️ OCR缓存写入失败: {e}")
+            return
+        _evict_dir_lru(self.cache_dir, "*.md", self.max_bytes)
+
+def _marker_worker_main(worker_id: int, task_queue, result_queue, torch_threads: int):
+    """
+    OCR工作进程入口：加载一次Marker模型并常驻，循环处理分配到的 (pdf_path, page_num)
+    结果通过result_queue回传: (状态, worker_id, page_num, 文本/错误信息, 耗时)
+    """
+    try:
+        import torch
+        torch.set_num_threads(torch_threads)
+    except ImportError:
+        pass
+    
+    try:
+        from marker.models import create_model_dict
+        from marker.converters.pdf import PdfConverter
+        from marker.config.parser import ConfigParser
+        from marker.output import text_from_rendered
         
-        # 设置临时输出目录
-        self.output_dir = Path("marker_temp_output")
-        self.output_dir.mkdir(exist_ok=True)
+        config_parser = ConfigParser(dict(MARKER_OPTIONS))
+        converter = PdfConverter(
+            config=config_parser.generate_config_dict(),
+            artifact_dict=create_model_dict(),
+            processor_list=config_parser.get_processors(),
+            renderer=config_parser.get_renderer(),
+            llm_service=config_parser.get_llm_service(),
+        )
+    except Exception as e:
+        result_queue.put(("init_error", worker_id, None, str(e), 0.0))
+        return
+    
+    result_queue.put(("ready", worker_id, None, None, 0.0))
+    
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        pdf_path, page_num = task
+        start = time.perf_counter()
+        try:
+            converter.config["page_range"] = [page_num]
+            rendered = converter(pdf_path)
+            text, _, _ = text_from_rendered(rendered)
+            result_queue.put(("ok", worker_id, page_num, text, time.perf_counter() - start))
+        except Exception as e:
+            result_queue.put(("error", worker_id, page_num, str(e), time.perf_counter() - start))
+
+class MarkerWorkerPool:
+    """
+    多进程Marker OCR引擎
+    每个工作进程常驻并只加载一次create_model_dict()；页面逐个分配给空闲进程，
+    失败的页面优先分配给另一个进程重试，结果按页码重新组装
+    """
+    
+    def __init__(self, num_workers: int, max_attempts: int = OCR_MAX_ATTEMPTS):
+        self.num_workers = num_workers
+        self.max_attempts = max_attempts
+        self._workers = {}       # worker_id -> Process
+        self._task_queues = {}   # worker_id -> Queue（每个进程独立队列，才能指定由哪个进程重试）
+        self._result_queue = None
+        self._ready = set()
+        self._dead = set()
+        self.page_timings = []   # [(page_num, seconds), ...]（工作进程内的转换耗时）
+    
+    def start(self):
+        """启动工作进程（使用spawn，避免fork后CUDA/torch状态异常）"""
+        if self._workers:
+            return
+        import multiprocessing as mp
+        ctx = mp.get_context("spawn")
+        self._result_queue = ctx.Queue()
+        torch_threads = max(1, (os.cpu_count() or 1) // self.num_workers)
         
-        # 获取总页数（PyMuPDF）
-        self.doc = fitz.open(str(self.pdf_path))
-        self.total_pages = len(self.doc)
-        # Note: Keep doc open for later use (e.g., get_page_image)
+        print(f"🧵 启动{self.num_workers}个Marker OCR工作进程（每进程{torch_threads}个线程）...")
+        for worker_id in range(self.num_workers):
+            task_queue = ctx.Queue()
+            process = ctx.Process(
+                target=_marker_worker_main,
+                args=(worker_id, task_queue, self._result_queue, torch_threads),
+                daemon=True,
+            )
+            process.start()
+            self._workers[worker_id] = process
+            self._task_queues[worker_id] = task_queue
+    
+    def _alive_workers(self) -> List[int]:
+        return [w for w, proc in self._workers.items() if w not in self._dead and proc.is_alive()]
+    
+    def convert_pages(self, pdf_path: str, page_nums: List[int], total_pages: int) -> dict:
+        """
+        并行转换指定页面，返回 {page_num: text}
+        某页在所有尝试中都失败时抛出RuntimeError
+        """
+        return dict(self.iter_convert_pages(pdf_path, page_nums, total_pages))
+    
+    def iter_convert_pages(self, pdf_path: str, page_nums: List[int], total_pages: int):
+        """
+        并行转换指定页面，每完成一页就yield (page_num, text)（按完成顺序，不保证页码顺序）
+        调用方提前关闭生成器时，等待已分配的页面完成并丢弃结果，避免残留结果串入下一次调用
+        """
+        from collections import deque
+        import queue
         
-        # 延迟加载marker模型
-        self._model_dict = None
-        self._converter_cls = None
+        self.start()
+        pending = deque(page_nums)
+        attempts = {p: 0 for p in page_nums}
+        failed_on = {p: set() for p in page_nums}  # page -> 曾失败过的worker
+        busy = {}  # worker_id -> page_num
+        results = {}
+        
+        def assign():
+            for worker_id in self._alive_workers():
+                if worker_id in busy or worker_id not in self._ready or not pending:
+                    continue
+                # 优先选择没有在该worker上失败过的页面
+                chosen = None
+                for page_num in pending:
+                    if worker_id not in failed_on[page_num]:
+                        chosen = page_num
+                        break
+                if chosen is None:
+                    # 只有所有存活worker都失败过时，才允许在同一worker上重试
+                    alive = set(self._alive_workers())
+                    for page_num in pending:
+                        if alive <= failed_on[page_num]:
+                            chosen = page_num
+                            break
+                if chosen is None:
+                    continue
+                pending.remove(chosen)
+                attempts[chosen] += 1
+                busy[worker_id] = chosen
+                self._task_queues[worker_id].put((pdf_path, chosen))
         
-        print(f"📚 使用Marker处理PDF（支持公式识别）- Python API + 临时文件模式")
+        def record_failure(worker_id: int, page_num: int, error: str):
+            failed_on[page_num].add(worker_id)
+            if attempts[page_num] >= self.max_attempts:
+                raise RuntimeError(f"Marker处理第{page_num + 1}页失败（已尝试{attempts[page_num]}次）: {error}")
+            print(f"  ⚠️ 第{page_num + 1}/{total_pages}页在进程{worker_id}上失败: {error}，将换进程重试")
+            pending.appendleft(page_num)
+        
+        def next_result():
+            """取一条工作进程消息；超时时检查处理中的进程是否崩溃（如OOM被杀），返回None"""
+            try:
+                return self._result_queue.get(timeout=1.0)
+            except queue.Empty:
+                for worker_id, page_num in list(busy.items()):
+                    if not self._workers[worker_id].is_alive():
+                        self._dead.add(worker_id)
+                        del busy[worker_id]
+                        record_failure(worker_id, page_num, "工作进程意外退出")
+                return None
+        
+        try:
+            while len(results) < len(page_nums):
+                if not self._alive_workers():
+                    raise RuntimeError("所有Marker OCR工作进程均已退出")
+                assign()
+                
+                message = next_result()
+                if message is None:
+                    continue
+                status, worker_id, page_num, payload, elapsed = message
+                
+                if status == "ready":
+                    self._ready.add(worker_id)
+                elif status == "init_error":
+                    print(f"  ❌ OCR工作进程{worker_id}初始化失败: {payload}")
+                    self._dead.add(worker_id)
+                elif status == "ok":
+                    busy.pop(worker_id, None)
+                    results[page_num] = payload
+                    self.page_timings.append((page_num, elapsed))
+                    print(f"  📖 第{page_num + 1}/{total_pages}页 ✅ (进程{worker_id}, {elapsed:.1f}秒, 已完成{len(results)}/{len(page_nums)})")
+                    yield page_num, payload
+                elif status == "error":
+                    busy.pop(worker_id, None)
+                    record_failure(worker_id, page_num, payload)
+        finally:
+            # 提前结束（出错或调用方关闭生成器）时，收回仍在处理中的页面
+            while busy and self._alive_workers():
+                try:
+                    message = self._result_queue.get(timeout=1.0)
+                except queue.Empty:
+                    for worker_id in list(busy):
+                        if not self._workers[worker_id].is_alive():
+                            self._dead.add(worker_id)
+                            del busy[worker_id]
+                    continue
+                status, worker_id = message[0], message[1]
+                if status == "ready":
+                    self._ready.add(worker_id)
+                elif status in ("ok", "error"):
+                    busy.pop(worker_id, None)
     
-    def _init_marker(self):
-        """初始化Marker模型和转换器"""
-        if self._model_dict is None:
+    def close(self):
+        """通知所有工作进程退出并回收"""
+        for worker_id, task_queue in self._task_queues.items():
+            if self._workers[worker_id].is_alive():
+                task_queue.put(None)
+        for process in self._workers.values():
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self._workers.clear()
+        self._task_queues.clear()
+        self._ready.clear()
+        self._dead.clear()
+
+class MarkerSession:
+    """
+    Marker模型与持久化PdfConverter会话
+    可在多篇论文之间共享（批量模式），模型只加载一次；
+    转换时会修改converter.config（page_range等），同一时刻只能有一个调用方使用，转换期间需持有lock
+    """
+    
+    def __init__(self, output_dir: Optional[Path] = None):
+        self.output_dir = Path(output_dir) if output_dir else make_run_temp_dir("marker_session_")
+        self._owns_output_dir = output_dir is None
+        self.model_dict = None
+        self.config_parser = None
+        self.converter = None
+        self.setup_seconds = 0.0
+        self.lock = threading.RLock()
+    
+    def ensure_loaded(self):
+        """首次调用时加载Marker模型并创建Converter会话"""
+        with self.lock:
+            if self.converter is not None:
+                return
             print("⏳ 首次使用，正在加载Marker模型...")
             try:
                 # 导入marker内部组件
@@ -187,71 +854,180 @@ class MarkerProcessor:
                 from marker.config.parser import ConfigParser
                 
                 # 设置环境变量优化显存
-                import os
                 os.environ["INFERENCE_RAM"] = "8"
                 os.environ["VRAM_PER_TASK"] = "4"
                 
                 # 加载模型
-                self._model_dict = create_model_dict()
+                self.model_dict = create_model_dict()
                 
                 # 加载配置 - 必须提供 output_format
-                config_parser = ConfigParser({"output_format": "markdown", "output_dir": "marker_temp_output"})
-                
-                # 保存配置用于每次创建converter
-                self._config_parser = config_parser
-                self._PdfConverter = PdfConverter
+                self.config_parser = ConfigParser({**MARKER_OPTIONS, "output_dir": str(self.output_dir)})
                 
                 print("✅ 模型加载完成")
+                
+                # 创建持久化的Converter会话：所有页面复用同一个实例
+                # PdfConverter.__call__ 每次都会重新build_document，除 page_count 外不保留跨调用状态
+                setup_start = time.perf_counter()
+                self.converter = PdfConverter(
+                    config=self.config_parser.generate_config_dict(),
+                    artifact_dict=self.model_dict,
+                    processor_list=self.config_parser.get_processors(),
+                    renderer=self.config_parser.get_renderer(),
+                    llm_service=self.config_parser.get_llm_service(),
+                )
+                self.setup_seconds = time.perf_counter() - setup_start
+                print(f"✅ Converter会话已创建（{self.setup_seconds:.2f}秒），将复用于所有页面")
             except ImportError as e:
                 raise ImportError(f"Marker导入失败，请确保安装了marker-pdf: {e}")
             except Exception as e:
                 raise RuntimeError(f"Marker初始化失败: {e}")
+    
+    def close(self):
+        """清理会话自建的临时目录"""
+        import shutil
+        if self._owns_output_dir and self.output_dir.exists():
+            shutil.rmtree(self.output_dir, ignore_errors=True)
 
-    def _process_single_page(self, page_num: int) -> str:
-        """处理单个页面：提取为临时PDF -> Marker转换 -> 返回文本"""
-        import tempfile
+class MarkerProcessor:
+    """使用Marker处理PDF - 支持公式识别，使用Python API，支持多页窗口与逐页模式"""
+    
+    def __init__(self, pdf_path: str, page_window: int = MARKER_PAGE_WINDOW, ocr_cache: Optional[OCRCache] = None,
+                 ocr_workers: int = OCR_WORKERS, registry: Optional[DocumentRegistry] = None,
+                 image_cache: Optional[PageImageCache] = None, image_encoder: Optional[ImageEncoder] = None,
+                 session: Optional[MarkerSession] = None, worker_pool: Optional["MarkerWorkerPool"] = None):
+        self.pdf_path = Path(pdf_path)
+        # 0表示在模型加载后自动检测
+        self.page_window = page_window
+        # OCR结果缓存（None表示禁用）
+        self.ocr_cache = ocr_cache
+        # 多进程OCR（>1时启用，延迟到确实需要转换时才启动）；批量模式下可传入共享的工作进程池
+        self.ocr_workers = ocr_workers
+        self._worker_pool = worker_pool
+        self._owns_worker_pool = worker_pool is None
+        
+        # 设置临时输出目录
+        # 每次运行独立的临时目录，仅在Marker不支持字节流输入时用于存放单页PDF
+        self.output_dir = make_run_temp_dir()
+        # Marker模型会话（批量模式下多篇论文共享，模型只加载一次）
+        self.session = session or MarkerSession(self.output_dir)
+        
+        # 获取总页数（PyMuPDF，从共享注册表借用句柄）
+        self._owns_registry = registry is None
+        self.registry = registry or DocumentRegistry()
+        with FITZ_LOCK:
+            self.doc = self.registry.acquire(self.pdf_path)
+        self.total_pages = len(self.doc)
+        # Note: Keep doc open for later use (e.g., get_page_image)
+        self.image_cache = image_cache or PageImageCache()
+        self.image_encoder = image_encoder or ImageEncoder()
+        
+        # 延迟加载marker模型
+        self._model_dict = None
+        self._config_parser = None
+        self._converter = None  # 持久化的PdfConverter会话，在_init_marker中从MarkerSession获取
+        
+        # 计时统计（用于对比一次性初始化开销与逐页转换耗时）
+        self.session_setup_seconds = 0.0
+        self.page_timings = []  # [(page_num, seconds), ...]
+        self.cached_pages = 0   # 命中OCR缓存的页数
+        
+        print(f"📚 使用Marker处理PDF（支持公式识别）- Python API + 内存单页模式")
+    
+    def _init_marker(self):
+        """初始化Marker模型和转换器（由MarkerSession加载，共享会话时多篇论文只加载一次）"""
+        if self._converter is not None:
+            return
+        newly_loaded = self.session.converter is None
+        self.session.ensure_loaded()
+        self._model_dict = self.session.model_dict
+        self._config_parser = self.session.config_parser
+        self._converter = self.session.converter
+        # 共享会话时只有首次加载模型的论文计入初始化开销
+        self.session_setup_seconds = self.session.setup_seconds if newly_loaded else 0.0
+        
+        if self.page_window <= 0:
+            self.page_window = detect_marker_page_window()
+            print(f"🪟 根据空闲显存/内存自动选择页窗口: 每次转换{self.page_window}页")
+
+    def _convert(self, source, page_range: Optional[List[int]] = None) -> str:
+        """
+        用持久化Converter转换PDF（路径或BytesIO）并返回markdown文本
+        page_range不为None时只转换指定页，并开启分页输出以便按页拆分
+        """
         from marker.output import text_from_rendered
         
-        # 1. 提取单页为临时PDF
-        temp_pdf_path = self.output_dir / f"temp_page_{page_num}.pdf"
+        # Provider和Renderer在每次调用时按self.config重新创建，因此可以逐次切换页范围
+        config = self._converter.config
+        if page_range is None:
+            config.pop("page_range", None)
+            config["paginate_output"] = False
+        else:
+            config["page_range"] = page_range
+            config["paginate_output"] = True
         
-        try:
-            doc = fitz.open(str(self.pdf_path))
+        rendered = self._converter(source)
+        text, _, _ = text_from_rendered(rendered)
+        return text
+
+    def _process_page_window(self, start_page: int, end_page: int) -> List[str]:
+        """
+        多页窗口模式：一次转换[start_page, end_page]范围内的页面，再按页拆分
+        拆分失败时抛出ValueError，由调用方回退到逐页模式
+        """
+        page_nums = list(range(start_page, end_page + 1))
+        
+        convert_start = time.perf_counter()
+        markdown = self._convert(str(self.pdf_path), page_range=page_nums)
+        page_texts = split_paginated_markdown(markdown, page_nums)
+        if page_texts is None:
+            raise ValueError(f"无法按页拆分第{start_page + 1}-{end_page + 1}页的输出")
+        
+        per_page = (time.perf_counter() - convert_start) / len(page_nums)
+        self.page_timings.extend((p, per_page) for p in page_nums)
+        return page_texts
+
+    def _page_pdf_bytes(self, page_num: int) -> bytes:
+        """将单页提取为独立PDF的字节串（no_new_id保证相同页面内容得到相同字节）"""
+        with FITZ_LOCK:
             new_doc = fitz.open()
-            new_doc.insert_pdf(doc, from_page=page_num, to_page=page_num)
-            new_doc.save(str(temp_pdf_path))
+            new_doc.insert_pdf(self.doc, from_page=page_num, to_page=page_num)
+            data = new_doc.tobytes(garbage=3, deflate=True, no_new_id=True)
             new_doc.close()
-            doc.close()
-            
-            # 2. 创建Converter实例 (每次处理都需要重新实例化吗？参考convert_single.py似乎是一次性的)
-            # 但为了安全起见，我们按照convert_single.py的模式，每次都创建converter
-            # 或者复用converter？ PdfConverter有状态吗？
-            # 源码显示 self.page_count = None，似乎可以复用，但 __init__ 里处理了 artifact_dict
-            # 为了稳妥，每次创建新的 converter 实例
-            
-            converter = self._PdfConverter(
-                config=self._config_parser.generate_config_dict(),
-                artifact_dict=self._model_dict,
-                processor_list=self._config_parser.get_processors(),
-                renderer=self._config_parser.get_renderer(),
-                llm_service=self._config_parser.get_llm_service(),
-            )
-            
-            # 3. 运行转换
-            rendered = converter(str(temp_pdf_path))
-            
-            # 4. 提取文本
-            text, _, _ = text_from_rendered(rendered)
-            
-            return text
-            
-        finally:
-            # 清理临时文件
-            if temp_pdf_path.exists():
-                try:
-                    os.remove(temp_pdf_path)
-                except:
-                    pass
+        return data
+
+    def _page_cache_keys(self) -> List[str]:
+        """计算每一页的OCR缓存键"""
+        marker_version = get_marker_version()
+        keys = []
+        for page_num in range(self.total_pages):
+            page_hash = hashlib.sha256(self._page_pdf_bytes(page_num)).hexdigest()
+            keys.append(OCRCache.make_key(page_hash, marker_version, MARKER_OPTIONS))
+        return keys
+
+    def _process_single_page(self, page_num: int) -> str:
+        """处理单个页面：在内存中提取单页PDF -> 复用Converter会话转换 -> 返回文本"""
+        # 1. 从已打开的self.doc提取单页字节（不落盘）
+        page_bytes = self._page_pdf_bytes(page_num)
+        
+        convert_start = time.perf_counter()
+        # 较新的Marker支持直接传入BytesIO；旧版本只接受路径，回退到本次运行独立的临时目录
+        if hasattr(self._converter, "filepath_to_str"):
+            text = self._convert(io.BytesIO(page_bytes))
+        else:
+            temp_pdf_path = self.output_dir / f"temp_page_{page_num}.pdf"
+            try:
+                temp_pdf_path.write_bytes(page_bytes)
+                text = self._convert(str(temp_pdf_path))
+            finally:
+                # 清理临时文件
+                if temp_pdf_path.exists():
+                    try:
+                        os.remove(temp_pdf_path)
+                    except:
+                        pass
+        self.page_timings.append((page_num, time.perf_counter() - convert_start))
+        
+        return text
 
     def get_text(self, start_page: int = 0, num_pages: int = 3) -> str:
         """提取前几页文本"""
@@ -274,44 +1050,155 @@ class MarkerProcessor:
         
         return "\n\n".join(all_text)
     
+    def _convert_pages(self, page_nums: List[int]) -> dict:
+        """
+        转换指定的页面（已排序），返回 {page_num: text}
+        连续的页面按多页窗口转换，窗口失败时回退到逐页模式
+        """
+        return dict(self._iter_convert_pages(page_nums))
+    
+    def _iter_convert_pages(self, page_nums: List[int]):
+        """同_convert_pages，但每转换完一个窗口/一页就yield (page_num, text)"""
+        window = max(1, self.page_window)
+        
+        # 按连续区间切分，只有连续页面才能组成一个page_range窗口
+        runs = []
+        for page_num in page_nums:
+            if runs and page_num == runs[-1][-1] + 1:
+                runs[-1].append(page_num)
+            else:
+                runs.append([page_num])
+        
+        for run in runs:
+            pos = 0
+            while pos < len(run):
+                start_page = run[pos]
+                end_page = run[min(pos + window, len(run)) - 1]
+                
+                if end_page > start_page:
+                    print(f"  📖 处理第{start_page + 1}-{end_page + 1}/{self.total_pages}页...", end="", flush=True)
+                    try:
+                        page_texts = self._process_page_window(start_page, end_page)
+                        print(" ✅")
+                    except Exception as e:
+                        page_texts = None
+                        print(f" ⚠️ 窗口转换失败: {e}，回退到逐页模式")
+                        if "out of memory" in str(e).lower():
+                            # 显存不足时缩小后续窗口
+                            window = max(1, window // 2)
+                            print(f"  🪟 页窗口缩小为{window}页")
+                    if page_texts is not None:
+                        yield from zip(range(start_page, end_page + 1), page_texts)
+                        pos += end_page - start_page + 1
+                        continue
+                
+                # 逐页模式（窗口为1或窗口转换失败时）
+                for single_page in range(start_page, end_page + 1):
+                    print(f"  📖 处理第{single_page + 1}/{self.total_pages}页...", end="", flush=True)
+                    
+                    try:
+                        text = self._process_single_page(single_page)
+                        print(" ✅")
+                    except Exception as e:
+                        print(f" ❌ {e}")
+                        raise RuntimeError(f"Marker处理第{single_page + 1}页失败: {e}")
+                    yield single_page, text
+                pos += end_page - start_page + 1
+
     def get_all_text_by_pages(self) -> List[str]:
-        """逐页识别整个PDF"""
-        self._init_marker()
+        """识别整个PDF，按页返回文本（优先读取OCR缓存，多页窗口模式，失败时回退逐页）"""
+        return [text for _, text in self.iter_pages()]
+    
+    def iter_pages(self):
+        """
+        识别整个PDF，按页码顺序逐页yield (page_num, text)：缓存命中的页面立即产出，
+        其余页面转换完成后即产出（多进程时先完成的页面在重排缓冲区等待前面的页），
+        下游可以边OCR边处理已就绪的页面
+        """
+        page_texts = {}
+        cache_keys = []
+        if self.ocr_cache is not None:
+            cache_keys = self._page_cache_keys()
+            for page_num, key in enumerate(cache_keys):
+                cached = self.ocr_cache.get(key)
+                if cached is not None:
+                    page_texts[page_num] = cached
+            self.cached_pages = len(page_texts)
+            if page_texts:
+                print(f"♻️ OCR缓存命中{len(page_texts)}/{self.total_pages}页")
         
-        print(f"⏳ Marker逐页处理整个PDF（{self.total_pages}页，预计{self.total_pages*15}秒）...")
+        next_page = 0
         
-        all_pages_text = []
-        for page_num in range(self.total_pages):
-            print(f"  📖 处理第{page_num + 1}/{self.total_pages}页...", end="", flush=True)
-            
+        def ready_pages():
+            """按页码顺序取出已就绪的连续页面"""
+            nonlocal next_page
+            while next_page in page_texts:
+                yield next_page, page_texts.pop(next_page)
+                next_page += 1
+        
+        yield from ready_pages()
+        
+        missing_pages = [p for p in range(self.total_pages) if p not in page_texts and p >= next_page]
+        if missing_pages and (self.ocr_workers > 1 or self._worker_pool is not None):
+            # 多进程模式：模型只在工作进程中加载，主进程不再加载
+            if self._worker_pool is None:
+                self._worker_pool = MarkerWorkerPool(self.ocr_workers)
+            print(f"⏳ Marker多进程处理{len(missing_pages)}页（共{self.total_pages}页，{self.ocr_workers}个工作进程）...")
+            pool_timings_start = len(self._worker_pool.page_timings)
+            converted = self._worker_pool.iter_convert_pages(str(self.pdf_path), missing_pages, self.total_pages)
             try:
-                text = self._process_single_page(page_num)
-                all_pages_text.append(text)
-                print(" ✅")
-            except Exception as e:
-                print(f" ❌ {e}")
-                raise RuntimeError(f"Marker处理第{page_num + 1}页失败: {e}")
+                for page_num, text in converted:
+                    self._store_page(page_texts, cache_keys, page_num, text)
+                    yield from ready_pages()
+            finally:
+                converted.close()
+                self.page_timings.extend(self._worker_pool.page_timings[pool_timings_start:])
+        elif missing_pages:
+            # 只有存在未缓存页面时才加载Marker模型；共享会话同一时刻只允许一篇论文转换
+            with self.session.lock:
+                self._init_marker()
+                
+                window = max(1, self.page_window)
+                mode_desc = "逐页" if window == 1 else f"每{window}页一个窗口"
+                print(f"⏳ Marker{mode_desc}处理{len(missing_pages)}页（共{self.total_pages}页，预计{len(missing_pages)*15}秒）...")
+                
+                for page_num, text in self._iter_convert_pages(missing_pages):
+                    self._store_page(page_texts, cache_keys, page_num, text)
+                    yield from ready_pages()
+        else:
+            print("♻️ 全部页面命中OCR缓存，跳过Marker识别")
         
-        print(f"✅ 完成！共识别{len(all_pages_text)}页")
-        return all_pages_text
+        print(f"✅ 完成！共识别{next_page}页")
+        if self.page_timings:
+            avg_convert = sum(t for _, t in self.page_timings) / len(self.page_timings)
+            print(f"   ⏱️ Converter会话初始化 {self.session_setup_seconds:.2f}秒（仅一次），平均每页转换 {avg_convert:.2f}秒")
+    
+    def _store_page(self, page_texts: dict, cache_keys: List[str], page_num: int, text: str):
+        """记录刚转换完成的页面，并立即写入OCR缓存（中途中断时已完成的页面不会丢失）"""
+        page_texts[page_num] = text
+        if self.ocr_cache is not None:
+            self.ocr_cache.put(cache_keys[page_num], text)
 
     
-    def get_page_image(self, page_number: int, dpi: int = 300) -> str:
-        """获取页面图片（仍使用PyMuPDF）"""
+    def get_page_image(self, page_number: int, clip: Optional[tuple] = None) -> str:
+        """获取页面图片（仍使用PyMuPDF，复用已借用的句柄，经共享编码器编码并缓存）"""
         if not (0 <= page_number < self.total_pages):
             raise ValueError(f"Page {page_number} out of range")
         
-        doc = fitz.open(str(self.pdf_path))
-        page = doc.load_page(page_number)
-        pix = page.get_pixmap(dpi=dpi)
-        img_data = pix.tobytes("png")
-        doc.close()
-        
-        return base64.b64encode(img_data).decode("utf-8")
+        key = (self.registry.fingerprint(self.pdf_path), page_number, clip) + self.image_encoder.cache_key()
+        return self.image_cache.get_or_render(key, lambda: self.image_encoder.encode(self.doc, page_number, clip))
     
     def close(self):
-        """清理临时文件"""
+        """归还PDF句柄，关闭OCR工作进程并清理临时文件"""
         import shutil
+        self.registry.release(self.pdf_path)
+        if self._owns_registry:
+            self.registry.close_all()
+        if self._worker_pool is not None and self._owns_worker_pool:
+            self._worker_pool.close()
+        self._worker_pool = None
+        if self.session.output_dir == self.output_dir:
+            self.session.close()
         if self.output_dir.exists():
             try:
                 shutil.rmtree(self.output_dir)
@@ -319,16 +1206,78 @@ class MarkerProcessor:
                 pass
 
 
+class PageStream:
+    """
+    在后台线程中驱动页面生成器（如MarkerProcessor.iter_pages），经有界队列按顺序交给消费端
+    队列满时OCR暂停（背压）；生成器中的异常在消费端迭代时重新抛出；close()可提前停止OCR
+    """
+    
+    _DONE = object()
+    
+    def __init__(self, pages, maxsize: int = PAGE_STREAM_QUEUE_SIZE):
+        import queue
+        self._queue = queue.Queue(maxsize=max(1, maxsize))
+        self._stop = threading.Event()
+        self._error = None
+        self.elapsed = 0.0  # 生成器从开始到结束的耗时（OCR墙钟时间）
+        self._thread = threading.Thread(target=self._run, args=(pages,), name="page-stream", daemon=True)
+        self._thread.start()
+    
+    def _put(self, item) -> bool:
+        """放入队列；队列满时等待，期间收到停止信号则放弃"""
+        import queue
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def _run(self, pages):
+        started = time.perf_counter()
+        try:
+            for item in pages:
+                if not self._put(item):
+                    break
+        except BaseException as e:
+            self._error = e
+        finally:
+            # 在生产线程内关闭生成器，使其持有的锁/工作进程在同一线程中释放
+            close = getattr(pages, "close", None)
+            if close:
+                close()
+            self.elapsed = time.perf_counter() - started
+            self._put(self._DONE)
+    
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is self._DONE:
+                if self._error is not None:
+                    raise self._error
+                return
+            yield item
+    
+    def close(self):
+        """停止生产线程并等待其退出（已结束时无操作）"""
+        self._stop.set()
+        self._thread.join()
+
 class FigureScanner:
     """扫描PDF中的所有图表（图片和可能的标题）"""
-    def __init__(self, pdf_path: str):
+    def __init__(self, pdf_path: str, registry: Optional[DocumentRegistry] = None):
         self.pdf_path = pdf_path
-        self.doc = fitz.open(pdf_path)
+        self._owns_registry = registry is None
+        self.registry = registry or DocumentRegistry()
+        self.doc = self.registry.acquire(pdf_path)
     
     def scan_all_figures(self) -> List[dict]:
         """
         扫描整个PDF，返回所有检测到的图表信息
-        返回格式: [{"page": int, "index": int, "caption": str}, ...]
+        返回格式: [{"page": int, "index": int, "caption": str,
+                    "bbox": [x0, y0, x1, y1] | None,          # 图片在页面上的位置
+                    "caption_bbox": [x0, y0, x1, y1] | None}, ...]  # 标题文本的位置
         """
         figures = []
         
@@ -351,7 +1300,9 @@ class FigureScanner:
                         "page": page_num,
                         "index": idx,
                         "type": "image",
-                        "caption": caption or f"第{page_num+1}页图片{idx+1}"
+                        "caption": caption or f"第{page_num+1}页图片{idx+1}",
+                        "bbox": self._image_bbox(page, img[0]),
+                        "caption_bbox": self._caption_bbox(page, caption)
                     })
             
             # 如果只有标题没有图片（可能是纯文本表格），也记录
@@ -361,11 +1312,33 @@ class FigureScanner:
                         "page": page_num,
                         "index": 0,
                         "type": "text_figure",
-                        "caption": caption
+                        "caption": caption,
+                        "bbox": None,
+                        "caption_bbox": self._caption_bbox(page, caption)
                     })
         
         return figures
     
+    def _image_bbox(self, page: fitz.Page, xref: int) -> Optional[List[float]]:
+        """获取图片在页面上的显示区域（同一图片多次出现时取第一个）"""
+        try:
+            rects = page.get_image_rects(xref)
+        except Exception:
+            return None
+        if not rects or rects[0].is_empty:
+            return None
+        return [round(v, 1) for v in rects[0]]
+    
+    def _caption_bbox(self, page: fitz.Page, caption: Optional[str]) -> Optional[List[float]]:
+        """在页面上定位标题文本（只搜索开头部分，避免跨行匹配失败）"""
+        if not caption:
+            return None
+        needle = caption.strip()[:40]
+        hits = page.search_for(needle) if needle else []
+        if not hits:
+            return None
+        return [round(v, 1) for v in hits[0]]
+    
     def _extract_figure_captions(self, text: str, page_num: int) -> List[str]:
         """从文本中提取图表标题"""
         captions = []
@@ -394,18 +1367,36 @@ class FigureScanner:
         return captions[0] if captions else None
     
     def close(self):
-        self.doc.close()
+        self.registry.release(self.pdf_path)
+        if self._owns_registry:
+            self.registry.close_all()
+
+
+# 公式扫描用的预编译正则
+DISPLAY_EQUATION_RE = re.compile(r'\$\$(.*?)\$\$', re.DOTALL)
+# 独立编号: (1), (2), (1a), (A.1)
+EQUATION_TAG_RE = re.compile(r'\((\d+[a-z]?|[A-Z]\.\d+)\)')
+# 显式引用 "Equation 1", "Eq. 2"，找不到时再找 "式(1)"
+EQUATION_REF_RE = re.compile(r'(?:Equation|Eq\.?)\s+(\d+[a-z]?)', re.IGNORECASE)
+EQUATION_CN_REF_RE = re.compile(r'(?:式|公式)\s*\(?(\d+[a-z]?)\)?')
+# 重要公式的关键LaTeX命令：求和/积分、分数/偏导、梯度、优化、特殊字体、希腊字母参数、分布/近似、映射、不等式
+IMPORTANT_EQUATION_SYMBOL_RE = re.compile(
+    r'\\(?:sum|prod|int|frac|partial|nabla|Delta|max|min|arg|mathbb|mathcal'
+    r'|alpha|beta|theta|sim|approx|rightarrow|leftarrow|leq|geq)'
+)
 
 
 class EquationScanner:
     """扫描Marker输出中的所有公式（编号和未编号）"""
     
-    def __init__(self, all_pages_text: List[str]):
+    def __init__(self, all_pages_text: List[str], doc: Optional[fitz.Document] = None):
         """
         Args:
             all_pages_text: Marker转换后的所有页面文本列表
+            doc: 原PDF句柄（可选），提供时为每个公式估算页面上的大致区域
         """
         self.all_pages_text = all_pages_text
+        self.doc = doc
     
     def scan_all_equations(self) -> List[dict]:
         """
@@ -417,7 +1408,9 @@ class EquationScanner:
                 "equation_number": str,   # 如 "1", "2", "1a" (编号公式) 或 None
                 "equation_text": str,     # LaTeX公式文本 (去除$$符号)
                 "context": str,           # 公式上下文 (前后各50字)
-                "description": str        # 描述性标题 (根据上下文生成)
+                "description": str,       # 描述性标题 (根据上下文生成)
+                "position": float,        # 公式在页面文本中的相对位置 (0-1)
+                "bbox": [x0, y0, x1, y1]  # 页面上的大致区域 (仅提供doc时)
             },
             ...
         ]
@@ -425,149 +1418,161 @@ class EquationScanner:
         equations = []
         
         for page_num, page_text in enumerate(self.all_pages_text):
-            # 1. 识别编号公式
-            numbered_eqs = self._extract_numbered_equations(page_text, page_num)
-            equations.extend(numbered_eqs)
-            
-            # 2. 识别重要的未编号显示公式
-            unnumbered_eqs = self._extract_unnumbered_equations(
-                page_text, page_num, numbered_eqs
-            )
-            equations.extend(unnumbered_eqs)
+            equations.extend(self.scan_page(page_text, page_num))
         
         return equations
     
-    def _extract_numbered_equations(self, text: str, page_num: int) -> List[dict]:
+    def scan_page(self, page_text: str, page_num: int) -> List[dict]:
+        """扫描单页（流水线模式下页面OCR完成即可扫描），返回格式同scan_all_equations"""
+        # 编号公式在前、重要的未编号公式在后
+        equations = self._scan_page(page_text, page_num)
+        if self.doc is not None:
+            for eq in equations:
+                eq["bbox"] = self._approximate_region(eq)
+        return equations
+    
+    def _approximate_region(self, eq: dict) -> Optional[List[float]]:
         """
-        提取编号公式
-        识别模式:
-        1. 独立编号: (1), (2), (1a) 等，必须与$$...$$在±10行内
-        2. 显式引用: Equation 1, Eq. 2, 式(3) 等
+        估算编号公式在PDF页面上的区域（Marker输出不带坐标，只能近似）
+        1. 在页面上搜索编号标签"(n)"，只保留位于所在行末尾的命中（公式编号右对齐；行内引用如"from (3) we"后面还有文字），
+           多个候选时取最接近公式在页面文本中相对位置的一个
+        2. 以标签所在行为中心取整宽横条，按LaTeX中的行数（\\\\换行）上下扩展，多行/对齐公式不被截断
+        未编号公式、或找不到行末标签时返回None（使用整页：错误的裁剪比整页更糟，
+        按文本位置映射的横条在双栏页面上也没有意义）
         """
-        numbered_equations = []
-        
-        # 模式1: 查找所有$$...$$显示公式
-        display_eq_pattern = r'\$\$(.*?)\$\$'
-        display_eqs = list(re.finditer(display_eq_pattern, text, re.DOTALL))
-        
-        # 模式2: 查找所有可能的编号
-        # (1), (2), (1a), (A.1) 等模式
-        number_pattern = r'\((\d+[a-z]?|[A-Z]\.\d+)\)'
+        if not eq.get("equation_number") or not (0 <= eq["page"] < len(self.doc)):
+            return None
+        page = self.doc.load_page(eq["page"])
+        page_rect = page.rect
+        tag_text = f"({eq['equation_number']})"
+        hits = page.search_for(tag_text)
+        if not hits:
+            return None
         
-        # 模式3: 显式引用 "Equation 1", "Eq. 2", "式(1)"
-        ref_patterns = [
-            r'(?:Equation|Eq\.?)\s+(\d+[a-z]?)',
-            r'(?:式|公式)\s*\(?(\d+[a-z]?)\)?'
-        ]
+        # 每一行（block, line）的最后一个词
+        line_ends = {}
+        for x0, y0, x1, y1, word, block_no, line_no, _ in page.get_text("words"):
+            last = line_ends.get((block_no, line_no))
+            if last is None or x1 > last[0].x1:
+                line_ends[(block_no, line_no)] = (fitz.Rect(x0, y0, x1, y1), word)
+        tags = [hit for hit in hits
+                if any(word.endswith(tag_text) and abs(rect.x1 - hit.x1) < 2 and rect.intersects(hit)
+                       for rect, word in line_ends.values())]
+        if not tags:
+            return None
         
-        # 为每个显示公式尝试匹配编号
-        for eq_match in display_eqs:
-            eq_text = eq_match.group(1).strip()
-            eq_start = eq_match.start()
-            eq_end = eq_match.end()
-            
-            # 提取上下文（前后各150字符）
-            context_start = max(0, eq_start - 150)
-            context_end = min(len(text), eq_end + 150)
-            context = text[context_start:context_end]
-            
-            # 在上下文中查找编号
-            equation_number = None
-            
-            # 方法1: 查找独立编号 (1), (2) 等
-            # 在公式前后20行范围内搜索
-            lines_before = text[max(0, eq_start-500):eq_start].split('\n')
-            lines_after = text[eq_end:min(len(text), eq_end+500)].split('\n')
-            
-            # 优先在公式后面查找（通常编号在右侧）
-            for line in lines_after[:3]:  # 只看后面3行
-                number_match = re.search(number_pattern, line)
-                if number_match:
-                    equation_number = number_match.group(1)
-                    break
-            
-            # 如果后面没找到，看前面
-            if not equation_number:
-                for line in reversed(lines_before[-3:]):  # 只看前面3行
-                    number_match = re.search(number_pattern, line)
-                    if number_match:
-                        equation_number = number_match.group(1)
-                        break
-            
-            # 方法2: 查找显式引用
-            if not equation_number:
-                for ref_pattern in ref_patterns:
-                    ref_match = re.search(ref_pattern, context, re.IGNORECASE)
-                    if ref_match:
-                        equation_number = ref_match.group(1)
-                        break
-            
-            # 如果找到编号，记录为编号公式
-            if equation_number:
-                # 生成描述（基于上下文）
-                description = self._generate_description(context, equation_number, is_numbered=True)
-                
-                numbered_equations.append({
-                    "page": page_num,
-                    "equation_type": "numbered",
-                    "equation_number": equation_number,
-                    "equation_text": eq_text,
-                    "context": context,
-                    "description": description
-                })
+        position = eq.get("position")
+        if position is not None:
+            y_estimate = page_rect.y0 + page_rect.height * position
+            tag = min(tags, key=lambda hit: abs((hit.y0 + hit.y1) / 2 - y_estimate))
+        else:
+            tag = max(tags, key=lambda hit: hit.x1)
         
-        return numbered_equations
+        # 标签可能在多行公式的第一行、中间或最后一行，因此上下各扩展 (行数-1) 行
+        rows = min(1 + len(re.findall(r'\\\\', eq.get("equation_text") or "")), 12)
+        row_height = max(2.5 * tag.height, 24)
+        half_height = max(3 * tag.height, 40) + (rows - 1) * row_height
+        y_center = (tag.y0 + tag.y1) / 2
+        return [round(page_rect.x0, 1), round(max(page_rect.y0, y_center - half_height), 1),
+                round(page_rect.x1, 1), round(min(page_rect.y1, y_center + half_height), 1)]
     
-    def _extract_unnumbered_equations(
-        self, text: str, page_num: int, 
-        numbered_equations: List[dict]
-    ) -> List[dict]:
+    def _scan_page(self, text: str, page_num: int) -> List[dict]:
         """
-        提取未编号但重要的显示公式
-        排除:
-        1. 已识别为编号公式的部分
-        2. 过于简单的公式（如 x = 1）
+        单遍扫描一页：显示公式$$...$$与编号标签(1)各用预编译正则扫描一次，
+        编号/未编号公式共用同一份显示公式列表，编号查找在标签位置表上二分。
         """
-        unnumbered_equations = []
+        display_eqs = list(DISPLAY_EQUATION_RE.finditer(text))
+        if not display_eqs:
+            return []
         
-        # 提取所有已识别编号公式的文本（用于排除）
-        numbered_texts = set(eq['equation_text'] for eq in numbered_equations)
-        
-        # 查找所有$$...$$显示公式
-        display_eq_pattern = r'\$\$(.*?)\$\$'
-        display_eqs = list(re.finditer(display_eq_pattern, text, re.DOTALL))
+        # 标签不含括号和换行、互不重叠，整页扫描一次即可代替逐个窗口内的搜索
+        tags = list(EQUATION_TAG_RE.finditer(text))
+        tag_starts = [tag.start() for tag in tags]
         
+        numbered_equations = []
+        unnumbered_candidates = []
         for eq_match in display_eqs:
-            eq_text = eq_match.group(1).strip()
-            
-            # 跳过已识别为编号公式的
-            if eq_text in numbered_texts:
-                continue
-            
-            # 判断重要性
-            if not self._is_important_equation(eq_text):
-                continue
-            
-            # 提取上下文
-            eq_start = eq_match.start()
-            eq_end = eq_match.end()
+            eq_start, eq_end = eq_match.span()
             context_start = max(0, eq_start - 150)
             context_end = min(len(text), eq_end + 150)
-            context = text[context_start:context_end]
-            
-            # 生成描述性标题
-            description = self._generate_description(context, None, is_numbered=False)
-            
-            unnumbered_equations.append({
-                "page": page_num,
-                "equation_type": "unnumbered",
-                "equation_number": None,
-                "equation_text": eq_text,
-                "context": context,
-                "description": description
-            })
+            equation_number = self._find_equation_number(
+                text, eq_start, eq_end, context_start, context_end, tags, tag_starts
+            )
+            entry = (eq_match, context_start, context_end, equation_number)
+            if equation_number:
+                numbered_equations.append(self._make_equation(text, page_num, entry))
+            else:
+                unnumbered_candidates.append(entry)
+        
+        # 未编号公式：排除与编号公式文本相同的、以及过于简单的
+        numbered_texts = set(eq['equation_text'] for eq in numbered_equations)
+        unnumbered_equations = []
+        for entry in unnumbered_candidates:
+            eq_text = entry[0].group(1).strip()
+            if eq_text in numbered_texts or not self._is_important_equation(eq_text):
+                continue
+            unnumbered_equations.append(self._make_equation(text, page_num, entry))
+        
+        return numbered_equations + unnumbered_equations
+    
+    def _find_equation_number(self, text: str, eq_start: int, eq_end: int,
+                              context_start: int, context_end: int,
+                              tags: list, tag_starts: List[int]) -> Optional[str]:
+        """
+        为显示公式查找编号，查找顺序:
+        1. 独立编号 (1), (2), (1a), (A.1)：先看公式后面3行，再由近及远看前面3行（各限500字符内）
+        2. 显式引用: Equation 1, Eq. 2, 式(3) 等（前后各150字符的上下文内）
+        """
+        def first_tag_in(lo: int, hi: int) -> Optional[str]:
+            i = bisect.bisect_left(tag_starts, lo)
+            if i < len(tags) and tags[i].end() <= hi:
+                return tags[i].group(1)
+            return None
+        
+        # 优先在公式后面查找（通常编号在右侧）
+        window_end = min(len(text), eq_end + 500)
+        region_end = eq_end
+        for _ in range(3):
+            newline = text.find('\n', region_end, window_end)
+            if newline == -1:
+                region_end = window_end
+                break
+            region_end = newline + 1
+        number = first_tag_in(eq_end, region_end)
+        if number:
+            return number
+        
+        # 如果后面没找到，看前面
+        window_start = max(0, eq_start - 500)
+        line_end = eq_start
+        for _ in range(3):
+            newline = text.rfind('\n', window_start, line_end)
+            line_start = window_start if newline == -1 else newline + 1
+            number = first_tag_in(line_start, line_end)
+            if number:
+                return number
+            if newline == -1:
+                break
+            line_end = newline
         
-        return unnumbered_equations
+        ref_match = EQUATION_REF_RE.search(text, context_start, context_end)
+        # 中文引用必含"式"字，先用str.find排除，省去逐位置尝试的正则搜索
+        if not ref_match and text.find('式', context_start, context_end) != -1:
+            ref_match = EQUATION_CN_REF_RE.search(text, context_start, context_end)
+        return ref_match.group(1) if ref_match else None
+    
+    def _make_equation(self, text: str, page_num: int, entry: tuple) -> dict:
+        eq_match, context_start, context_end, equation_number = entry
+        context = text[context_start:context_end]
+        return {
+            "page": page_num,
+            "equation_type": "numbered" if equation_number else "unnumbered",
+            "equation_number": equation_number,
+            "equation_text": eq_match.group(1).strip(),
+            "context": context,
+            "description": self._generate_description(context, equation_number, is_numbered=bool(equation_number)),
+            "position": eq_match.start() / max(len(text), 1)
+        }
     
     def _is_important_equation(self, eq_text: str) -> bool:
         """
@@ -581,21 +1586,8 @@ class EquationScanner:
             return False
         
         # 关键符号检查
-        important_symbols = [
-            r'\\sum', r'\\prod', r'\\int',  # 求和、乘积、积分
-            r'\\frac', r'\\partial',        # 分数、偏导
-            r'\\nabla', r'\\Delta',         # 梯度、差分
-            r'\\max', r'\\min', r'\\arg',   # 优化
-            r'\\mathbb', r'\\mathcal',      # 特殊字体（通常表示集合、空间）
-            r'\\alpha', r'\\beta', r'\\theta',  # 希腊字母（参数）
-            r'\\sim', r'\\approx',          # 分布、近似
-            r'\\rightarrow', r'\\leftarrow', # 映射
-            r'\\leq', r'\\geq',             # 不等式
-        ]
-        
-        for symbol in important_symbols:
-            if symbol in eq_text:
-                return True
+        if IMPORTANT_EQUATION_SYMBOL_RE.search(eq_text):
+            return True
         
         # 检查是否包含下标/上标（通常是重要公式的特征）
         if '_' in eq_text or '^' in eq_text:
@@ -684,7 +1676,387 @@ def sanitize_obsidian_filename(name: str) -> str:
         clean_name = clean_name.replace(char, "_")
     return clean_name.strip()
 
-def group_visual_elements(figures_list: List[dict], equations_list: List[dict]) -> dict:
+def _expand_number_refs(title: str, keyword_pattern: str) -> set:
+    """
+    提取标题中某类元素引用的编号（只取基础数字，忽略子图字母）
+    例如 "3.1.1 Fig 1a-c: ..." -> {"1"}；"Equation 1-3: ..." -> {"1", "2", "3"}
+    """
+    numbers = set()
+    pattern = keyword_pattern + r'\s*(\d+)[a-z]?(?:\s*[-–~,]\s*(\d+)[a-z]?)?'
+    for match in re.finditer(pattern, title, re.IGNORECASE):
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else start
+        if end < start or end - start > 10:
+            end = start
+        numbers.update(str(n) for n in range(start, end + 1))
+    return numbers
+
+def resolve_section_region(section: SectionIntent, figures_list: List[dict], equations_list: List[dict],
+                           page_rect: fitz.Rect, padding: float = 12.0) -> Optional[tuple]:
+    """
+    为figure/equation类型的section确定目标页上需要裁剪的区域
+    - figure: 标题中引用的图号 -> 对应图片区域 + 标题区域
+    - equation: 标题中引用的公式编号 -> 对应公式的大致区域
+    找不到可靠区域、或区域接近整页时返回None（调用方使用整页图片）
+    """
+    if section.type not in ("figure", "equation") or not section.target_pages:
+        return None
+    page_num = section.target_pages[0]
+    rects = []
+    
+    if section.type == "figure":
+        fig_numbers = _expand_number_refs(section.section_title, r'(?:Fig\.?|Figure|Table|图|表)')
+        page_figures = [f for f in (figures_list or []) if f['page'] == page_num]
+        matched = []
+        for fig in page_figures:
+            caption_numbers = _expand_number_refs(fig.get('caption', ''), r'(?:Fig\.?|Figure|Table|图|表)')
+            if fig_numbers & caption_numbers:
+                matched.append(fig)
+        # 页面上只有一张带位置的图片时，直接使用
+        if not matched:
+            located = [f for f in page_figures if f.get('bbox')]
+            if len(located) == 1:
+                matched = located
+        for fig in matched:
+            for key in ('bbox', 'caption_bbox'):
+                if fig.get(key):
+                    rects.append(fitz.Rect(fig[key]))
+    else:
+        eq_numbers = _expand_number_refs(section.section_title, r'(?:Equation|Eq\.?|式|公式)')
+        for eq in (equations_list or []):
+            if eq['page'] != page_num or not eq.get('bbox'):
+                continue
+            if eq.get('equation_number') and re.match(r'\d+', eq['equation_number']):
+                if re.match(r'\d+', eq['equation_number']).group(0) in eq_numbers:
+                    rects.append(fitz.Rect(eq['bbox']))
+            elif not eq_numbers and eq.get('description') and eq['description'] in section.section_title:
+                rects.append(fitz.Rect(eq['bbox']))
+    
+    if not rects:
+        return None
+    
+    region = rects[0]
+    for rect in rects[1:]:
+        region |= rect
+    region = fitz.Rect(region.x0 - padding, region.y0 - padding, region.x1 + padding, region.y1 + padding) & page_rect
+    
+    # 区域接近整页时裁剪没有意义
+    if region.is_empty or region.get_area() > 0.8 * page_rect.get_area():
+        return None
+    return tuple(round(v, 1) for v in region)
+
+def section_image_target(section: SectionIntent, doc: fitz.Document, figures_list: List[dict],
+                         equations_list: List[dict]) -> tuple:
+    """
+    返回section上传给Analyst的图片位置 (页码, 裁剪区域或None)，调用方需持有FITZ_LOCK
+    目前只取第一个目标页；figure/equation类型只上传对应区域（图片+标题 / 公式附近），其余使用整页
+    """
+    target_page_idx = section.target_pages[0]
+    # Safety check
+    if target_page_idx >= len(doc):
+        return 0, None
+    page_rect = doc.load_page(target_page_idx).rect
+    return target_page_idx, resolve_section_region(section, figures_list, equations_list, page_rect)
+
+def _sequence_ratio(text1: str, text2: str) -> float:
+    from difflib import SequenceMatcher
+    return SequenceMatcher(None, text1, text2).ratio()
+
+class _SequenceRatio:
+    """
+    与 difflib.SequenceMatcher(None, a, b).ratio() 逐位一致的快速实现（同样的autojunk规则和匹配块查找顺序）
+    - 每个文本的字符位置表只建一次（SequenceMatcher每对公式都重建b2j）
+    - 最长匹配只遍历a中出现在b2j里的位置，跳过的位置等价于原实现中j2len被清空
+    公式上下文约300字符，autojunk会去掉几乎所有常见字母，需要遍历的位置很少
+    """
+    
+    def __init__(self):
+        self._b2j = {}   # 文本 -> {字符: b中的位置列表}（已去掉popular字符）
+        self._a2i = {}   # 文本 -> {字符: a中的位置列表}
+    
+    def _b_index(self, b: str) -> dict:
+        b2j = self._b2j.get(b)
+        if b2j is None:
+            b2j = {}
+            for j, ch in enumerate(b):
+                b2j.setdefault(ch, []).append(j)
+            # 与SequenceMatcher的autojunk一致：长度>=200时，出现次数超过1%+1的字符不参与匹配起点
+            if len(b) >= 200:
+                ntest = len(b) // 100 + 1
+                for ch in [ch for ch, positions in b2j.items() if len(positions) > ntest]:
+                    del b2j[ch]
+            self._b2j[b] = b2j
+        return b2j
+    
+    def _a_index(self, a: str) -> dict:
+        a2i = self._a2i.get(a)
+        if a2i is None:
+            a2i = {}
+            for i, ch in enumerate(a):
+                a2i.setdefault(ch, []).append(i)
+            self._a2i[a] = a2i
+        return a2i
+    
+    def __call__(self, a: str, b: str) -> float:
+        if not len(a) + len(b):
+            return 1.0
+        b2j = self._b_index(b)
+        starts = sorted(i for ch, positions in self._a_index(a).items() if ch in b2j for i in positions)
+        matches = 0
+        queue = [(0, len(a), 0, len(b))]
+        while queue:
+            alo, ahi, blo, bhi = queue.pop()
+            # find_longest_match：最长的、全部由b2j字符组成的匹配（并列时取最先出现的）
+            besti, bestj, bestsize = alo, blo, 0
+            j2len = {}
+            prev_i = -2
+            for pos in range(bisect.bisect_left(starts, alo), bisect.bisect_left(starts, ahi)):
+                i = starts[pos]
+                if i != prev_i + 1:
+                    j2len = {}
+                prev_i = i
+                j2lenget = j2len.get
+                newj2len = {}
+                for j in b2j[a[i]]:
+                    if j < blo:
+                        continue
+                    if j >= bhi:
+                        break
+                    k = newj2len[j] = j2lenget(j - 1, 0) + 1
+                    if k > bestsize:
+                        besti, bestj, bestsize = i - k + 1, j - k + 1, k
+                j2len = newj2len
+            # 两端用任意相等字符扩展（没有isjunk，原实现中针对junk的扩展不会发生）
+            while besti > alo and bestj > blo and a[besti - 1] == b[bestj - 1]:
+                besti, bestj, bestsize = besti - 1, bestj - 1, bestsize + 1
+            while besti + bestsize < ahi and bestj + bestsize < bhi and a[besti + bestsize] == b[bestj + bestsize]:
+                bestsize += 1
+            if bestsize:
+                matches += bestsize
+                if alo < besti and blo < bestj:
+                    queue.append((alo, besti, blo, bestj))
+                if besti + bestsize < ahi and bestj + bestsize < bhi:
+                    queue.append((besti + bestsize, ahi, bestj + bestsize, bhi))
+        return 2.0 * matches / (len(a) + len(b))
+
+def _legacy_equation_similarity(eq1: dict, eq2: dict, ratio=_sequence_ratio) -> float:
+    """
+    计算两个公式的关联度 (0-1)
+    
+    评分标准：
+    - 页码接近 (+0.2)
+    - 上下文关键词相似 (+0.4)
+    - 描述相似 (+0.2)
+    - 连续编号 (+0.2)
+    ratio: 文本相似度函数，默认SequenceMatcher.ratio（_SequenceRatio结果逐位相同）
+    """
+    score = 0.0
+    
+    # 1. 页码接近 (同一页或相邻页)
+    page_diff = abs(eq1['page'] - eq2['page'])
+    if page_diff == 0:
+        score += 0.2
+    elif page_diff == 1:
+        score += 0.1
+    
+    # 2. 上下文关键词相似
+    context1 = eq1.get('context', '').lower()
+    context2 = eq2.get('context', '').lower()
+    if context1 and context2:
+        context_similarity = ratio(context1, context2)
+        score += context_similarity * 0.4
+    
+    # 3. 描述相似
+    desc1 = eq1.get('description', '').lower()
+    desc2 = eq2.get('description', '').lower()
+    if desc1 and desc2:
+        desc_similarity = ratio(desc1, desc2)
+        score += desc_similarity * 0.2
+    
+    # 4. 连续编号 (仅对编号公式)
+    if eq1['equation_type'] == 'numbered' and eq2['equation_type'] == 'numbered':
+        try:
+            num1 = int(re.search(r'\d+', eq1['equation_number']).group(0))
+            num2 = int(re.search(r'\d+', eq2['equation_number']).group(0))
+            if abs(num1 - num2) == 1:
+                score += 0.2
+        except:
+            pass
+    
+    return min(score, 1.0)
+
+class EquationSimilarity:
+    """
+    公式两两关联度（分组时查表），pair(i, j) 对应旧版的 calculate_equation_similarity(equations[i], equations[j])
+    exact: 与sequence分组结果完全一致。NumPy按字符计数矩阵一次算出所有公式对的关联度上界
+           （SequenceMatcher.quick_ratio：多重集交集不小于匹配块总长），贪心分组时组内平均上界不超过阈值的候选
+           直接跳过，其余才用_SequenceRatio计算精确分数并缓存
+    sequence: 按需调用旧版SequenceMatcher评分并缓存（ratio不对称，按旧版的参数顺序计算），作为对照
+    tfidf: 上下文/描述转为字符3-gram的TF-IDF向量（特征哈希到固定维度），用矩阵乘法一次得到所有余弦相似度，
+           页码与连续编号项同样以矩阵运算得到；各项权重与旧版一致，但余弦分数普遍高于SequenceMatcher，
+           同一阈值下分组更大（不等价于旧版语义）
+    """
+    
+    # 上界与精确分数的浮点误差余量（上界必须不小于精确分数，预筛才不会改变分组）
+    UPPER_BOUND_SLACK = 1e-9
+    
+    def __init__(self, equations: List[dict], method: str = EQUATION_SIMILARITY_METHOD):
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+        if method == "tfidf" and np is None:
+            method = "exact"
+        self.method = method
+        self.size = len(equations)
+        self._np = np
+        self._equations = equations
+        self._pair_cache = {}
+        self._ratio = _SequenceRatio() if method == "exact" else _sequence_ratio
+        self.matrix = self._tfidf_matrix(equations, np) if method == "tfidf" else None
+        self.upper = self._upper_bound_matrix(equations, np) if method == "exact" and np is not None else None
+    
+    @staticmethod
+    def _numbering_matrices(equations: List[dict], np) -> tuple:
+        """页码项与连续编号项（两种矩阵方式共用，数值与旧版逐项相同）"""
+        pages = np.array([eq['page'] for eq in equations], dtype=np.int64)
+        page_diff = np.abs(pages[:, None] - pages[None, :])
+        page_score = np.where(page_diff == 0, 0.2, np.where(page_diff == 1, 0.1, 0.0))
+        numbers = np.full(len(equations), np.nan)
+        for idx, eq in enumerate(equations):
+            if eq['equation_type'] == 'numbered':
+                match = re.search(r'\d+', eq.get('equation_number') or '')
+                if match:
+                    numbers[idx] = int(match.group(0))
+        with np.errstate(invalid="ignore"):
+            consecutive = np.abs(numbers[:, None] - numbers[None, :]) == 1
+        return page_score, np.where(consecutive, 0.2, 0.0)
+    
+    @staticmethod
+    def _quick_ratio_matrix(texts: List[str], np, chunk: int = 64):
+        """所有文本对的SequenceMatcher.quick_ratio（2×字符多重集交集/总长度，是ratio的上界）；任一文本为空时为0"""
+        alphabet = {ch: k for k, ch in enumerate(sorted(set("".join(texts))))}
+        counts = np.zeros((len(texts), max(1, len(alphabet))), dtype=np.int32)
+        for row, text in enumerate(texts):
+            for ch, count in Counter(text).items():
+                counts[row, alphabet[ch]] = count
+        lengths = counts.sum(axis=1).astype(np.float64)
+        common = np.empty((len(texts), len(texts)), dtype=np.float64)
+        # 分块计算 min(count_i, count_j) 之和，限制中间数组大小
+        for begin in range(0, len(texts), chunk):
+            block = counts[begin:begin + chunk]
+            common[begin:begin + chunk] = np.minimum(block[:, None, :], counts[None, :, :]).sum(axis=2)
+        total = lengths[:, None] + lengths[None, :]
+        ratio = np.divide(2.0 * common, total, out=np.zeros_like(common), where=total > 0)
+        nonempty = lengths > 0
+        return np.where(nonempty[:, None] & nonempty[None, :], ratio, 0.0)
+    
+    def _upper_bound_matrix(self, equations: List[dict], np):
+        page_score, consecutive = self._numbering_matrices(equations, np)
+        contexts = self._quick_ratio_matrix([eq.get('context', '').lower() for eq in equations], np)
+        descriptions = self._quick_ratio_matrix([eq.get('description', '').lower() for eq in equations], np)
+        return page_score + contexts * 0.4 + descriptions * 0.2 + consecutive + self.UPPER_BOUND_SLACK
+    
+    @staticmethod
+    def _text_vectors(texts: List[str], np):
+        """字符n-gram TF-IDF向量（L2归一化；空文本为零向量）"""
+        import zlib
+        rows, cols = [], []
+        for row, text in enumerate(texts):
+            n = EQUATION_SHINGLE_SIZE
+            shingles = [text[k:k + n] for k in range(max(1, len(text) - n + 1))] if text else []
+            for shingle in shingles:
+                rows.append(row)
+                # crc32保证跨进程稳定（内置hash受PYTHONHASHSEED影响）
+                cols.append(zlib.crc32(shingle.encode("utf-8")) % EQUATION_HASH_DIM)
+        counts = np.zeros((len(texts), EQUATION_HASH_DIM), dtype=np.float64)
+        if rows:
+            np.add.at(counts, (np.array(rows), np.array(cols)), 1.0)
+        doc_freq = (counts > 0).sum(axis=0)
+        idf = np.log((1 + len(texts)) / (1 + doc_freq)) + 1.0
+        vectors = counts * idf
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+    
+    def _tfidf_matrix(self, equations: List[dict], np):
+        page_score, consecutive = self._numbering_matrices(equations, np)
+        contexts = self._text_vectors([eq.get('context', '').lower() for eq in equations], np)
+        descriptions = self._text_vectors([eq.get('description', '').lower() for eq in equations], np)
+        score = page_score + (contexts @ contexts.T) * 0.4 + (descriptions @ descriptions.T) * 0.2 + consecutive
+        return np.minimum(score, 1.0)
+    
+    def pair(self, i: int, j: int) -> float:
+        if self.matrix is not None:
+            return float(self.matrix[i, j])
+        key = (i, j)
+        if key not in self._pair_cache:
+            self._pair_cache[key] = _legacy_equation_similarity(self._equations[i], self._equations[j], self._ratio)
+        return self._pair_cache[key]
+    
+    def greedy_groups(self, threshold: float = 0.4, max_size: int = 4) -> List[List[int]]:
+        """
+        贪心分组（与旧版语义一致）：按顺序取第一个剩余公式开新组，反复加入与组内平均相似度最高
+        且严格大于阈值的公式（并列时取靠前者），直到组满max_size或没有满足阈值的公式
+        """
+        if self.matrix is not None:
+            return self._greedy_groups_matrix(threshold, max_size)
+        upper = self.upper
+        remaining = list(range(self.size))
+        groups = []
+        while remaining:
+            first = remaining.pop(0)
+            group = [first]
+            # sums[k] = (公式k与组内前n个成员的相似度之和, n)，按成员顺序累加（与旧版的加法顺序相同），按需补齐
+            sums = {}
+            upper_sums = upper[:, first].copy() if upper is not None else None
+            while len(group) < max_size and remaining:
+                best_pos = -1
+                best_score = threshold
+                for pos, idx in enumerate(remaining):
+                    # 平均上界不超过阈值：精确平均值也不会超过，无需计算
+                    if upper_sums is not None and not upper_sums[idx] / len(group) > threshold:
+                        continue
+                    total, counted = sums.get(idx, (0.0, 0))
+                    for member in group[counted:]:
+                        total += self.pair(idx, member)
+                        counted += 1
+                    sums[idx] = (total, counted)
+                    avg_similarity = total / len(group)
+                    if avg_similarity > best_score:
+                        best_score = avg_similarity
+                        best_pos = pos
+                if best_pos < 0:
+                    break
+                chosen = remaining.pop(best_pos)
+                group.append(chosen)
+                if upper_sums is not None:
+                    upper_sums += upper[:, chosen]
+            groups.append(group)
+        return groups
+    
+    def _greedy_groups_matrix(self, threshold: float, max_size: int) -> List[List[int]]:
+        """tfidf：组内相似度之和随加入成员增量更新，每轮只需一次向量运算"""
+        np = self._np
+        remaining = list(range(self.size))
+        groups = []
+        while remaining:
+            first = remaining.pop(0)
+            group = [first]
+            sums = self.matrix[:, first].copy()
+            while len(group) < max_size and remaining:
+                averages = sums[remaining] / len(group)
+                # argmax返回第一个最大值，对应旧版"严格大于才更新"的并列规则
+                best_pos = int(np.argmax(averages))
+                if not averages[best_pos] > threshold:
+                    break
+                chosen = remaining.pop(best_pos)
+                group.append(chosen)
+                sums += self.matrix[:, chosen]
+            groups.append(group)
+        return groups
+
+def group_visual_elements(figures_list: List[dict], equations_list: List[dict],
+                          similarity_method: str = EQUATION_SIMILARITY_METHOD) -> dict:
     """
     智能分组视觉元素（图表和公式）
     
@@ -712,7 +2084,6 @@ def group_visual_elements(figures_list: List[dict], equations_list: List[dict])
         }
     """
     import re
-    from difflib import SequenceMatcher
     
     def extract_figure_base_and_sub(caption: str) -> tuple:
         """
@@ -786,82 +2157,13 @@ def group_visual_elements(figures_list: List[dict], equations_list: List[dict])
                         "pages": [fig['page']]
                     })
     
-    # 2. 公式分组
-    def calculate_equation_similarity(eq1: dict, eq2: dict) -> float:
-        """
-        计算两个公式的关联度 (0-1)
-        
-        评分标准：
-        - 页码接近 (+0.2)
-        - 上下文关键词相似 (+0.4)
-        - 描述相似 (+0.2)
-        - 连续编号 (+0.2)
-        """
-        score = 0.0
-        
-        # 1. 页码接近 (同一页或相邻页)
-        page_diff = abs(eq1['page'] - eq2['page'])
-        if page_diff == 0:
-            score += 0.2
-        elif page_diff == 1:
-            score += 0.1
-        
-        # 2. 上下文关键词相似
-        context1 = eq1.get('context', '').lower()
-        context2 = eq2.get('context', '').lower()
-        if context1 and context2:
-            context_similarity = SequenceMatcher(None, context1, context2).ratio()
-            score += context_similarity * 0.4
-        
-        # 3. 描述相似
-        desc1 = eq1.get('description', '').lower()
-        desc2 = eq2.get('description', '').lower()
-        if desc1 and desc2:
-            desc_similarity = SequenceMatcher(None, desc1, desc2).ratio()
-            score += desc_similarity * 0.2
-        
-        # 4. 连续编号 (仅对编号公式)
-        if eq1['equation_type'] == 'numbered' and eq2['equation_type'] == 'numbered':
-            try:
-                num1 = int(re.search(r'\d+', eq1['equation_number']).group(0))
-                num2 = int(re.search(r'\d+', eq2['equation_number']).group(0))
-                if abs(num1 - num2) == 1:
-                    score += 0.2
-            except:
-                pass
-        
-        return min(score, 1.0)
-    
+    # 2. 公式分组（关联度矩阵一次计算，贪心分组时查表）
     equation_groups = []
     if equations_list:
-        # 使用贪心算法分组
-        remaining = list(equations_list)
+        similarity_index = EquationSimilarity(equations_list, method=similarity_method)
         
-        while remaining:
-            # 开始新组
-            current_group = [remaining.pop(0)]
-            
-            # 尝试添加相似的公式到当前组 (最多4个)
-            while len(current_group) < 4 and remaining:
-                # 计算当前组与剩余公式的平均相似度
-                best_idx = -1
-                best_score = 0.4  # 最低阈值
-                
-                for i, eq in enumerate(remaining):
-                    # 计算与当前组所有公式的平均相似度
-                    similarities = [calculate_equation_similarity(eq, group_eq) 
-                                   for group_eq in current_group]
-                    avg_similarity = sum(similarities) / len(similarities)
-                    
-                    if avg_similarity > best_score:
-                        best_score = avg_similarity
-                        best_idx = i
-                
-                # 如果找到足够相似的公式，添加到组中
-                if best_idx >= 0:
-                    current_group.append(remaining.pop(best_idx))
-                else:
-                    break
+        for member_indices in similarity_index.greedy_groups(threshold=0.4, max_size=4):
+            current_group = [equations_list[i] for i in member_indices]
             
             # 生成组描述
             if len(current_group) == 1:
@@ -902,11 +2204,9 @@ def group_visual_elements(figures_list: List[dict], equations_list: List[dict])
                 # 计算组内平均相似度
                 if len(current_group) > 1:
                     similarities = []
-                    for i in range(len(current_group)):
-                        for j in range(i+1, len(current_group)):
-                            similarities.append(calculate_equation_similarity(
-                                current_group[i], current_group[j]
-                            ))
+                    for i in range(len(member_indices)):
+                        for j in range(i+1, len(member_indices)):
+                            similarities.append(similarity_index.pair(member_indices[i], member_indices[j]))
                     similarity = sum(similarities) / len(similarities) if similarities else 0.5
                 else:
                     similarity = 1.0
@@ -925,12 +2225,17 @@ def group_visual_elements(figures_list: List[dict], equations_list: List[dict])
     }
 
 
-def deduplicate_sections(sections: List[SectionIntent], figures_list: List[dict] = None) -> List[SectionIntent]:
+def deduplicate_sections(sections: List[SectionIntent], figures_list: List[dict] = None,
+                         use_index: bool = True, verbose: bool = True) -> List[SectionIntent]:
     """
     去除重复的section分析。判断重复的标准：
     1. 相同的图表编号（如Fig. 1, Table 2）
     2. 相似的章节关键词（如Introduction, Methods）
     保留第一次出现的section。
+
+    use_index=True 时按图表编号/章节关键词建哈希索引，并在标题相似度计算前用
+    长度与字符频次上界预筛，结果与逐个比较（use_index=False）完全一致。
+    verbose=False 时不打印合并/覆盖信息（提前分析对部分批次反复去重时使用）
     """
     if not sections:
         return sections
@@ -1051,38 +2356,98 @@ def deduplicate_sections(sections: List[SectionIntent], figures_list: List[dict]
         base.sub_questions = merged_questions
         return base
     
+    # 候选索引：每个key按插入顺序编号，section_map的遍历顺序即编号顺序，
+    # 因此"第一个相似的key"就是满足条件的最小编号
+    fuzzy_threshold = 0.7
+    figure_index = {}   # 图表编号 -> 最早的key编号
+    keyword_index = {}  # 章节关键词 -> 最早的key编号
+    key_entries = []    # [(key, 小写长度, 字符频次, 以key为seq2的SequenceMatcher)]
+    
+    def index_key(key: str):
+        order = len(key_entries)
+        fig = extract_figure_number(key)
+        if fig:
+            figure_index.setdefault(fig, order)
+        keyword = get_section_key(key)
+        if keyword:
+            keyword_index.setdefault(keyword, order)
+        key_lower = key.lower()
+        key_entries.append((key, len(key_lower), Counter(key_lower), SequenceMatcher(None, "", key_lower)))
+    
+    def find_similar_key(title: str) -> Optional[str]:
+        """返回与are_similar逐个比较时第一个命中的key"""
+        best = len(key_entries)
+        fig = extract_figure_number(title)
+        if fig and fig in figure_index:
+            best = figure_index[fig]
+        keyword = get_section_key(title)
+        if keyword and keyword in keyword_index:
+            best = min(best, keyword_index[keyword])
+        
+        # 只有编号更小的key才可能先于编号/关键词命中而被选中
+        title_lower = title.lower()
+        title_len = len(title_lower)
+        title_counts = None
+        for order in range(best):
+            key, key_len, key_counts, matcher = key_entries[order]
+            total = title_len + key_len
+            if not total:
+                return key  # 两个空标题的ratio为1.0
+            # 上界1（real_quick_ratio）：匹配字符数不超过较短标题长度
+            if 2.0 * min(title_len, key_len) / total <= fuzzy_threshold:
+                continue
+            # 上界2（quick_ratio）：匹配字符数不超过两者字符频次的交集
+            if title_counts is None:
+                title_counts = Counter(title_lower).items()
+            overlap = 0
+            for ch, n in title_counts:
+                m = key_counts.get(ch)
+                if m:
+                    overlap += n if n < m else m
+            if 2.0 * overlap / total <= fuzzy_threshold:
+                continue
+            matcher.set_seq1(title_lower)
+            if matcher.ratio() > fuzzy_threshold:
+                return key
+        return key_entries[best][0] if best < len(key_entries) else None
+    
     # 去重逻辑（优先保留图表类型，并智能合并sub_questions）
     unique_sections = []
     section_map = {}  # title -> (index, section)
     
     for section in sections:
-        found_similar = False
         similar_key = None
         
         # 查找是否有相似的section
-        for key, (idx, existing) in section_map.items():
-            if are_similar(section.section_title, key):
-                found_similar = True
-                similar_key = key
-                # 合并sub_questions而不是简单替换
-                merged_section = merge_sub_questions(existing, section)
-                unique_sections[idx] = merged_section
-                section_map[similar_key] = (idx, merged_section)
-                print(f"  🔄 合并: '{existing.section_title}' (保留优先问题，去重其他问题)")
-                break
+        if use_index:
+            similar_key = find_similar_key(section.section_title)
+        else:
+            for key in section_map:
+                if are_similar(section.section_title, key, fuzzy_threshold):
+                    similar_key = key
+                    break
         
-        if not found_similar:
+        if similar_key is not None:
+            idx, existing = section_map[similar_key]
+            # 合并sub_questions而不是简单替换
+            merged_section = merge_sub_questions(existing, section)
+            unique_sections[idx] = merged_section
+            section_map[similar_key] = (idx, merged_section)
+            if verbose:
+                print(f"  🔄 合并: '{existing.section_title}' (保留优先问题，去重其他问题)")
+        else:
             idx = len(unique_sections)
             unique_sections.append(section)
             section_map[section.section_title] = (idx, section)
+            index_key(section.section_title)
     
     # 打印去重结果
     removed_count = len(sections) - len(unique_sections)
-    if removed_count > 0:
+    if removed_count > 0 and verbose:
         print(f"🔧 去重完成: 移除了{removed_count}个重复section，保留{len(unique_sections)}个唯一section")
     
     # 验证图表覆盖完整性
-    if figures_list:
+    if figures_list and verbose:
         figure_sections = [s for s in unique_sections if s.type in ['figure', 'equation']]
         print(f"📊 图表覆盖验证: 检测到{len(figures_list)}个图表，生成了{len(figure_sections)}个图表分析section")
         
@@ -1289,37 +2654,546 @@ def validate_equation_coverage(outline: Outline, equations_list: List[dict] = No
     return outline
 
 
-def call_api_with_retry(client, model, messages, response_format=None, max_retries=15):
+class RunMetrics:
+    """
+    单次运行的指标收集器（线程安全）
+    记录各阶段耗时、Marker逐页OCR耗时、每次API调用的延迟/重试/token数和上传的图片字节数，
+    运行结束时写出run_report.json并打印汇总表
+    """
+    
+    REPORT_FILENAME = "run_report.json"
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.stages = OrderedDict()   # stage -> 累计秒数
+        self.ocr = {"pages": [], "cached_pages": 0, "session_setup_seconds": 0.0}
+        self.api_calls = []
+    
+    def add_stage(self, name: str, seconds: float):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+    
+    def record_ocr(self, page_timings: list, cached_pages: int = 0, session_setup_seconds: float = 0.0):
+        """记录Marker OCR结果（page_timings为 [(page_num, seconds), ...]）"""
+        with self._lock:
+            self.ocr["pages"].extend({"page": page + 1, "seconds": round(seconds, 3)} for page, seconds in page_timings)
+            self.ocr["cached_pages"] += cached_pages
+            self.ocr["session_setup_seconds"] += session_setup_seconds
+    
+    def record_api_call(self, model: str, outcome: str, latency: float = 0.0, wall_seconds: float = 0.0,
+                        retries: int = 0, usage=None, image_bytes: int = 0, streamed: bool = False):
+        """
+        Args:
+            outcome: ok | cached | failed
+            latency: 成功那次请求的耗时；wall_seconds: 含限速等待与重试退避的总耗时
+            usage: openai的CompletionUsage（可为None）
+        """
+        with self._lock:
+            self.api_calls.append({
+                "model": model,
+                "outcome": outcome,
+                "latency": round(latency, 3),
+                "wall_seconds": round(wall_seconds, 3),
+                "retries": retries,
+                "prompt_tokens": getattr(usage, "prompt_tokens", None),
+                "completion_tokens": getattr(usage, "completion_tokens", None),
+                "image_bytes": image_bytes,
+                "streamed": streamed,
+            })
+    
+    def to_dict(self) -> dict:
+        with self._lock:
+            calls = list(self.api_calls)
+            ocr_pages = list(self.ocr["pages"])
+            report = {
+                "started_at": self.started_at,
+                "total_seconds": round(time.time() - self.started_at, 3),
+                "stages": {name: round(seconds, 3) for name, seconds in self.stages.items()},
+                "ocr": {**self.ocr, "pages": ocr_pages},
+            }
+        
+        by_model = OrderedDict()
+        for call in calls:
+            stats = by_model.setdefault(call["model"], {
+                "calls": 0, "cached": 0, "failed": 0, "retries": 0, "latency_seconds": 0.0,
+                "prompt_tokens": 0, "completion_tokens": 0, "image_bytes": 0,
+            })
+            stats["calls"] += 1
+            stats["cached"] += call["outcome"] == "cached"
+            stats["failed"] += call["outcome"] == "failed"
+            stats["retries"] += call["retries"]
+            stats["latency_seconds"] = round(stats["latency_seconds"] + call["latency"], 3)
+            stats["prompt_tokens"] += call["prompt_tokens"] or 0
+            stats["completion_tokens"] += call["completion_tokens"] or 0
+            stats["image_bytes"] += call["image_bytes"]
+        report["api"] = {"by_model": by_model, "calls": calls}
+        return report
+    
+    def write_report(self, folder: Path) -> Path:
+        path = folder / self.REPORT_FILENAME
+        path.write_text(json.dumps(self.to_dict(), ensure_ascii=False, indent=2), encoding="utf-8")
+        return path
+    
+    def summary_table(self) -> str:
+        report = self.to_dict()
+        lines = [f"{'阶段':<24}{'耗时(秒)':>12}"]
+        for name, seconds in report["stages"].items():
+            lines.append(f"{name:<24}{seconds:>12.1f}")
+        lines.append(f"{'总计':<24}{report['total_seconds']:>12.1f}")
+        
+        ocr = report["ocr"]
+        if ocr["pages"] or ocr["cached_pages"]:
+            seconds = [p["seconds"] for p in ocr["pages"]]
+            avg = sum(seconds) / len(seconds) if seconds else 0.0
+            slowest = max(ocr["pages"], key=lambda p: p["seconds"]) if seconds else None
+            slowest_str = f"，最慢第{slowest['page']}页 {slowest['seconds']:.1f}秒" if slowest else ""
+            lines.append(f"\nOCR: 转换{len(seconds)}页（平均{avg:.1f}秒/页{slowest_str}），缓存命中{ocr['cached_pages']}页")
+        
+        if report["api"]["by_model"]:
+            lines.append(f"\n{'模型':<40}{'调用':>6}{'缓存':>6}{'失败':>6}{'重试':>6}{'延迟(秒)':>10}"
+                         f"{'输入tok':>10}{'输出tok':>10}{'图片MB':>8}")
+            for model, stats in report["api"]["by_model"].items():
+                lines.append(f"{model:<40}{stats['calls']:>6}{stats['cached']:>6}{stats['failed']:>6}"
+                             f"{stats['retries']:>6}{stats['latency_seconds']:>10.1f}{stats['prompt_tokens']:>10}"
+                             f"{stats['completion_tokens']:>10}{stats['image_bytes'] / 1e6:>8.1f}")
+        return "\n".join(lines)
+
+# 全局运行指标（main中创建；None表示不收集）
+RUN_METRICS: Optional[RunMetrics] = None
+
+def _image_payload_bytes(messages: list) -> int:
+    """请求中图片data URL的总字节数"""
+    total = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            for part in content:
+                if part.get("type") == "image_url":
+                    total += len(part.get("image_url", {}).get("url", ""))
+    return total
+
+class RateLimiter:
+    """
+    线程安全的令牌桶限速器（请求数/分钟 + token数/分钟）
+    所有并发调用共享同一个实例；收到Retry-After或配额耗尽的响应头时，暂停所有调用方
+    """
+    
+    def __init__(self, requests_per_min: Optional[float] = API_REQUESTS_PER_MIN,
+                 tokens_per_min: Optional[float] = API_TOKENS_PER_MIN):
+        self._cond = threading.Condition()
+        self.configure(requests_per_min, tokens_per_min)
+    
+    def configure(self, requests_per_min: Optional[float], tokens_per_min: Optional[float]):
+        """设置速率（None或<=0表示不限制），桶容量为一分钟的配额"""
+        with self._cond:
+            self.requests_per_min = requests_per_min if requests_per_min and requests_per_min > 0 else None
+            self.tokens_per_min = tokens_per_min if tokens_per_min and tokens_per_min > 0 else None
+            self._request_tokens = float(self.requests_per_min or 0)
+            self._token_tokens = float(self.tokens_per_min or 0)
+            self._last_refill = time.monotonic()
+            self._paused_until = 0.0
+            self._cond.notify_all()
+    
+    def _refill(self, now: float):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        if self.requests_per_min:
+            self._request_tokens = min(self.requests_per_min,
+                                       self._request_tokens + elapsed * self.requests_per_min / 60)
+        if self.tokens_per_min:
+            self._token_tokens = min(self.tokens_per_min,
+                                     self._token_tokens + elapsed * self.tokens_per_min / 60)
+    
+    def acquire(self, tokens: int = 0):
+        """阻塞直到请求桶和token桶都有余量，然后扣除"""
+        with self._cond:
+            if self.tokens_per_min:
+                # 单次请求超过整桶容量时按整桶扣除，避免永久等待
+                tokens = min(tokens, self.tokens_per_min)
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._paused_until - now
+                if wait <= 0:
+                    if self.requests_per_min and self._request_tokens < 1:
+                        wait = (1 - self._request_tokens) * 60 / self.requests_per_min
+                    elif self.tokens_per_min and self._token_tokens < tokens:
+                        wait = (tokens - self._token_tokens) * 60 / self.tokens_per_min
+                if wait <= 0:
+                    if self.requests_per_min:
+                        self._request_tokens -= 1
+                    if self.tokens_per_min:
+                        self._token_tokens -= tokens
+                    return
+                self._cond.wait(timeout=wait)
+    
+    def adjust_tokens(self, delta: int):
+        """按实际用量修正token桶（delta为实际用量减去预扣量，可为负）"""
+        if not self.tokens_per_min or not delta:
+            return
+        with self._cond:
+            self._token_tokens = min(self.tokens_per_min, self._token_tokens - delta)
+            self._cond.notify_all()
+    
+    def pause(self, seconds: float):
+        """暂停所有调用方至少seconds秒（如服务商返回Retry-After）"""
+        if seconds <= 0:
+            return
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+    
+    def update_from_headers(self, headers) -> Optional[float]:
+        """
+        根据响应头更新限速状态，返回建议等待的秒数（无信息时返回None）
+        支持: Retry-After / retry-after-ms，以及配额耗尽时的 x-ratelimit-reset(-requests/-tokens)
+        """
+        if not headers:
+            return None
+        
+        wait = None
+        retry_after_ms = headers.get("retry-after-ms")
+        retry_after = headers.get("retry-after")
+        if retry_after_ms:
+            try:
+                wait = float(retry_after_ms) / 1000
+            except ValueError:
+                pass
+        elif retry_after:
+            wait = _parse_reset_seconds(retry_after)
+        
+        if wait is None:
+            for remaining_key, reset_key in (("x-ratelimit-remaining-requests", "x-ratelimit-reset-requests"),
+                                             ("x-ratelimit-remaining-tokens", "x-ratelimit-reset-tokens"),
+                                             ("x-ratelimit-remaining", "x-ratelimit-reset")):
+                remaining = headers.get(remaining_key)
+                reset = headers.get(reset_key)
+                if remaining is None or reset is None:
+                    continue
+                try:
+                    exhausted = float(remaining) <= 0
+                except ValueError:
+                    continue
+                if exhausted:
+                    reset_wait = _parse_reset_seconds(reset)
+                    if reset_wait is not None:
+                        wait = max(wait or 0, reset_wait)
+        
+        if wait is not None:
+            self.pause(wait)
+        return wait
+
+def _parse_reset_seconds(value: str) -> Optional[float]:
+    """
+    解析限速头中的时间
+    支持: 秒数 "12" / 时长 "6m0s"、"20ms" / Unix时间戳（秒或毫秒，如OpenRouter的X-RateLimit-Reset）/ HTTP日期
+    """
+    value = str(value).strip()
+    try:
+        number = float(value)
+        if number > 1e12:    # 毫秒时间戳
+            return max(0.0, number / 1000 - time.time())
+        if number > 1e9:     # 秒时间戳
+            return max(0.0, number - time.time())
+        return max(0.0, number)
+    except ValueError:
+        pass
+    
+    duration = re.fullmatch(r'(?:(\d+(?:\.\d+)?)h)?(?:(\d+(?:\.\d+)?)m(?!s))?(?:(\d+(?:\.\d+)?)s)?(?:(\d+(?:\.\d+)?)ms)?', value)
+    if duration and any(duration.groups()):
+        hours, minutes, seconds, millis = (float(g) if g else 0.0 for g in duration.groups())
+        return hours * 3600 + minutes * 60 + seconds + millis / 1000
+    
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+_CJK_RE = re.compile(r'[\u4e00-\u9fff]')
+
+def estimate_text_tokens(text: str) -> int:
+    """粗略估算文本的token数（中文约1字1token，其余约3字符1token）"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk) // 3
+
+def truncate_to_token_budget(text: str, token_budget: int) -> tuple:
+    """按token预算截断文本，返回 (文本, 是否截断)"""
+    if estimate_text_tokens(text) <= token_budget:
+        return text, False
+    # 按比例估计截断位置，再逐步收紧直到满足预算
+    cut = int(len(text) * token_budget / max(1, estimate_text_tokens(text)))
+    while cut > 0 and estimate_text_tokens(text[:cut]) > token_budget:
+        cut = int(cut * 0.95)
+    return text[:cut], True
+
+def estimate_message_tokens(messages: list) -> int:
+    """粗略估算请求的token数（文本见estimate_text_tokens；图片按固定值计）"""
+    total = 0
+    for message in messages:
+        content = message.get("content")
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content or ""}]
+        for part in parts:
+            if part.get("type") == "image_url":
+                total += IMAGE_TOKEN_ESTIMATE
+            else:
+                total += estimate_text_tokens(part.get("text", ""))
+    return total
+
+# 全局共享的限速器（main中按命令行参数重新配置）
+API_RATE_LIMITER = RateLimiter()
+
+class LLMCache:
+    """
+    LLM响应的磁盘缓存（SQLite，线程安全，TTL + 大小受限的LRU淘汰）
+    存储完整的ChatCompletion JSON，命中时还原为同类型对象，调用方无需区分
+    """
+    
+    def __init__(self, db_path: Path = LLM_CACHE_PATH, ttl_days: Optional[float] = LLM_CACHE_TTL_DAYS,
+                 max_mb: int = LLM_CACHE_MAX_MB):
+        import sqlite3
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl_seconds = ttl_days * 86400 if ttl_days else None
+        self.max_bytes = max_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # 多个Analyst线程共用一个连接，由锁串行化访问
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT NOT NULL, "
+            "size INTEGER NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses(last_used)")
+        self._conn.commit()
+        self._purge_expired()
+    
+    @staticmethod
+    def _normalize_messages(messages: list) -> list:
+        """把base64图片替换为其sha256，使缓存键与图片内容相关而与编码长度无关"""
+        normalized = []
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, list):
+                parts = []
+                for part in content:
+                    if part.get("type") == "image_url":
+                        url = part.get("image_url", {}).get("url", "")
+                        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+                        parts.append({"type": "image_url", "image_sha256": digest})
+                    else:
+                        parts.append(part)
+                content = parts
+            normalized.append({**message, "content": content})
+        return normalized
+    
+    @classmethod
+    def make_key(cls, model: str, messages: list, response_format=None) -> str:
+        """根据模型ID、规范化后的messages和response_format生成缓存键"""
+        payload = json.dumps(
+            {"model": model, "messages": cls._normalize_messages(messages), "response_format": response_format},
+            sort_keys=True, ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def get(self, key: str):
+        """读取缓存，未命中或已过期返回None"""
+        from openai.types.chat import ChatCompletion
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.ttl_seconds and now - row[1] > self.ttl_seconds):
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        try:
+            response = ChatCompletion.model_validate_json(row[0])
+        except ValueError:
+            # 旧版本openai写入的条目无法解析时视为未命中
+            self.misses += 1
+            return None
+        self.hits += 1
+        return response
+    
+    def put(self, key: str, model: str, response):
+        """写入缓存，然后按需淘汰"""
+        try:
+            payload = response.model_dump_json()
+        except AttributeError:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, created, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, payload, len(payload), now, now),
+            )
+            self._conn.commit()
+            self._evict()
+    
+    def _purge_expired(self):
+        if not self.ttl_seconds:
+            return
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl_seconds,))
+            self._conn.commit()
+    
+    def _evict(self):
+        """总大小超过上限时，按last_used从旧到新删除条目（调用方持有锁）"""
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall()
+        stale = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+        self._conn.commit()
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+    
+    def summary(self) -> str:
+        return f"LLM缓存: 命中{self.hits}次, 未命中{self.misses}次"
+
+# 全局LLM响应缓存（main中创建；None表示禁用）
+LLM_CACHE: Optional[LLMCache] = None
+
+class _CachedStream:
+    """把缓存的完整响应作为只有一个chunk的流回放给stream_handler（草稿写入、字数检查照常进行）"""
+    
+    def __init__(self, response):
+        self._response = response
+    
+    def __iter__(self):
+        from openai.types.chat import ChatCompletionChunk
+        from openai.types.chat.chat_completion_chunk import Choice, ChoiceDelta
+        response = self._response
+        yield ChatCompletionChunk(
+            id=response.id, created=response.created, model=response.model, object="chat.completion.chunk",
+            choices=[Choice(index=0, delta=ChoiceDelta(role="assistant", content=response.choices[0].message.content),
+                            finish_reason="stop")],
+            usage=response.usage,
+        )
+    
+    def close(self):
+        pass
+
+def _completion_from_stream(model: str, result: dict):
+    """把完整（未中止）的流式结果组装为ChatCompletion写入缓存，与非流式响应共用缓存键"""
+    from openai.types.chat import ChatCompletion, ChatCompletionMessage
+    from openai.types.chat.chat_completion import Choice
+    return ChatCompletion(
+        id=f"stream-{time.time_ns()}", created=int(time.time()), model=model, object="chat.completion",
+        choices=[Choice(index=0, finish_reason="stop",
+                        message=ChatCompletionMessage(role="assistant", content=result["content"]))],
+        usage=result.get("usage"),
+    )
+
+def call_api_with_retry(client, model, messages, response_format=None, max_retries=15, rate_limiter: Optional[RateLimiter] = None,
+                        llm_cache: Optional[LLMCache] = None, stream_handler=None):
+    """
+    带限速、缓存和重试的chat completion调用
+    stream_handler: 提供时以流式模式请求，返回stream_handler(stream)的结果（dict，含content/aborted）；
+                    完整（未中止）的流式结果同样写入缓存，命中时把缓存的响应作为单个chunk回放给stream_handler
+    """
     import json
+    import random
+    import openai
     retries = 0
     base_delay = 2
+    limiter = rate_limiter or API_RATE_LIMITER
+    call_start = time.perf_counter()
+    
+    def record(outcome: str, latency: float = 0.0, usage=None):
+        if RUN_METRICS is not None:
+            RUN_METRICS.record_api_call(
+                model, outcome, latency=latency, wall_seconds=time.perf_counter() - call_start, retries=retries,
+                usage=usage, image_bytes=0 if outcome == "cached" else _image_payload_bytes(messages) * (retries + 1),
+                streamed=stream_handler is not None,
+            )
+    
+    # 命中响应缓存时直接返回，不占用限速配额
+    cache = llm_cache or LLM_CACHE
+    cache_key = None
+    if cache is not None:
+        cache_key = LLMCache.make_key(model, messages, response_format)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            record("cached", usage=getattr(cached, "usage", None))
+            return stream_handler(_CachedStream(cached)) if stream_handler is not None else cached
     
-    # Add throttling: sleep before each call to avoid hitting rate limits
-    time.sleep(1.5)  # 1.5 second delay between API calls
+    estimated_tokens = estimate_message_tokens(messages)
+    
+    def backoff_delay(headers=None) -> float:
+        """优先使用服务商给出的等待时间，否则指数退避（带上限和抖动）"""
+        wait = limiter.update_from_headers(headers)
+        if wait is None:
+            wait = min(base_delay * (2 ** retries), API_MAX_BACKOFF) * random.uniform(0.8, 1.2)
+            limiter.pause(wait)
+        return wait
     
     while retries < max_retries:
+        # 令牌桶限速（替代固定的1.5秒间隔），所有并发调用方共享配额
+        limiter.acquire(estimated_tokens)
+        attempt_start = time.perf_counter()
         try:
-            return client.chat.completions.create(
+            if stream_handler is not None:
+                raw_response = client.chat.completions.with_raw_response.create(
+                    model=model,
+                    messages=messages,
+                    response_format=response_format,
+                    stream=True,
+                    stream_options={"include_usage": True}
+                )
+                limiter.update_from_headers(raw_response.headers)
+                result = stream_handler(raw_response.parse())
+                # 中止的流只有部分内容，不能缓存
+                if cache is not None and isinstance(result, dict) and result.get("content") and not result.get("aborted"):
+                    cache.put(cache_key, model, _completion_from_stream(model, result))
+                record("ok", latency=time.perf_counter() - attempt_start,
+                       usage=result.get("usage") if isinstance(result, dict) else None)
+                return result
+            
+            raw_response = client.chat.completions.with_raw_response.create(
                 model=model,
                 messages=messages,
                 response_format=response_format
             )
+            limiter.update_from_headers(raw_response.headers)
+            response = raw_response.parse()
+            usage = getattr(response, "usage", None)
+            if usage and getattr(usage, "total_tokens", None):
+                limiter.adjust_tokens(usage.total_tokens - estimated_tokens)
+            # 只缓存有实际内容的响应，避免把空回复固化下来
+            if cache is not None and response.choices and response.choices[0].message.content:
+                cache.put(cache_key, model, response)
+            record("ok", latency=time.perf_counter() - attempt_start, usage=usage)
+            return response
         except json.JSONDecodeError as e:
             # Special handling for JSON parsing errors (often means API returned HTML error page)
-            wait_time = base_delay * (2 ** retries)
-            print(f"⚠️  JSON解析错误 (API可能返回了非JSON响应). 等待 {wait_time} 秒后重试... (尝试 {retries+1}/{max_retries})")
+            wait_time = backoff_delay()
+            print(f"⚠️  JSON解析错误 (API可能返回了非JSON响应). 等待 {wait_time:.1f} 秒后重试... (尝试 {retries+1}/{max_retries})")
             print(f"   错误详情: {str(e)[:200]}")
-            time.sleep(wait_time)
             retries += 1
             if retries >= max_retries:
                 print(f"❌ JSON解析错误持续出现，已达到重试上限。跳过此问题。")
+                record("failed")
                 return None  # Return None to allow skipping
         except Exception as e:
             error_str = str(e).lower()
-            if "429" in error_str or "rate limit" in error_str or "quota" in error_str:
-                wait_time = base_delay * (2 ** retries)
-                print(f"⚠️ 触发速率限制 (Rate limit/Quota). 等待 {wait_time} 秒后重试... (Attempt {retries+1}/{max_retries})")
-                time.sleep(wait_time)
+            headers = e.response.headers if isinstance(e, openai.APIStatusError) else None
+            if isinstance(e, openai.RateLimitError) or "429" in error_str or "rate limit" in error_str or "quota" in error_str:
+                wait_time = backoff_delay(headers)
+                print(f"⚠️ 触发速率限制 (Rate limit/Quota). 暂停所有请求 {wait_time:.1f} 秒后重试... (Attempt {retries+1}/{max_retries})")
                 retries += 1
             elif "400" in error_str:
                 # Allow limited retries for 400 (may be transient content filtering)
@@ -1330,17 +3204,21 @@ def call_api_with_retry(client, model, messages, response_format=None, max_retri
                     retries += 1
                 else:
                     print(f"❌ API 400 错误持续出现，已达到重试上限。")
+                    record("failed")
                     raise e
             else:
                 print(f"❌ API 调用发生未处理错误: {e}")
+                record("failed")
                 raise e
+    record("failed")
     raise Exception(f"API 调用超过最大重试次数 ({max_retries})")
 
 class ArchitectAgent:
     def __init__(self, client: OpenAI):
         self.client = client
 
-    def generate_outline(self, text_content: str, figures_list: List[dict] = None, equations_list: List[dict] = None, visual_groups: dict = None, include_appendix: bool = False) -> Outline:
+    def generate_outline(self, text_content: str, figures_list: List[dict] = None, equations_list: List[dict] = None, visual_groups: dict = None, include_appendix: bool = False,
+                         token_budget: int = ARCHITECT_TOKEN_BUDGET) -> Outline:
         """
         生成论文阅读大纲
         Args:
@@ -1349,7 +3227,11 @@ class ArchitectAgent:
             equations_list: 扫描得到的公式清单 [{"page": int, "equation_type": str, "description": str}, ...]
             visual_groups: 智能分组后的视觉元素 {"figure_groups": [...], "equation_groups": [...]}
             include_appendix: 是否包含附录
+            token_budget: 论文文本的token预算，超出部分截断（会打印提示）
         """
+        text_content, truncated = truncate_to_token_budget(text_content, token_budget)
+        if truncated:
+            print(f"  ⚠️ Architect输入超出token预算({token_budget})，已截断为{len(text_content)}字符")
         appendix_instruction = "请分析附录 (Appendix) 部分。" if include_appendix else "请忽略附录 (Appendix)，专注于正文。"
         
         # 构建视觉元素清单文本（优先使用分组信息）
@@ -1633,7 +3515,7 @@ class ArchitectAgent:
             model=ARCHITECT_MODEL,
             messages=[
                 {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"分析这篇论文文本 (Abstract/Intro) 并生成研读大纲。\n**重要：请务必使用中文输出 JSON 内容，并严格遵守层级标号要求。**\n\n{text_content[:8000]}"}
+                {"role": "user", "content": f"分析这篇论文文本 (Abstract/Intro) 并生成研读大纲。\n**重要：请务必使用中文输出 JSON 内容，并严格遵守层级标号要求。**\n\n{text_content}"}
             ],
             response_format={"type": "json_object"}
         )
@@ -1658,6 +3540,217 @@ class ArchitectAgent:
                      return Outline.model_validate_json(match.group(0))
             raise e
 
+class TokenBudgetBatcher:
+    """
+    按估算token数把页面装入Architect批次（增量式：逐页add，批次装满时返回）
+    单页超出预算时独占一个批次，由generate_outline截断并提示
+    """
+    
+    SEPARATOR = "\n\n---\n\n"
+    
+    def __init__(self, token_budget: int = ARCHITECT_TOKEN_BUDGET, max_pages: int = PAGES_PER_BATCH):
+        self.token_budget = token_budget
+        self.max_pages = max(1, max_pages)
+        self._separator_tokens = estimate_text_tokens(self.SEPARATOR)
+        self._pages = []     # 当前批次的 (page_idx, text)
+        self._tokens = 0
+    
+    def add(self, page_idx: int, text: str) -> Optional[dict]:
+        """加入一页；如果当前批次因此装满，返回已完成的批次，否则返回None"""
+        page_tokens = estimate_text_tokens(text)
+        added_tokens = page_tokens + (self._separator_tokens if self._pages else 0)
+        completed = None
+        if self._pages and (self._tokens + added_tokens > self.token_budget or len(self._pages) >= self.max_pages):
+            completed = self.flush()
+            added_tokens = page_tokens
+        self._pages.append((page_idx, text))
+        self._tokens += added_tokens
+        return completed
+    
+    def flush(self) -> Optional[dict]:
+        """返回当前未满的批次（没有页面时返回None）"""
+        if not self._pages:
+            return None
+        batch = {
+            "start": self._pages[0][0],
+            "end": self._pages[-1][0] + 1,
+            "text": self.SEPARATOR.join(text for _, text in self._pages),
+            "tokens": self._tokens,
+            "truncated": self._tokens > self.token_budget,
+        }
+        self._pages = []
+        self._tokens = 0
+        return batch
+    
+    @classmethod
+    def plan(cls, pages_text: List[str], token_budget: int = ARCHITECT_TOKEN_BUDGET,
+             max_pages: int = PAGES_PER_BATCH) -> List[dict]:
+        """一次性把所有页面分成批次"""
+        batcher = cls(token_budget, max_pages)
+        batches = []
+        for page_idx, text in enumerate(pages_text):
+            completed = batcher.add(page_idx, text)
+            if completed:
+                batches.append(completed)
+        last = batcher.flush()
+        if last:
+            batches.append(last)
+        return batches
+
+def attach_batch_inventory(batch: dict, figures_list: List[dict], equations_list: List[dict],
+                           visual_groups: Optional[dict]) -> dict:
+    """把页码落在批次范围内的图表/公式清单（及其分组）附加到批次上"""
+    in_batch = lambda page: batch["start"] <= page < batch["end"]
+    batch["figures_list"] = [fig for fig in figures_list or [] if in_batch(fig["page"])]
+    batch["equations_list"] = [eq for eq in equations_list or [] if in_batch(eq["page"])]
+    batch["visual_groups"] = None
+    if visual_groups:
+        groups = {
+            key: [group for group in visual_groups.get(key, []) if any(in_batch(p) for p in group["pages"])]
+            for key in ("figure_groups", "equation_groups")
+        }
+        if groups["figure_groups"] or groups["equation_groups"]:
+            batch["visual_groups"] = groups
+    return batch
+
+def run_architect_batches(architect: ArchitectAgent, batches: List[dict], include_appendix: bool = False,
+                          max_workers: int = ARCHITECT_CONCURRENCY,
+                          token_budget: int = ARCHITECT_TOKEN_BUDGET) -> List[Outline]:
+    """
+    并发调用Architect处理各批次，按批次顺序返回大纲（合并顺序与串行执行一致）
+    Args:
+        batches: [{"start": int, "end": int, "text": str, "figures_list": list|None,
+                   "equations_list": list|None, "visual_groups": dict|None}, ...]
+    任一批次失败时取消尚未开始的批次并抛出异常
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    
+    workers = max(1, min(max_workers, len(batches)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="architect") as executor:
+        futures = [executor.submit(run_architect_batch, architect, batch, f"{idx+1}/{len(batches)}",
+                                   include_appendix, token_budget)
+                   for idx, batch in enumerate(batches)]
+        try:
+            return [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+def run_architect_batch(architect: ArchitectAgent, batch: dict, label: str, include_appendix: bool = False,
+                        token_budget: int = ARCHITECT_TOKEN_BUDGET) -> Outline:
+    """调用Architect处理单个批次（label用于日志，如"2/5"）"""
+    started = time.time()
+    outline = architect.generate_outline(
+        batch["text"],
+        figures_list=batch.get("figures_list"),
+        equations_list=batch.get("equations_list"),
+        visual_groups=batch.get("visual_groups"),
+        include_appendix=include_appendix,
+        token_budget=token_budget
+    )
+    print(f"  ✅ 批次 {label} (第{batch['start']+1}-{batch['end']}页): "
+          f"生成了{len(outline.sections)}个分析问题 ({time.time() - started:.1f}秒)")
+    return outline
+
+def consume_page_stream(paper: dict, args, architect: Optional[ArchitectAgent] = None,
+                        on_outline=None) -> Optional[List[Outline]]:
+    """
+    流水线模式的消费端：按页码顺序接收后台OCR产出的页面，逐页扫描公式；
+    提供architect时按token预算增量装箱，批次一装满就提交Architect，LLM大纲生成与剩余页面的OCR重叠
+    on_outline(outline, equations_list) 在主线程中按批次顺序调用：前面的批次都完成后，
+    每个批次的大纲一完成就交给它（用于提前分析）
+    结束后把 all_pages_text / equations_list / visual_groups 写回paper（与prepare_paper的非流水线结果一致），
+    返回按批次顺序排列的大纲（未提供architect时返回None）
+    任一批次失败时停止OCR、取消尚未开始的批次并抛出异常
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    
+    stream = paper.pop("page_stream")
+    pdf_proc = paper["pdf_proc"]
+    figures_list = paper["figures_list"]
+    metrics = paper["metrics"]
+    scanner = EquationScanner([], doc=pdf_proc.doc)
+    batcher = TokenBudgetBatcher(token_budget=args.architect_token_budget)
+    executor = None
+    if architect is not None:
+        executor = ThreadPoolExecutor(max_workers=max(1, args.architect_concurrency), thread_name_prefix="architect")
+        print(f"📚 流水线模式: 页面OCR完成即装箱，按token预算{args.architect_token_budget}提交Architect批次"
+              f"（并发数{args.architect_concurrency}）")
+    
+    all_pages_text = []
+    equations_list = []
+    futures = []
+    scan_seconds = 0.0
+    delivered = 0
+    
+    def deliver_ready(wait: bool = False):
+        """按批次顺序把已完成的大纲交给on_outline（wait=True时等待全部完成）"""
+        nonlocal delivered
+        while delivered < len(futures) and (wait or futures[delivered].done()):
+            outline = futures[delivered].result()
+            delivered += 1
+            if on_outline is not None:
+                on_outline(outline, equations_list)
+    
+    def submit(batch: dict):
+        # 批次只包含已识别的页面，此时其范围内的公式都已扫描完毕
+        # 只对批次范围内的图表/公式分组（attach_batch_inventory也只保留这些），避免每个批次在消费线程上
+        # 对已扫描的全部公式重新分组而阻塞页面消费和OCR
+        in_batch = lambda page: batch["start"] <= page < batch["end"]
+        batch_groups = group_visual_elements([fig for fig in figures_list if in_batch(fig["page"])],
+                                             [eq for eq in equations_list if in_batch(eq["page"])])
+        attach_batch_inventory(batch, figures_list, equations_list, batch_groups)
+        label = str(len(futures) + 1)
+        truncated_note = " ⚠️ 超出预算，将截断" if batch["truncated"] else ""
+        print(f"  📤 提交批次 {label}: 第{batch['start']+1}-{batch['end']}页，约{batch['tokens']} tokens，"
+              f"{len(batch['figures_list'])}个图表，{len(batch['equations_list'])}个公式{truncated_note}")
+        futures.append(executor.submit(run_architect_batch, architect, batch, label,
+                                       args.include_appendix, args.architect_token_budget))
+    
+    stage_start = time.perf_counter()
+    try:
+        for page_num, text in stream:
+            all_pages_text.append(text)
+            scan_start = time.perf_counter()
+            with FITZ_LOCK:
+                equations_list.extend(scanner.scan_page(text, page_num))
+            scan_seconds += time.perf_counter() - scan_start
+            if executor is not None:
+                completed = batcher.add(page_num, text)
+                if completed:
+                    submit(completed)
+                deliver_ready()
+        metrics.add_stage("text_extraction", stream.elapsed)
+        metrics.record_ocr(pdf_proc.page_timings, cached_pages=pdf_proc.cached_pages,
+                           session_setup_seconds=pdf_proc.session_setup_seconds)
+        metrics.add_stage("equation_scan", scan_seconds)
+        
+        outlines = None
+        if executor is not None:
+            last = batcher.flush()
+            if last:
+                submit(last)
+            print(f"⏳ OCR已完成，等待{sum(1 for f in futures if not f.done())}/{len(futures)}个Architect批次...")
+            deliver_ready(wait=True)
+            outlines = [future.result() for future in futures]
+            metrics.add_stage("architect", time.perf_counter() - stage_start)
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        stream.close()
+        if executor is not None:
+            executor.shutdown(wait=True)
+    
+    print(f"✅ 检测到 {len(equations_list)} 个公式")
+    stage_start = time.perf_counter()
+    visual_groups = group_visual_elements(figures_list, equations_list)
+    metrics.add_stage("grouping", time.perf_counter() - stage_start)
+    paper.update(all_pages_text=all_pages_text, equations_list=equations_list, visual_groups=visual_groups)
+    return outlines
+
 class ContentValidator:
     def __init__(self, min_length=600, max_length=3500):
         self.min_length = min_length
@@ -1694,41 +3787,38 @@ class ContentValidator:
 
         return True, "Pass"
 
-class AnalystAgent:
-    def __init__(self, client: OpenAI):
-        self.client = client
-        self.validator = ContentValidator()
-
-    def analyze_section(self, image_b64: str, sub_question: SubQuestion, section_type: str = "text", prev_context: str = "") -> str:
-        """
-        分析论文特定部分
-        Args:
-            image_b64: Base64编码的图片
-            sub_question: SubQuestion对象（包含问题、类型和字数要求）
-            section_type: 内容类型
-            prev_context: 先前的上下文
-        """
-        # 根据问题类型定制system_prompt
-        question_type_desc = {
-            "phenomenon": "现象描述/'是什么'",
-            "mechanism": "机理推导",
-            "critique": "目的和批判/'为什么'"
-        }
-        
-        current_type_desc = question_type_desc.get(sub_question.question_type, "综合分析")
-        
-        system_prompt = f"""
-        你是一位世界顶尖的**理论神经科学家和物理学家**（如 Feynman 或 Hopfield 风格）。
-        你的任务是对学术论文的特定部分进行深度解析。
+class AnalystAgent:
+    # API调用失败时占位回答中的标记（此类回答不会记入断点日志，--resume时会重新分析）
+    SKIPPED_MARKER = "[分析跳过：API调用失败]"
+    
+    def __init__(self, client: OpenAI, stream: bool = False, retry_context: str = ANALYST_RETRY_CONTEXT):
+        self.client = client
+        self.validator = ContentValidator()
+        # 流式模式：边生成边写入草稿文件，超过validate_max时立即中止
+        self.stream = stream
+        # 字数重试时携带的上下文: full | last | summary
+        self.retry_context = retry_context
 
-        ## 当前问题类型: {current_type_desc}
-        
-        根据问题类型，你需要采用不同的分析策略：
+    # 问题类型在提示词中的名称（未列出的类型为"综合分析"）
+    QUESTION_TYPE_DESC = {
+        "phenomenon": "现象描述/'是什么'",
+        "mechanism": "机理推导",
+        "critique": "目的和批判/'为什么'"
+    }
+
+    @classmethod
+    def _question_type_desc(cls, question_type: str) -> str:
+        return cls.QUESTION_TYPE_DESC.get(question_type, "综合分析")
+
+    @staticmethod
+    def _analysis_guidelines(word_requirement: str) -> str:
+        """按问题类型的分析策略与格式规范（逐题与批量模式共用，保证两种模式的回答标准一致）"""
+        return f"""根据问题类型，你需要采用不同的分析策略：
 
         ### 如果是"phenomenon"（现象描述/"是什么"）:
         - **重点**: 客观描述图表趋势、解剖结构或数据特征
         - **包含**: 观察到的现象、数据模式、视觉特征
-        - **字数要求**: 目标{sub_question.min_words}-{sub_question.max_words}字，验证范围{sub_question.validate_min}-{sub_question.validate_max}字
+        - **字数要求**: {word_requirement}
 
         ### 如果是"mechanism"（机理推导）:
         - **重点**: 解释背后的生成机制
@@ -1736,7 +3826,7 @@ class AnalystAgent:
           - 第一性原理推导（First-Principles Derivation）
           - 每个变量的物理/神经意义
           - 数学公式（使用LaTeX格式）
-        - **字数要求**: 目标{sub_question.min_words}-{sub_question.max_words}字，验证范围{sub_question.validate_min}-{sub_question.validate_max}字
+        - **字数要求**: {word_requirement}
 
         ### 如果是"critique"（目的和批判/"为什么"）:
         - **重点**: 质疑设计动机、识别局限性
@@ -1744,14 +3834,126 @@ class AnalystAgent:
           - 为什么要这样设计？解决了什么计算问题？
           - 这个结论在什么条件下不成立？
           - 是否存在替代解释模型？
-        - **字数要求**: 目标{sub_question.min_words}-{sub_question.max_words}字，验证范围{sub_question.validate_min}-{sub_question.validate_max}字
+        - **字数要求**: {word_requirement}
 
         ## 格式规范
         1. **全中文输出**
         2. **使用Markdown格式**，数学公式使用LaTeX (`$$ ... $$` 或 `$ ... $`)
         3. **段落控制**: 任何段落不超过5行
         4. **关键词加粗**: 核心概念用**粗体**标记
-        5. **列表化**: 涉及列举使用Bullet Points
+        5. **列表化**: 涉及列举使用Bullet Points"""
+
+    @classmethod
+    def _skipped_answer(cls, sub_question: SubQuestion) -> str:
+        """API重试耗尽时的占位回答（含SKIPPED_MARKER，不记入断点日志）"""
+        return f"# {sub_question.question}\n\n**{cls.SKIPPED_MARKER}**\n\n该问题因API错误被跳过，请稍后手动补充分析。"
+
+    @staticmethod
+    def _summarize_answer(content: str, max_chars: int = RETRY_SUMMARY_MAX_CHARS) -> str:
+        """提取回答的提纲（标题 + 每段首句），用于紧凑的重试上下文"""
+        outline_lines = []
+        for block in re.split(r'\n\s*\n', content):
+            block = block.strip()
+            if not block:
+                continue
+            first_line = block.splitlines()[0].strip()
+            if not first_line.startswith("#"):
+                first_line = re.split(r'(?<=[。！？.!?])', first_line, maxsplit=1)[0][:80]
+            outline_lines.append(first_line)
+        summary = "\n".join(outline_lines)
+        return summary[:max_chars] + ("…" if len(summary) > max_chars else "")
+
+    def _build_retry_messages(self, base_messages: list, history: list, content: str, feedback: str) -> list:
+        """
+        按重试策略构造下一次请求
+        Args:
+            base_messages: system + 原始user消息（含图片）
+            history: full策略下累积的历史回答与修改意见（就地追加）
+        """
+        correction = f"字数验证未通过: {feedback}\n请重写，严格遵守字数要求。"
+        if self.retry_context == "full":
+            history.append({"role": "assistant", "content": content})
+            history.append({"role": "user", "content": correction})
+            return base_messages + history
+        if self.retry_context == "summary":
+            summary = self._summarize_answer(content)
+            return base_messages + [{"role": "user", "content": f"你上一次回答的提纲如下:\n{summary}\n\n{correction}"}]
+        # last: 只携带最近一次回答
+        return base_messages + [{"role": "assistant", "content": content}, {"role": "user", "content": correction}]
+
+    def _stream_answer(self, messages: list, max_words: int, draft_path: Optional[Path], label: str,
+                       abort_over_limit: bool = True) -> Optional[dict]:
+        """
+        流式请求一次回答，返回 {"content", "aborted", "ttft", "usage"}（API调用失败时返回None）
+        abort_over_limit: 字数（去除空白后的字符数）超过max_words时关闭连接，不再为多余的token付费；
+                          最后一次尝试不中止，保证返回完整的回答
+        """
+        def consume(stream) -> dict:
+            started = time.time()
+            ttft = None
+            parts = []
+            word_count = 0
+            aborted = False
+            usage = None
+            draft = open(draft_path, "w", encoding="utf-8") if draft_path else None
+            try:
+                for chunk in stream:
+                    # include_usage时最后一个chunk只携带用量
+                    if getattr(chunk, "usage", None):
+                        usage = chunk.usage
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if not delta:
+                        continue
+                    if ttft is None:
+                        ttft = time.time() - started
+                    parts.append(delta)
+                    if draft:
+                        draft.write(delta)
+                        draft.flush()
+                    word_count += len(re.sub(r'\s+', '', delta))
+                    if abort_over_limit and word_count > max_words:
+                        aborted = True
+                        break
+            finally:
+                stream.close()
+                if draft:
+                    draft.close()
+            return {"content": "".join(parts), "aborted": aborted, "ttft": ttft, "usage": usage}
+        
+        result = call_api_with_retry(self.client, model=ANALYST_MODEL, messages=messages, stream_handler=consume)
+        if result is not None:
+            ttft_str = f"{result['ttft']:.2f}秒" if result["ttft"] is not None else "无输出"
+            abort_str = f"，超过{max_words}字已提前中止" if result["aborted"] else ""
+            print(f"{label}⏱️ 首token延迟: {ttft_str}{abort_str}")
+        return result
+
+    def analyze_section(self, image_b64: str, sub_question: SubQuestion, section_type: str = "text", prev_context: str = "",
+                        image_mime: str = "image/png", label: str = "", draft_path: Optional[Path] = None) -> str:
+        """
+        分析论文特定部分
+        Args:
+            image_b64: Base64编码的图片
+            sub_question: SubQuestion对象（包含问题、类型和字数要求）
+            section_type: 内容类型
+            prev_context: 先前的上下文
+            image_mime: 图片MIME类型（与ImageEncoder的输出格式一致）
+            label: 日志前缀（并发执行时用于区分不同子问题）
+            draft_path: 流式模式下实时写入的草稿文件
+        """
+        # 根据问题类型定制system_prompt
+        current_type_desc = self._question_type_desc(sub_question.question_type)
+        word_requirement = (f"目标{sub_question.min_words}-{sub_question.max_words}字，"
+                            f"验证范围{sub_question.validate_min}-{sub_question.validate_max}字")
+        
+        system_prompt = f"""
+        你是一位世界顶尖的**理论神经科学家和物理学家**（如 Feynman 或 Hopfield 风格）。
+        你的任务是对学术论文的特定部分进行深度解析。
+
+        ## 当前问题类型: {current_type_desc}
+        
+        {self._analysis_guidelines(word_requirement)}
         
         **重要**: 输出后我会进行字数验证。如果不在{sub_question.validate_min}-{sub_question.validate_max}字范围内，你需要重写。
         """
@@ -1765,7 +3967,7 @@ class AnalystAgent:
         请针对这个问题进行深度分析，字数控制在{sub_question.min_words}-{sub_question.max_words}字之间。
         """
 
-        messages = [
+        base_messages = [
             {"role": "system", "content": system_prompt},
             {
                 "role": "user",
@@ -1773,38 +3975,56 @@ class AnalystAgent:
                     {"type": "text", "text": user_prompt},
                     {
                         "type": "image_url",
-                        "image_url": {"url": f"data:image/png;base64,{image_b64}"},
+                        "image_url": {"url": f"data:{image_mime};base64,{image_b64}"},
                     },
                 ],
             },
         ]
+        messages = base_messages
+        history = []
 
         # Retry Loop with word count validation
         max_retries = 3
         for attempt in range(max_retries):
-            print(f"💭 分析中... (尝试 {attempt+1}/{max_retries})")
+            print(f"{label}💭 分析中... (尝试 {attempt+1}/{max_retries})")
             
-            response = call_api_with_retry(
-                self.client,
-                model=ANALYST_MODEL,
-                messages=messages
-            )
+            if self.stream:
+                # 最后一次尝试不再中止：否则重试耗尽后写入笔记的是在句中截断的回答
+                response = self._stream_answer(messages, sub_question.validate_max, draft_path, label,
+                                               abort_over_limit=attempt < max_retries - 1)
+            else:
+                response = call_api_with_retry(
+                    self.client,
+                    model=ANALYST_MODEL,
+                    messages=messages
+                )
             
             # Handle case where API call failed after max retries
             if response is None:
-                print(f"⚠️  API调用失败，跳过此问题")
-                return f"# {sub_question.question}\n\n**[分析跳过：API调用失败]**\n\n该问题因API错误被跳过，请稍后手动补充分析。"
+                print(f"{label}⚠️  API调用失败，跳过此问题")
+                return self._skipped_answer(sub_question)
             
-            content = response.choices[0].message.content
+            content = response["content"] if self.stream else response.choices[0].message.content
+            usage = response.get("usage") if self.stream else getattr(response, "usage", None)
+            prompt_tokens = getattr(usage, "prompt_tokens", None)
+            if prompt_tokens is None:
+                prompt_tokens = f"~{estimate_message_tokens(messages)}"
+            print(f"{label}📨 尝试{attempt+1} prompt tokens: {prompt_tokens}（重试上下文: {self.retry_context}）")
             
             # Word count validation (Chinese characters)
             word_count = len(re.sub(r'\s+', '', content))
+            # 流式中止时word_count只是中止位置，不是回答的实际长度
+            aborted = self.stream and response["aborted"]
             
-            if sub_question.validate_min <= word_count <= sub_question.validate_max:
-                print(f"✅ 字数验证通过: {word_count}字 (目标{sub_question.min_words}-{sub_question.max_words}字)")
+            if aborted:
+                print(f"{label}⚠️  字数不符: 超过{sub_question.validate_max}字上限，已中止生成")
+                feedback = f"回答超出字数上限（生成超过{sub_question.validate_max}字时已被中止）。需要控制在{sub_question.validate_max}字以内，目标{sub_question.min_words}-{sub_question.max_words}字。请大幅精简表述。"
+                messages = self._build_retry_messages(base_messages, history, content, feedback)
+            elif sub_question.validate_min <= word_count <= sub_question.validate_max:
+                print(f"{label}✅ 字数验证通过: {word_count}字 (目标{sub_question.min_words}-{sub_question.max_words}字)")
                 return content
             else:
-                print(f"⚠️  字数不符: 当前{word_count}字，要求{sub_question.validate_min}-{sub_question.validate_max}字")
+                print(f"{label}⚠️  字数不符: 当前{word_count}字，要求{sub_question.validate_min}-{sub_question.validate_max}字")
                 
                 # Provide feedback for retry
                 if word_count < sub_question.validate_min:
@@ -1812,8 +4032,7 @@ class AnalystAgent:
                 else:
                     feedback = f"回答字数过多（{word_count}字）。需要控制在{sub_question.validate_max}字以内，目标{sub_question.min_words}-{sub_question.max_words}字。请精简表述。"
                 
-                messages.append({"role": "assistant", "content": content})
-                messages.append({"role": "user", "content": f"字数验证未通过: {feedback}\n请重写，严格遵守字数要求。"})
+                messages = self._build_retry_messages(base_messages, history, content, feedback)
         
         # If all retries failed, return with warning
         word_count = len(re.sub(r'\s+', '', content))
@@ -1823,10 +4042,140 @@ class AnalystAgent:
         # If all retries failed, append a warning but return content (don't crash)
         return content + "\n\n> [!WARNING] 此内容未完全通过质量验证 (e.g. 维度缺失或字数不足)，建议人工复核。"
 
+    def analyze_section_batch(self, image_b64: str, sub_questions: List[SubQuestion], anchor_ids: List[str],
+                              section_type: str = "text", image_mime: str = "image/png", label: str = "") -> List[str]:
+        """
+        一次请求回答一个section的多个子问题（图片和系统提示只上传一次）
+        返回与sub_questions对齐的回答列表；每个回答单独验证字数，只重新提问未通过的问题
+        JSON解析失败或缺失的回答回退到逐题analyze_section；API重试耗尽时未完成的问题直接返回跳过占位（与逐题模式一致）
+        """
+        system_prompt = f"""
+        你是一位世界顶尖的**理论神经科学家和物理学家**（如 Feynman 或 Hopfield 风格）。
+        你的任务是对学术论文的特定部分进行深度解析，一次回答多个子问题。
+
+        {self._analysis_guidelines("见各问题的字数要求")}
+
+        ## 输出格式
+        只输出JSON: {{"answers": [{{"anchor_id": "<问题编号>", "answer": "<Markdown回答>"}}, ...]}}
+        每个问题单独作答，严格遵守各自的字数要求；我会逐题进行字数验证，未通过的问题需要重写。
+        """
+        
+        def build_user_prompt(indices: List[int], feedback: dict) -> str:
+            prompt = "## 任务\n参考资料: 见附图\n请分别回答以下问题:\n\n"
+            for i in indices:
+                sub_q = sub_questions[i]
+                prompt += (f"### {anchor_ids[i]}\n问题: {sub_q.question}\n"
+                           f"问题类型: {self._question_type_desc(sub_q.question_type)}\n"
+                           f"字数要求: 目标{sub_q.min_words}-{sub_q.max_words}字，验证范围{sub_q.validate_min}-{sub_q.validate_max}字\n")
+                if i in feedback:
+                    prompt += f"上次回答未通过字数验证: {feedback[i]}\n"
+                prompt += "\n"
+            return prompt
+        
+        answers = [None] * len(sub_questions)
+        last_answers = {}
+        pending = list(range(len(sub_questions)))
+        feedback = {}
+        api_failed = False
+        max_retries = 3
+        for attempt in range(max_retries):
+            print(f"{label}💭 批量分析{len(pending)}个子问题... (尝试 {attempt+1}/{max_retries})")
+            messages = [
+                {"role": "system", "content": system_prompt},
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": build_user_prompt(pending, feedback)},
+                        {"type": "image_url", "image_url": {"url": f"data:{image_mime};base64,{image_b64}"}},
+                    ],
+                },
+            ]
+            response = call_api_with_retry(self.client, model=ANALYST_MODEL, messages=messages,
+                                           response_format={"type": "json_object"})
+            if response is None:
+                # 重试已耗尽，不再逐题回退（否则每个问题都会对失败的API再走一遍完整重试）
+                print(f"{label}⚠️  API调用失败，跳过{len(pending)}个子问题")
+                api_failed = True
+                break
+            usage = getattr(response, "usage", None)
+            prompt_tokens = getattr(usage, "prompt_tokens", None) or f"~{estimate_message_tokens(messages)}"
+            print(f"{label}📨 尝试{attempt+1} prompt tokens: {prompt_tokens}")
+            
+            try:
+                payload = json.loads(response.choices[0].message.content)
+                by_anchor = {item["anchor_id"]: item["answer"] for item in payload.get("answers", [])
+                             if isinstance(item, dict) and isinstance(item.get("answer"), str)}
+            except (json.JSONDecodeError, TypeError, KeyError, AttributeError) as e:
+                print(f"{label}⚠️  批量回答JSON解析失败: {e}")
+                continue
+            
+            feedback = {}
+            still_pending = []
+            for i in pending:
+                content = by_anchor.get(anchor_ids[i])
+                if content is None:
+                    still_pending.append(i)
+                    continue
+                last_answers[i] = content
+                sub_q = sub_questions[i]
+                word_count = len(re.sub(r'\s+', '', content))
+                if sub_q.validate_min <= word_count <= sub_q.validate_max:
+                    print(f"{label}✅ {anchor_ids[i]} 字数验证通过: {word_count}字")
+                    answers[i] = content
+                    continue
+                print(f"{label}⚠️  {anchor_ids[i]} 字数不符: 当前{word_count}字，要求{sub_q.validate_min}-{sub_q.validate_max}字")
+                if word_count < sub_q.validate_min:
+                    feedback[i] = f"字数不足（{word_count}字），需要至少{sub_q.validate_min}字。请大幅扩充分析深度和细节。"
+                else:
+                    feedback[i] = f"字数过多（{word_count}字），需要控制在{sub_q.validate_max}字以内。请精简表述。"
+                still_pending.append(i)
+            pending = still_pending
+            if not pending:
+                break
+        
+        for i in pending:
+            sub_q = sub_questions[i]
+            if api_failed:
+                answers[i] = self._skipped_answer(sub_q)
+            elif i in last_answers:
+                # 多次重写仍未通过字数验证：保留最后一次回答并附加警告（与逐题模式一致）
+                word_count = len(re.sub(r'\s+', '', last_answers[i]))
+                answers[i] = last_answers[i] + (f"\n\n---\n⚠️ **字数警告**: 当前{word_count}字，未达到"
+                                                f"{sub_q.validate_min}-{sub_q.validate_max}字要求（已重试{max_retries}次）\n")
+            else:
+                # 批量回答中缺失：回退到逐题分析
+                print(f"{label}↩️ {anchor_ids[i]} 未在批量回答中返回，改为单独分析")
+                answers[i] = self.analyze_section(image_b64, sub_q, section_type=section_type,
+                                                  image_mime=image_mime, label=f"{label}{anchor_ids[i]} ")
+        return answers
+
 class FileManager:
+    OUTLINE_FILENAME = "outline.json"
+    
     def __init__(self, vault_path: Path):
         self.vault_path = vault_path
         self.vault_path.mkdir(parents=True, exist_ok=True)
+        # 本次运行已写过的spoke note：首次写入时覆盖旧文件，之后（同名section）才追加
+        # 保证重跑/--resume时内容不会重复
+        self._written_this_run = set()
+
+    def save_outline(self, outline: Outline, paper_folder: Path):
+        """保存最终大纲（先写临时文件再原子替换），供--resume复用"""
+        path = paper_folder / self.OUTLINE_FILENAME
+        tmp_path = path.with_suffix(".json.tmp")
+        tmp_path.write_text(outline.model_dump_json(indent=2), encoding="utf-8")
+        os.replace(tmp_path, path)
+
+    def load_outline(self, paper_folder: Path) -> Optional[Outline]:
+        """读取已保存的大纲，不存在或无法解析时返回None"""
+        path = paper_folder / self.OUTLINE_FILENAME
+        try:
+            return Outline.model_validate_json(path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            print(f"⚠️ 已保存的大纲无法解析，将重新生成: {e}")
+            return None
 
     def write_hub_index(self, outline: Outline, paper_folder: Path, paper_slug: str):
         content = f"# {outline.paper_title}\n\n"
@@ -1868,8 +4217,9 @@ class FileManager:
         unique_slug = f"{paper_slug}_{clean_slug}"
         file_path = paper_folder / f"{unique_slug}.md"
         
-        # Check if file exists to determine mode and header
-        file_exists = file_path.exists()
+        # Append only if this run already wrote the file; stale files from earlier runs are overwritten
+        file_exists = file_path in self._written_this_run
+        self._written_this_run.add(file_path)
         
         mode = "a" if file_exists else "w"
         
@@ -1900,26 +4250,380 @@ class FileManager:
                 q_a_block += f"### 💡 分析回答\n{analysis['answer']}\n\n"
                 f.write(q_a_block)
 
-# --- Main Workflow ---
+class AnalysisJournal:
+    """
+    Analyst阶段的断点日志（JSON Lines，线程安全）
+    每完成一个子问题追加一行 {section_idx, question_idx, question, answer}，--resume时据此跳过已完成的问题
+    """
+    
+    FILENAME = "analysis_journal.jsonl"
+    
+    def __init__(self, paper_folder: Path, resume: bool = False):
+        self.path = paper_folder / self.FILENAME
+        self._lock = threading.Lock()
+        self._entries = {}
+        if resume:
+            self._load()
+        else:
+            # 新的运行：清空旧日志（大纲可能已变化）
+            self.path.write_text("", encoding="utf-8")
+    
+    @staticmethod
+    def _key(section_idx: int, question_idx: int, question: str) -> tuple:
+        # 包含问题文本，防止大纲变化后错配
+        return (section_idx, question_idx, question)
+    
+    def _load(self):
+        try:
+            lines = self.path.read_text(encoding="utf-8").splitlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                entry = json.loads(line)
+                key = self._key(entry["section_idx"], entry["question_idx"], entry["question"])
+            except (ValueError, KeyError, TypeError):
+                # 运行中断时最后一行可能不完整
+                continue
+            self._entries[key] = entry["answer"]
+    
+    def get(self, section_idx: int, question_idx: int, question: str) -> Optional[str]:
+        return self._entries.get(self._key(section_idx, question_idx, question))
+    
+    def record(self, section_idx: int, question_idx: int, question: str, answer: str):
+        """记录一个已完成的子问题（立即刷盘）"""
+        line = json.dumps({"section_idx": section_idx, "question_idx": question_idx,
+                           "question": question, "answer": answer}, ensure_ascii=False)
+        with self._lock:
+            self._entries[self._key(section_idx, question_idx, question)] = answer
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+    
+    def __len__(self) -> int:
+        return len(self._entries)
 
-def main():
-    parser = argparse.ArgumentParser(description="Paper to Obsidian Workflow")
-    parser.add_argument("--pdf", required=True, help="Path to PDF file")
-    parser.add_argument("--vault", required=True, help="Path to Obsidian Vault Root")
-    parser.add_argument("--include_appendix", action="store_true", help="Include appendix in analysis")
-    args = parser.parse_args()
+class AnalystScheduler:
+    """
+    并发执行所有section的子问题（有界线程池），并按大纲顺序确定性地写入spoke note
+    页面图片在请求开始前才渲染（持FITZ_LOCK，fitz.Document不是线程安全的），不在内存中预先保存所有section的图片；
+    同一section的多个子问题由PageImageCache命中
+    """
+    
+    def __init__(self, analyst: AnalystAgent, file_manager: FileManager, paper_folder: Path, paper_slug: str,
+                 max_workers: int = ANALYST_CONCURRENCY, journal: Optional[AnalysisJournal] = None,
+                 batch_questions: bool = False, pdf_proc=None):
+        self.analyst = analyst
+        self.pdf_proc = pdf_proc
+        self.file_manager = file_manager
+        self.paper_folder = paper_folder
+        self.paper_slug = paper_slug
+        self.max_workers = max(1, max_workers)
+        self.journal = journal
+        # 批量模式：一个section的所有未完成子问题合并为一次请求
+        self.batch_questions = batch_questions
+    
+    def _draft_path(self, job: dict, question_idx: int) -> Optional[Path]:
+        """流式模式下子问题的实时草稿文件（写入spoke note后删除）"""
+        if not getattr(self.analyst, "stream", False):
+            return None
+        drafts_dir = self.paper_folder / "_drafts"
+        drafts_dir.mkdir(exist_ok=True)
+        clean_slug = sanitize_obsidian_filename(job["section"].filename_slug) or "untitled"
+        return drafts_dir / f"{self.paper_slug}_{clean_slug}_{job['section_idx']}_sub-q{question_idx}.md"
+    
+    def _render_image(self, job: dict) -> str:
+        with FITZ_LOCK:
+            return self.pdf_proc.get_page_image(job["page"], clip=job["region"])
+    
+    def _analyze_batch(self, job: dict, question_indices: List[int], label: str) -> List[str]:
+        section = job["section"]
+        sub_questions = [section.sub_questions[idx - 1] for idx in question_indices]
+        answers = self.analyst.analyze_section_batch(
+            self._render_image(job), sub_questions, [f"sub-q{idx}" for idx in question_indices],
+            section_type=section.type, image_mime=job["image_mime"], label=label
+        )
+        if self.journal is not None:
+            for idx, sub_q, answer in zip(question_indices, sub_questions, answers):
+                if AnalystAgent.SKIPPED_MARKER not in answer:
+                    self.journal.record(job["section_idx"], idx, sub_q.question, answer)
+        return answers
+    
+    def _analyze(self, job: dict, sub_q: SubQuestion, question_idx: int, label: str) -> str:
+        answer = self.analyst.analyze_section(
+            self._render_image(job), sub_q, section_type=job["section"].type, image_mime=job["image_mime"], label=label,
+            draft_path=self._draft_path(job, question_idx)
+        )
+        if self.journal is not None and AnalystAgent.SKIPPED_MARKER not in answer:
+            self.journal.record(job["section_idx"], question_idx, sub_q.question, answer)
+        return answer
+    
+    @staticmethod
+    def _fan_out(batch_future, slots: list):
+        """把批量请求的结果（或异常/取消）分发到各子问题的占位Future"""
+        # 出错时run()可能已取消了占位Future
+        slots = [slot for slot in slots if not slot.done()]
+        if batch_future.cancelled():
+            for slot in slots:
+                slot.cancel()
+            return
+        error = batch_future.exception()
+        if error is not None:
+            for slot in slots:
+                slot.set_exception(error)
+            return
+        for slot, answer in zip(slots, batch_future.result()):
+            slot.set_result(answer)
+    
+    def _record_early(self, future, job: dict, question_idx: int, question: str):
+        """提前分析的答案完成后以最终大纲中的序号记入断点日志"""
+        if self.journal is None or future.cancelled() or future.exception() is not None:
+            return
+        answer = future.result()
+        if AnalystAgent.SKIPPED_MARKER not in answer:
+            self.journal.record(job["section_idx"], question_idx, question, answer)
+    
+    def run(self, jobs: List[dict], early_answers: Optional[dict] = None, executor=None):
+        """
+        Args:
+            jobs: 按大纲顺序排列的 [{"section": SectionIntent, "section_idx": int, "page": int, "region": Optional[tuple],
+                  "image_mime": str}, ...]
+                  section_idx为section在大纲中的序号（断点日志的键）；page/region为分析图片的位置（请求开始时渲染）
+            early_answers: 提前分析（--early-analysis）已绑定的子问题 {(section_idx, question_idx): Future}，直接复用
+            executor: 共用的线程池（提前分析的线程池，保证同时进行的Analyst调用不超过并发数），由调用方关闭；
+                      为None时本次运行新建一个
+        """
+        from concurrent.futures import Future, ThreadPoolExecutor
+        from contextlib import nullcontext
+        
+        total_questions = sum(len(job["section"].sub_questions) for job in jobs)
+        print(f"🚀 并发分析: {len(jobs)}个section，{total_questions}个子问题，并发数{self.max_workers}")
+        
+        if executor is None:
+            executor_context = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="analyst")
+        else:
+            executor_context = nullcontext(executor)
+        with executor_context as executor:
+            # 1. 一次性提交所有子问题，线程池负责限制并发；断点日志中已完成的问题直接复用
+            section_futures = []
+            resumed = 0
+            reused = 0
+            for job_idx, job in enumerate(jobs, 1):
+                section = job["section"]
+                futures = []
+                batch_indices = []
+                for idx, sub_q in enumerate(section.sub_questions, 1):
+                    done = self.journal.get(job["section_idx"], idx, sub_q.question) if self.journal else None
+                    if done is not None:
+                        future = Future()
+                        future.set_result(done)
+                        futures.append(future)
+                        resumed += 1
+                        continue
+                    early = (early_answers or {}).get((job["section_idx"], idx))
+                    if early is not None:
+                        early.add_done_callback(
+                            lambda f, job=job, idx=idx, question=sub_q.question: self._record_early(f, job, idx, question)
+                        )
+                        futures.append(early)
+                        reused += 1
+                        continue
+                    if self.batch_questions:
+                        # 先占位，批量请求完成后统一填充
+                        futures.append(Future())
+                        batch_indices.append(idx)
+                        continue
+                    label = f"[{job_idx}/{len(jobs)} Q{idx}] "
+                    futures.append(executor.submit(self._analyze, job, sub_q, idx, label))
+                if batch_indices:
+                    batch_future = executor.submit(self._analyze_batch, job, batch_indices, f"[{job_idx}/{len(jobs)}] ")
+                    batch_future.add_done_callback(
+                        lambda bf, slots=[futures[idx - 1] for idx in batch_indices]: self._fan_out(bf, slots)
+                    )
+                section_futures.append(futures)
+            if resumed:
+                print(f"♻️ 断点续跑: 跳过{resumed}/{total_questions}个已完成的子问题")
+            if reused:
+                print(f"⚡ 提前分析: 复用{reused}/{total_questions}个子问题的答案")
+            
+            # 2. 按大纲顺序收集结果并写入，保证输出与串行执行一致
+            try:
+                for job, futures in zip(jobs, section_futures):
+                    section = job["section"]
+                    all_analyses = []
+                    for idx, (sub_q, future) in enumerate(zip(section.sub_questions, futures), 1):
+                        all_analyses.append({
+                            'question': sub_q.question,
+                            'answer': future.result(),
+                            'anchor_id': f"sub-q{idx}"
+                        })
+                    self.file_manager.write_spoke_note(section, all_analyses, self.paper_folder, self.paper_slug)
+                    print(f"Saved: {self.paper_slug}_{section.filename_slug}.md")
+                    for idx in range(1, len(section.sub_questions) + 1):
+                        draft_path = self._draft_path(job, idx)
+                        if draft_path is not None:
+                            draft_path.unlink(missing_ok=True)
+            except BaseException:
+                # 出错或中断时取消尚未开始的请求
+                for futures in section_futures:
+                    for future in futures:
+                        future.cancel()
+                raise
+        
+        # 所有草稿都已写入spoke note，删除空的草稿目录
+        drafts_dir = self.paper_folder / "_drafts"
+        if drafts_dir.is_dir() and not any(drafts_dir.iterdir()):
+            drafts_dir.rmdir()
 
-    api_key = os.getenv("OPENROUTER_API_KEY")
-    if not api_key:
-        print("Error: OPENROUTER_API_KEY not found in environment.")
-        return
+class EarlyAnalysisPool:
+    """
+    提前分析（--early-analysis，配合--stream-pages）：Architect批次按顺序完成后，立即对截至该批次
+    去重后的section子问题调用Analyst，不等后续页面的OCR和大纲生成
+    
+    后续批次的合并可能替换section（页码/类型随之改变）、新增或删除问题，因此答案不按section序号保存，
+    而是按 (问题文本, 问题类型, section类型, 页码, 裁剪区域) 保存；最终大纲确定后由claim()晚绑定：
+    键一致的子问题复用答案，其余（后续合并新增或发生变化的问题）交给调度器正常分析，
+    未被认领的答案为孤立答案：尚未开始的请求取消，已完成的写入 orphaned_answers.jsonl 并报告
+    线程池由之后的AnalystScheduler共用，两个阶段合计的并发调用数不超过max_workers
+    提前的请求总是逐题进行：答案按问题晚绑定，因此不使用--batch-questions的合并请求；
+    --stream时照常流式生成并在超限时中止，但不写草稿（草稿文件按最终大纲的section序号命名）
+    """
+    
+    ORPHANS_FILENAME = "orphaned_answers.jsonl"
+    
+    def __init__(self, analyst: AnalystAgent, pdf_proc, figures_list: List[dict], image_mime: str,
+                 max_workers: int = ANALYST_CONCURRENCY):
+        from concurrent.futures import ThreadPoolExecutor
+        self.analyst = analyst
+        self.pdf_proc = pdf_proc
+        self.figures_list = figures_list
+        self.image_mime = image_mime
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="analyst")
+        self._sections = []   # 已完成批次的原始section（按批次顺序）
+        self._futures = {}    # key -> Future
+        self._claimed = set()
+        self._orphans = []
+        self._orphans_lock = threading.Lock()
+        self.reported = False
+    
+    @staticmethod
+    def answer_key(section: SectionIntent, sub_q: SubQuestion, page: int, region: Optional[tuple]) -> tuple:
+        # 同一问题、同一图片、同一提示词（类型决定字数要求与提示）才能复用答案
+        return (sub_q.question, sub_q.question_type, section.type, page, tuple(region) if region else None)
+    
+    def _analyze(self, page: int, region: Optional[tuple], sub_q: SubQuestion, section_type: str, label: str) -> str:
+        # 与AnalystScheduler._render_image一致：请求开始时才在工作线程中渲染，排队的请求不持有图片
+        with FITZ_LOCK:
+            image_b64 = self.pdf_proc.get_page_image(page, clip=region)
+        return self.analyst.analyze_section(image_b64, sub_q, section_type=section_type,
+                                            image_mime=self.image_mime, label=label)
+    
+    def add_outline(self, outline: Outline, equations_list: List[dict]):
+        """
+        收到下一个批次的大纲（按批次顺序，在主线程中调用）：对截至当前批次的全部section去重，
+        为尚未提交的子问题提交Analyst（图片由工作线程在请求开始时渲染，不阻塞页面消费）
+        去重在副本上进行（merge会修改section），不影响最终大纲的合并结果
+        """
+        self._sections.extend(outline.sections)
+        prefix = [section.model_copy(deep=True) for section in self._sections]
+        submitted = 0
+        for section in deduplicate_sections(prefix, verbose=False):
+            if not section.target_pages:
+                continue
+            with FITZ_LOCK:
+                page, region = section_image_target(section, self.pdf_proc.doc, self.figures_list, equations_list)
+            for sub_q in section.sub_questions:
+                key = self.answer_key(section, sub_q, page, region)
+                if key in self._futures:
+                    continue
+                label = f"[提前 {len(self._futures) + 1}] "
+                self._futures[key] = self.executor.submit(self._analyze, page, region, sub_q, section.type, label)
+                submitted += 1
+        if submitted:
+            print(f"  ⚡ 提前分析: 提交{submitted}个子问题（累计{len(self._futures)}个）")
+    
+    def claim(self, section: SectionIntent, sub_q: SubQuestion, page: int, region: Optional[tuple]):
+        """最终大纲中的子问题认领提前分析的答案，返回Future；没有对应答案时返回None"""
+        key = self.answer_key(section, sub_q, page, region)
+        future = self._futures.get(key)
+        if future is None or future.cancelled():
+            return None
+        self._claimed.add(key)
+        return future
+    
+    def release_unclaimed(self):
+        """认领结束：取消尚未开始的孤立请求，已在进行中的留待report_orphans报告"""
+        cancelled = 0
+        for key, future in self._futures.items():
+            if key in self._claimed:
+                continue
+            if future.cancel():
+                cancelled += 1
+            else:
+                self._orphans.append((key, future))
+        claimed = len(self._claimed)
+        print(f"⚡ 提前分析对账: {claimed}/{len(self._futures)}个答案绑定到最终大纲，"
+              f"{len(self._orphans)}个孤立（取消了{cancelled}个未开始的请求）")
+    
+    def _write_orphan(self, path: Path, key: tuple, future):
+        """孤立请求结束时追加一行（在完成请求的线程中调用）"""
+        if future.cancelled() or future.exception() is not None:
+            return
+        question, question_type, section_type, page, region = key
+        line = json.dumps({"question": question, "question_type": question_type, "section_type": section_type,
+                           "page": page, "region": list(region) if region else None,
+                           "answer": future.result()}, ensure_ascii=False)
+        with self._orphans_lock:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+    
+    def report_orphans(self, paper_folder: Path, wait: bool = True):
+        """
+        把孤立答案写入orphaned_answers.jsonl（不进入笔记），避免已付费的结果丢失
+        wait=False时不等待进行中的请求：已完成的立即写入，其余在请求结束时追加
+        """
+        from concurrent.futures import wait as wait_futures
+        self.reported = True
+        if not self._orphans:
+            return
+        path = paper_folder / self.ORPHANS_FILENAME
+        path.write_text("", encoding="utf-8")
+        for key, future in self._orphans:
+            future.add_done_callback(lambda f, key=key: self._write_orphan(path, key, f))
+        if wait:
+            wait_futures([future for _, future in self._orphans])
+        print(f"⚠️ 提前分析: {len(self._orphans)}个答案未进入笔记，已保存到 {path}"
+              + ("" if wait else "（进行中的请求结束后追加）"))
+        for key, _ in self._orphans:
+            preview = key[0][:60] + "..." if len(key[0]) > 60 else key[0]
+            print(f"   - (第{key[3] + 1}页) {preview}")
+    
+    def abort(self, paper_folder: Path):
+        """
+        分析阶段中止或出错时调用：所有答案视为孤立（已认领的也可能未写入笔记），
+        取消尚未开始的请求，不等待进行中的请求，其答案结束时追加到orphaned_answers.jsonl
+        """
+        self._orphans = [(key, future) for key, future in self._futures.items() if not future.cancel()]
+        self.report_orphans(paper_folder, wait=False)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+    
+    def close(self):
+        """正常结束：取消尚未开始的请求并等待进行中的请求结束"""
+        self.executor.shutdown(wait=True, cancel_futures=True)
 
-    client = OpenAI(
-        base_url=OPENROUTER_BASE_URL,
-        api_key=api_key,
-    )
+# --- Main Workflow ---
 
-    pdf_path = Path(args.pdf)
+def prepare_paper(pdf_path: Path, args, marker_session: Optional[MarkerSession] = None,
+                  worker_pool: Optional[MarkerWorkerPool] = None, stream_pages: bool = False) -> dict:
+    """
+    论文的本地处理阶段：文本提取（Marker OCR / PyMuPDF）、图表与公式扫描、视觉元素分组
+    不调用LLM API；批量模式下在后台线程中执行，与上一篇论文的分析阶段重叠
+    stream_pages=True（仅Marker）时只启动后台OCR并扫描图表，立即返回；
+    页面文本、公式清单和分组由analyze阶段的consume_page_stream边识别边补全
+    返回分析阶段使用的上下文（其中pdf_proc / doc_registry由finish_paper关闭）
+    """
+    metrics = RunMetrics()
     vault_root = Path(args.vault)
     
     # Create folder for this paper
@@ -1932,132 +4636,247 @@ def main():
 
     print(f"正在处理 {pdf_path.name}...")
     
-    # 1. Ingestion & Figure Scanning - 根据配置选择PDF处理器
-    if USE_MARKER:
-        print("🔬 使用Marker处理器（支持公式识别）")
-        pdf_proc = MarkerProcessor(str(pdf_path))
+    # 本次运行共享的PDF句柄注册表：各组件借用同一个fitz.Document
+    doc_registry = DocumentRegistry()
+    # 页面图片缓存：多个section指向同一页时避免重复渲染
+    image_cache = PageImageCache(spill_dir=args.image_spill_dir, spill_max_mb=args.image_spill_max_mb)
+    image_encoder = ImageEncoder(fmt=args.image_format, quality=args.image_quality,
+                                 max_dim=args.image_max_dim, dpi=args.image_dpi)
+    
+    # 中途出错（含Ctrl+C）时由这里关闭已打开的PDF句柄与后台OCR；正常返回后由finish_paper负责
+    pdf_proc = None
+    page_stream = None
+    try:
+        # 1. Ingestion & Figure Scanning - 根据配置选择PDF处理器
+        stage_start = time.perf_counter()
+        if USE_MARKER:
+            print("🔬 使用Marker处理器（支持公式识别）")
+            ocr_cache = None if args.no_ocr_cache else OCRCache()
+            pdf_proc = MarkerProcessor(str(pdf_path), page_window=args.page_window, ocr_cache=ocr_cache,
+                                       ocr_workers=args.ocr_workers, registry=doc_registry,
+                                       image_cache=image_cache, image_encoder=image_encoder,
+                                       session=marker_session, worker_pool=worker_pool)
         
-        # Marker模式：逐页识别整个PDF
-        all_pages_text = pdf_proc.get_all_text_by_pages()
-    else:
-        print("⚡ 使用PyMuPDF处理器（快速模式）")
-        pdf_proc = PDFProcessor(str(pdf_path))
-        
-        # PyMuPDF模式：逐页提取（为了统一接口）
-        all_pages_text = []
-        for i in range(len(pdf_proc.doc)):
-            all_pages_text.append(pdf_proc.doc[i].get_text())
-        print(f"✅ 提取了{len(all_pages_text)}页文本")
-    
-    # NEW: Scan all figures first
-    print("📊 图表扫描: 正在识别PDF中的所有图表...")
-    figure_scanner = FigureScanner(str(pdf_path))
-    figures_list = figure_scanner.scan_all_figures()
-    figure_scanner.close()
-    print(f"✅ 检测到 {len(figures_list)} 个图表/表格")
-    
-    # NEW: Scan all equations (only if using Marker)
-    equations_list = []
-    if USE_MARKER:
-        print("🔢 公式扫描: 正在识别Marker输出中的所有公式...")
-        equation_scanner = EquationScanner(all_pages_text)
-        equations_list = equation_scanner.scan_all_equations()
-        print(f"✅ 检测到 {len(equations_list)} 个公式")
-        if equations_list:
-            numbered_count = sum(1 for eq in equations_list if eq['equation_type'] == 'numbered')
-            unnumbered_count = sum(1 for eq in equations_list if eq['equation_type'] == 'unnumbered')
-            print(f"   - 编号公式: {numbered_count}")
-            print(f"   - 重要未编号公式: {unnumbered_count}")
-    else:
-        print("ℹ️  公式扫描: PyMuPDF模式不支持公式识别，跳过公式扫描")
+            if stream_pages:
+                # 流水线模式：后台线程逐页识别，下游按页码顺序消费（队列满时OCR暂停）
+                print(f"🚰 流水线模式: 后台OCR，最多领先下游{args.page_queue_size}页")
+                page_stream = PageStream(pdf_proc.iter_pages(), maxsize=args.page_queue_size)
+                all_pages_text = None
+            else:
+                # Marker模式：逐页识别整个PDF
+                all_pages_text = pdf_proc.get_all_text_by_pages()
+                metrics.record_ocr(pdf_proc.page_timings, cached_pages=pdf_proc.cached_pages,
+                                       session_setup_seconds=pdf_proc.session_setup_seconds)
+        else:
+            print("⚡ 使用PyMuPDF处理器（快速模式）")
+            with FITZ_LOCK:
+                pdf_proc = PDFProcessor(str(pdf_path), registry=doc_registry, image_cache=image_cache,
+                                        image_encoder=image_encoder)
+            
+                # PyMuPDF模式：逐页提取（为了统一接口）
+                all_pages_text = []
+                for i in range(len(pdf_proc.doc)):
+                    all_pages_text.append(pdf_proc.doc[i].get_text())
+            print(f"✅ 提取了{len(all_pages_text)}页文本")
+        if page_stream is None:
+            metrics.add_stage("text_extraction", time.perf_counter() - stage_start)
     
-    # NEW: 智能分组视觉元素
-    print("🔗 智能分组: 正在对图表和公式进行智能分组...")
-    visual_groups = group_visual_elements(figures_list, equations_list)
+        # NEW: Scan all figures first
+        stage_start = time.perf_counter()
+        print("📊 图表扫描: 正在识别PDF中的所有图表...")
+        with FITZ_LOCK:
+            figure_scanner = FigureScanner(str(pdf_path), registry=doc_registry)
+            figures_list = figure_scanner.scan_all_figures()
+            figure_scanner.close()
+        print(f"✅ 检测到 {len(figures_list)} 个图表/表格")
+        metrics.add_stage("figure_scan", time.perf_counter() - stage_start)
     
-    # 打印分组统计
-    if visual_groups:
-        fig_groups = visual_groups.get("figure_groups", [])
-        eq_groups = visual_groups.get("equation_groups", [])
+        # NEW: Scan all equations (only if using Marker)
+        stage_start = time.perf_counter()
+        equations_list = []
+        if page_stream is not None:
+            # 流水线模式：公式扫描与分组随页面到达在consume_page_stream中进行
+            print("🔢 公式扫描: 流水线模式下随OCR逐页进行")
+        elif USE_MARKER:
+            print("🔢 公式扫描: 正在识别Marker输出中的所有公式...")
+            with FITZ_LOCK:
+                equation_scanner = EquationScanner(all_pages_text, doc=pdf_proc.doc)
+                equations_list = equation_scanner.scan_all_equations()
+            print(f"✅ 检测到 {len(equations_list)} 个公式")
+            if equations_list:
+                numbered_count = sum(1 for eq in equations_list if eq['equation_type'] == 'numbered')
+                unnumbered_count = sum(1 for eq in equations_list if eq['equation_type'] == 'unnumbered')
+                print(f"   - 编号公式: {numbered_count}")
+                print(f"   - 重要未编号公式: {unnumbered_count}")
+        else:
+            print("ℹ️  公式扫描: PyMuPDF模式不支持公式识别，跳过公式扫描")
+        metrics.add_stage("equation_scan", time.perf_counter() - stage_start)
+    
+        # NEW: 智能分组视觉元素
+        stage_start = time.perf_counter()
+        visual_groups = None
+        if page_stream is None:
+            print("🔗 智能分组: 正在对图表和公式进行智能分组...")
+            visual_groups = group_visual_elements(figures_list, equations_list)
+            metrics.add_stage("grouping", time.perf_counter() - stage_start)
+    
+        # 打印分组统计
+        if visual_groups:
+            fig_groups = visual_groups.get("figure_groups", [])
+            eq_groups = visual_groups.get("equation_groups", [])
         
-        if fig_groups:
-            subfig_count = sum(1 for g in fig_groups if g['group_type'] == 'subfigures')
-            print(f"   - 图表分组: {len(fig_groups)}个组")
-            if subfig_count > 0:
-                print(f"     * 子图组: {subfig_count}个")
+            if fig_groups:
+                subfig_count = sum(1 for g in fig_groups if g['group_type'] == 'subfigures')
+                print(f"   - 图表分组: {len(fig_groups)}个组")
+                if subfig_count > 0:
+                    print(f"     * 子图组: {subfig_count}个")
         
-        if eq_groups:
-            related_count = sum(1 for g in eq_groups if g['group_type'] == 'related')
-            total_eqs_in_groups = sum(len(g['items']) for g in eq_groups if g['group_type'] == 'related')
-            print(f"   - 公式分组: {len(eq_groups)}个组")
-            if related_count > 0:
-                avg_group_size = total_eqs_in_groups / related_count if related_count > 0 else 0
-                print(f"     * 关联组: {related_count}个 (平均每组{avg_group_size:.1f}个公式)")
+            if eq_groups:
+                related_count = sum(1 for g in eq_groups if g['group_type'] == 'related')
+                total_eqs_in_groups = sum(len(g['items']) for g in eq_groups if g['group_type'] == 'related')
+                print(f"   - 公式分组: {len(eq_groups)}个组")
+                if related_count > 0:
+                    avg_group_size = total_eqs_in_groups / related_count if related_count > 0 else 0
+                    print(f"     * 关联组: {related_count}个 (平均每组{avg_group_size:.1f}个公式)")
+
+        return {
+            "pdf_path": pdf_path,
+            "paper_folder": paper_folder,
+            "paper_slug": paper_slug,
+            "metrics": metrics,
+            "doc_registry": doc_registry,
+            "image_cache": image_cache,
+            "image_encoder": image_encoder,
+            "pdf_proc": pdf_proc,
+            "page_stream": page_stream,
+            "all_pages_text": all_pages_text,
+            "figures_list": figures_list,
+            "equations_list": equations_list,
+            "visual_groups": visual_groups,
+        }
+    except BaseException:
+        if page_stream is not None:
+            page_stream.close()
+        with FITZ_LOCK:
+            if pdf_proc is not None:
+                pdf_proc.close()
+            doc_registry.close_all()
+        raise
+
+def analyze_prepared_paper(paper: dict, args, client: OpenAI, interactive: bool = True) -> bool:
+    """
+    论文的LLM分析阶段：Architect生成大纲 → 预览 → Analyst逐题分析并写入笔记
+    返回是否完成；不关闭paper中的资源（由finish_paper负责）
+    """
+    global RUN_METRICS
+    # 本阶段的API调用计入该论文的运行统计
+    RUN_METRICS = paper["metrics"]
+    paper_folder = paper["paper_folder"]
+    paper_slug = paper["paper_slug"]
+    pdf_proc = paper["pdf_proc"]
+    image_encoder = paper["image_encoder"]
+    vault_root = Path(args.vault)
 
-    # 2. Architect - 分批处理
-    print("架构师: 正在分批生成深度阅读大纲...")
-    architect = ArchitectAgent(client)
+    file_manager = FileManager(vault_root)
     
-    all_sections = []
+    # --resume: 复用上次保存的大纲，跳过Architect阶段
+    outline = file_manager.load_outline(paper_folder) if args.resume else None
+    
+    analyst = AnalystAgent(client, stream=args.stream, retry_context=args.retry_context)
+    
+    # 流水线模式：OCR仍在后台进行，边接收页面边扫描公式；需要生成大纲时同时边装箱边提交Architect
+    streamed_outlines = None
+    early_pool = None
+    if paper.get("page_stream") is not None:
+        architect = ArchitectAgent(client) if outline is None else None
+        if architect is not None and args.early_analysis:
+            # 前面的批次一完成就开始分析其section，答案在最终大纲确定后晚绑定（由finish_paper关闭）
+            early_pool = EarlyAnalysisPool(analyst, pdf_proc, paper["figures_list"], image_encoder.mime_type,
+                                           max_workers=args.analyst_concurrency)
+            paper["early_analysis"] = early_pool
+        try:
+            streamed_outlines = consume_page_stream(paper, args, architect,
+                                                    on_outline=early_pool.add_outline if early_pool else None)
+        except Exception as e:
+            print(f"架构师出错: {e}" if architect is not None else f"OCR出错: {e}")
+            return False
+    
+    all_pages_text = paper["all_pages_text"]
+    figures_list = paper["figures_list"]
+    equations_list = paper["equations_list"]
+    visual_groups = paper["visual_groups"]
+    
+    if outline is not None:
+        print(f"♻️ 断点续跑: 已加载保存的大纲 ({paper_folder / FileManager.OUTLINE_FILENAME})")
+    else:
+        if args.resume:
+            print("ℹ️  未找到已保存的大纲，将重新生成")
+        # 2. Architect - 分批处理
+        print("架构师: 正在分批生成深度阅读大纲...")
+        architect = ArchitectAgent(client)
+    
+        all_sections = []
 
     
-    try:
-        # 计算批次数
-        num_batches = (len(all_pages_text) + PAGES_PER_BATCH - 1) // PAGES_PER_BATCH
-        print(f"📚 共{len(all_pages_text)}页，将分{num_batches}批处理（每批{PAGES_PER_BATCH}页）")
-        
-        for batch_idx in range(num_batches):
-            start_idx = batch_idx * PAGES_PER_BATCH
-            end_idx = min((batch_idx + 1) * PAGES_PER_BATCH, len(all_pages_text))
-            
-            # 合并本批次的文本
-            batch_text = "\n\n---\n\n".join(all_pages_text[start_idx:end_idx])
-            
-            print(f"\n  批次 {batch_idx+1}/{num_batches}: 第{start_idx+1}-{end_idx}页")
-            
-            # 调用Architect生成本批次的大纲
-            batch_outline = architect.generate_outline(
-                batch_text, 
-                figures_list=figures_list if batch_idx == 0 else None,  # 只在第一批传入图表列表
-                equations_list=equations_list if batch_idx == 0 else None,  # 只在第一批传入公式列表
-                visual_groups=visual_groups if batch_idx == 0 else None,  # 只在第一批传入分组信息
-                include_appendix=args.include_appendix
-            )
+        try:
+            if streamed_outlines is None:
+                # 按token预算把页面装箱成批次，图表/公式清单随所在页面进入对应批次
+                batches = TokenBudgetBatcher.plan(all_pages_text, token_budget=args.architect_token_budget)
+                for batch in batches:
+                    attach_batch_inventory(batch, figures_list, equations_list, visual_groups)
+                print(f"📚 共{len(all_pages_text)}页，按token预算{args.architect_token_budget}分为{len(batches)}批"
+                      f"（并发数{args.architect_concurrency}）")
+                for batch_idx, batch in enumerate(batches):
+                    truncated_note = " ⚠️ 超出预算，将截断" if batch["truncated"] else ""
+                    print(f"  批次 {batch_idx+1}/{len(batches)}: 第{batch['start']+1}-{batch['end']}页，"
+                          f"约{batch['tokens']} tokens，{len(batch['figures_list'])}个图表，"
+                          f"{len(batch['equations_list'])}个公式{truncated_note}")
             
-            # 收集sections
-            all_sections.extend(batch_outline.sections)
-            print(f"  ✅ 生成了{len(batch_outline.sections)}个分析问题")
+                # 各批次相互独立，并发调用Architect；结果按批次顺序收集
+                stage_start = time.perf_counter()
+                batch_outlines = run_architect_batches(architect, batches, include_appendix=args.include_appendix,
+                                                       max_workers=args.architect_concurrency,
+                                                       token_budget=args.architect_token_budget)
+                RUN_METRICS.add_stage("architect", time.perf_counter() - stage_start)
+            else:
+                batch_outlines = streamed_outlines
+            for batch_outline in batch_outlines:
+                all_sections.extend(batch_outline.sections)
         
-        # 合并所有批次的结果
-        print(f"\n✅ 所有批次完成！共生成{len(all_sections)}个分析问题")
+            # 合并所有批次的结果
+            print(f"\n✅ 所有批次完成！共生成{len(all_sections)}个分析问题")
         
-        # 去重处理
-        unique_sections = deduplicate_sections(all_sections, figures_list)
+            # 去重处理
+            stage_start = time.perf_counter()
+            unique_sections = deduplicate_sections(all_sections, figures_list)
         
-        # 创建临时Outline for validation
-        temp_outline = Outline(
-            paper_title=batch_outline.paper_title,
-            summary=batch_outline.summary,
-            sections=unique_sections
-        )
+            # 创建临时Outline for validation
+            temp_outline = Outline(
+                paper_title=batch_outline.paper_title,
+                summary=batch_outline.summary,
+                sections=unique_sections
+            )
         
-        # 验证公式覆盖（如果有公式）
-        if equations_list:
-            temp_outline = validate_equation_coverage(temp_outline, equations_list)
+            # 验证公式覆盖（如果有公式）
+            if equations_list:
+                temp_outline = validate_equation_coverage(temp_outline, equations_list)
         
-        # 验证并补充优先问题
-        outline = validate_and_fix_priority_questions(temp_outline, figures_list)
+            # 验证并补充优先问题
+            outline = validate_and_fix_priority_questions(temp_outline, figures_list)
         
-        # Soft Structure Check
-        titles = [s.section_title.lower() for s in outline.sections]
-        imrad_keywords = ["intro", "method", "result", "discuss"]
-        missing = [k for k in imrad_keywords if not any(k in t for t in titles)]
-        if missing:
-             print(f"⚠️ [Structure Warning] 大纲似乎缺失核心章节: {missing}。但这可能是由于论文结构特殊。")
-    except Exception as e:
-        print(f"架构师出错: {e}")
-        pdf_proc.close()
-        return
+            # Soft Structure Check
+            titles = [s.section_title.lower() for s in outline.sections]
+            imrad_keywords = ["intro", "method", "result", "discuss"]
+            missing = [k for k in imrad_keywords if not any(k in t for t in titles)]
+            if missing:
+                 print(f"⚠️ [Structure Warning] 大纲似乎缺失核心章节: {missing}。但这可能是由于论文结构特殊。")
+            RUN_METRICS.add_stage("dedup_validation", time.perf_counter() - stage_start)
+        except Exception as e:
+            print(f"架构师出错: {e}")
+            return False
+
+        # 保存最终大纲，供中断后--resume使用
+        file_manager.save_outline(outline, paper_folder)
 
     print(f"计划已生成: 共 {len(outline.sections)} 个部分需要分析。")
     
@@ -2121,55 +4940,303 @@ def main():
     print(f"   - 文本分析: {text_sections} sections")
     print(f"   - 优先问题: {priority_questions} (是什么+原理)")
     
-    print("\n" + "="*80)
-    print("⏸️  预览完成。按 Ctrl+C 可中止，或等待5秒后自动继续...")
-    print("="*80)
-    
-    # 给用户5秒查看时间
-    import time
-    try:
-        time.sleep(5)
-    except KeyboardInterrupt:
-        print("\n\n⏹️  用户中止执行")
-        pdf_proc.close()
-        return
+    if interactive:
+        print("\n" + "="*80)
+        print("⏸️  预览完成。按 Ctrl+C 可中止，或等待5秒后自动继续...")
+        print("="*80)
+        
+        # 给用户5秒查看时间
+        try:
+            time.sleep(5)
+        except KeyboardInterrupt:
+            print("\n\n⏹️  用户中止执行")
+            return False
     
     print("\n▶️  开始执行分析...\n")
 
     # 3. Analyst loop
-    analyst = AnalystAgent(client)
-    file_manager = FileManager(vault_root)
     file_manager.write_hub_index(outline, paper_folder, paper_slug)
+    # 每完成一个子问题记入断点日志；--resume时跳过已完成的问题
+    journal = AnalysisJournal(paper_folder, resume=args.resume)
 
-    for section in outline.sections:
-        print(f"分析师: 正在深入分析 {section.section_title}...")
-        # Just grab the first target page for now for simplicity, or combine them
-        if not section.target_pages:
-            continue
+    # 在主线程中确定每个section的图片位置（页码+裁剪区域），图片由调度器在请求开始前渲染
+    stage_start = time.perf_counter()
+    jobs = []
+    # 提前分析的答案按 (问题, 图片位置) 绑定到最终大纲的子问题：(section_idx, question_idx) -> Future
+    early_answers = {}
+    with FITZ_LOCK:
+        for section_idx, section in enumerate(outline.sections, 1):
+            # Just grab the first target page for now for simplicity, or combine them
+            if not section.target_pages:
+                continue
             
-        target_page_idx = section.target_pages[0] 
-        # Safety check
-        if target_page_idx >= len(pdf_proc.doc):
-             target_page_idx = 0
-             
-        image_b64 = pdf_proc.get_page_image(target_page_idx)
-        
-        # Process all sub_questions (2-4 questions per section)
-        all_analyses = []
-        for idx, sub_q in enumerate(section.sub_questions, 1):
-            print(f"  Sub-Question {idx}/{len(section.sub_questions)} ({sub_q.question_type}): {sub_q.question[:50]}...")
-            analysis_content = analyst.analyze_section(image_b64, sub_q, section_type=section.type)
-            all_analyses.append({
-                'question': sub_q.question,
-                'answer': analysis_content,
-                'anchor_id': f"sub-q{idx}"
+            target_page_idx, region = section_image_target(section, pdf_proc.doc, figures_list, equations_list)
+            if early_pool is not None:
+                for idx, sub_q in enumerate(section.sub_questions, 1):
+                    future = early_pool.claim(section, sub_q, target_page_idx, region)
+                    if future is not None:
+                        early_answers[(section_idx, idx)] = future
+            
+            if region:
+                print(f"  ✂️ {section.section_title} 裁剪区域: {region}")
+            jobs.append({
+                "section": section,
+                "section_idx": section_idx,
+                "page": target_page_idx,
+                "region": region,
+                "image_mime": image_encoder.mime_type,
             })
-        
-        file_manager.write_spoke_note(section, all_analyses, paper_folder, paper_slug)
-        print(f"Saved: {paper_slug}_{section.filename_slug}.md")
+    if early_pool is not None:
+        early_pool.release_unclaimed()
+    
+    RUN_METRICS.add_stage("image_targets", time.perf_counter() - stage_start)
+    
+    stage_start = time.perf_counter()
+    scheduler = AnalystScheduler(analyst, file_manager, paper_folder, paper_slug,
+                                 max_workers=args.analyst_concurrency, journal=journal,
+                                 batch_questions=args.batch_questions, pdf_proc=pdf_proc)
+    # 提前分析的线程池由调度器共用，同时进行的Analyst调用不超过--analyst-concurrency
+    scheduler.run(jobs, early_answers=early_answers, executor=early_pool.executor if early_pool else None)
+    RUN_METRICS.add_stage("analyst", time.perf_counter() - stage_start)
+    if early_pool is not None:
+        early_pool.report_orphans(paper_folder)
+    return True
+
+def finish_paper(paper: dict):
+    """关闭论文占用的PDF句柄/临时文件，写出run_report.json并打印统计"""
+    # 流水线模式下分析阶段未消费页面流（如提前出错）时，先停止后台OCR
+    page_stream = paper.pop("page_stream", None)
+    if page_stream is not None:
+        page_stream.close()
+    # 提前分析：正常结束时孤立答案已报告；中止（预览阶段Ctrl+C）或出错时不等待进行中的付费请求，
+    # 所有答案作为孤立答案保存，避免丢失
+    early_pool = paper.pop("early_analysis", None)
+    if early_pool is not None:
+        if early_pool.reported:
+            early_pool.close()
+        else:
+            early_pool.abort(paper["paper_folder"])
+    with FITZ_LOCK:
+        paper["pdf_proc"].close()
+        paper["doc_registry"].close_all()
+    print(f"📂 {paper['doc_registry'].summary()}")
+    print(f"🖼️ {paper['image_cache'].summary()}")
+    report_path = paper["metrics"].write_report(paper["paper_folder"])
+    print(f"\n📈 运行统计（详见 {report_path}）")
+    print(paper["metrics"].summary_table())
+
+def process_paper(pdf_path: Path, args, client: OpenAI, marker_session: Optional[MarkerSession] = None,
+                  worker_pool: Optional[MarkerWorkerPool] = None, interactive: bool = True) -> bool:
+    """处理单篇论文（本地处理 + LLM分析），返回是否完成"""
+    paper = prepare_paper(pdf_path, args, marker_session=marker_session, worker_pool=worker_pool,
+                          stream_pages=args.stream_pages)
+    try:
+        return analyze_prepared_paper(paper, args, client, interactive=interactive)
+    finally:
+        finish_paper(paper)
+
+def collect_batch_pdfs(args) -> List[Path]:
+    """解析--pdf-dir / --manifest得到待处理的PDF列表（保持顺序，去重）"""
+    if args.pdf_dir:
+        pdf_paths = sorted(Path(args.pdf_dir).glob("*.pdf"))
+    else:
+        manifest = Path(args.manifest)
+        pdf_paths = []
+        for line in manifest.read_text(encoding="utf-8").splitlines():
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            path = Path(line).expanduser()
+            # 相对路径相对于manifest所在目录
+            pdf_paths.append(path if path.is_absolute() else manifest.parent / path)
+    return list(dict.fromkeys(pdf_paths))
+
+def run_batch(pdf_paths: List[Path], args, client: OpenAI) -> List[dict]:
+    """
+    批量处理多篇论文
+    - Marker模型（或OCR工作进程池）只加载一次，所有论文共享
+    - 流水线：第N篇做LLM分析时，后台线程已在做第N+1篇的OCR和扫描
+    - 单篇失败不影响其余论文，最后打印每篇的状态汇总
+    - 论文间已经重叠OCR与分析，因此不使用--stream-pages的页面流水线
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    
+    marker_session = None
+    worker_pool = None
+    if USE_MARKER:
+        if args.ocr_workers > 1:
+            worker_pool = MarkerWorkerPool(args.ocr_workers)
+        else:
+            marker_session = MarkerSession()
+    
+    def prepare(pdf_path: Path) -> dict:
+        started = time.perf_counter()
+        paper = prepare_paper(pdf_path, args, marker_session=marker_session, worker_pool=worker_pool)
+        paper["prepare_seconds"] = time.perf_counter() - started
+        return paper
+    
+    results = []
+    print(f"📚 批量模式: 共{len(pdf_paths)}篇论文")
+    try:
+        # 单线程的后台执行器：同一时刻只预处理一篇，天然提供背压
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="prepare") as prepare_executor:
+            future = next_future = None
+            try:
+                next_future = prepare_executor.submit(prepare, pdf_paths[0]) if pdf_paths else None
+                for idx, pdf_path in enumerate(pdf_paths):
+                    future = next_future
+                    next_future = prepare_executor.submit(prepare, pdf_paths[idx + 1]) if idx + 1 < len(pdf_paths) else None
+                
+                    print(f"\n{'='*80}\n📄 [{idx+1}/{len(pdf_paths)}] {pdf_path.name}\n{'='*80}")
+                    status = {"pdf": str(pdf_path), "status": "failed", "error": None,
+                              "prepare_seconds": None, "analyze_seconds": None}
+                    try:
+                        paper = future.result()
+                    except Exception as e:
+                        print(f"❌ {pdf_path.name} 预处理失败: {e}")
+                        status["error"] = f"prepare: {e}"
+                        results.append(status)
+                        continue
+                    # 此后该论文由下面的finally负责清理
+                    future = None
+                
+                    status["prepare_seconds"] = round(paper["prepare_seconds"], 1)
+                    started = time.perf_counter()
+                    try:
+                        completed = analyze_prepared_paper(paper, args, client, interactive=False)
+                        status["status"] = "ok" if completed else "failed"
+                        if not completed:
+                            status["error"] = "analysis aborted"
+                    except Exception as e:
+                        print(f"❌ {pdf_path.name} 分析失败: {e}")
+                        status["error"] = f"analyze: {e}"
+                    finally:
+                        status["analyze_seconds"] = round(time.perf_counter() - started, 1)
+                        try:
+                            finish_paper(paper)
+                        except Exception as e:
+                            print(f"⚠️ {pdf_path.name} 清理失败: {e}")
+                    results.append(status)
+            except BaseException:
+                # 中断（如Ctrl+C）逃出循环时，已在后台预处理完的论文同样要关闭PDF句柄并写出统计
+                for pending in (future, next_future):
+                    if pending is None or pending.cancel():
+                        continue
+                    try:
+                        finish_paper(pending.result())
+                    except Exception as e:
+                        print(f"⚠️ 预处理中的论文清理失败: {e}")
+                raise
+    finally:
+        if worker_pool is not None:
+            worker_pool.close()
+        if marker_session is not None:
+            marker_session.close()
+    
+    print(f"\n{'='*80}\n📋 批量处理汇总\n{'='*80}")
+    print(f"{'状态':<6}{'预处理(秒)':>12}{'分析(秒)':>10}  论文")
+    for status in results:
+        mark = "✅" if status["status"] == "ok" else "❌"
+        prepare_str = f"{status['prepare_seconds']:.1f}" if status["prepare_seconds"] is not None else "-"
+        analyze_str = f"{status['analyze_seconds']:.1f}" if status["analyze_seconds"] is not None else "-"
+        line = f"{mark:<6}{prepare_str:>12}{analyze_str:>10}  {Path(status['pdf']).name}"
+        if status["error"]:
+            line += f"  ({status['error']})"
+        print(line)
+    succeeded = sum(1 for status in results if status["status"] == "ok")
+    print(f"完成 {succeeded}/{len(results)} 篇")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Paper to Obsidian Workflow")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--pdf", help="Path to PDF file")
+    source.add_argument("--pdf-dir", help="Process every PDF in this directory (batch mode)")
+    source.add_argument("--manifest", help="Text file listing one PDF path per line (batch mode; '#' starts a comment)")
+    parser.add_argument("--vault", required=True, help="Path to Obsidian Vault Root")
+    parser.add_argument("--include_appendix", action="store_true", help="Include appendix in analysis")
+    parser.add_argument("--page-window", type=int, default=MARKER_PAGE_WINDOW,
+                        help="Pages per Marker conversion call (0 = auto from free RAM/VRAM, 1 = page-by-page)")
+    parser.add_argument("--no-ocr-cache", action="store_true", help="Ignore and do not update the on-disk Marker OCR cache")
+    parser.add_argument("--ocr-workers", type=int, default=OCR_WORKERS,
+                        help="Number of Marker OCR worker processes (CPU servers); 0/1 = convert in-process")
+    parser.add_argument("--image-spill-dir", default=PAGE_IMAGE_SPILL_DIR,
+                        help="Spill page images evicted from the in-memory cache to this directory")
+    parser.add_argument("--image-spill-max-mb", type=int, default=PAGE_IMAGE_SPILL_MAX_MB,
+                        help="Size cap of the image spill directory; least recently used images are deleted beyond it")
+    parser.add_argument("--image-format", default=IMAGE_FORMAT, choices=["png", "jpeg", "webp"],
+                        help="Encoding of images sent to the analyst")
+    parser.add_argument("--image-quality", type=int, default=IMAGE_QUALITY, help="JPEG/WebP quality (1-100)")
+    parser.add_argument("--image-max-dim", type=int, default=IMAGE_MAX_DIM,
+                        help="Max pixels on the longer image side (default: unlimited)")
+    parser.add_argument("--image-dpi", type=int, default=IMAGE_DPI, help="Render DPI for analyst images")
+    parser.add_argument("--analyst-concurrency", type=int, default=ANALYST_CONCURRENCY,
+                        help="Max concurrent analyst API calls (1 = serial)")
+    parser.add_argument("--architect-token-budget", type=int, default=ARCHITECT_TOKEN_BUDGET,
+                        help="Estimated token budget of paper text per Architect batch")
+    parser.add_argument("--architect-concurrency", type=int, default=ARCHITECT_CONCURRENCY,
+                        help="Max concurrent Architect batch calls (1 = serial)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream analyst answers into live drafts (<paper>/_drafts) and stop once over the word limit")
+    parser.add_argument("--retry-context", default=ANALYST_RETRY_CONTEXT, choices=["full", "last", "summary"],
+                        help="Context sent on analyst word-count retries: all prior answers, only the last one, or a compact outline")
+    parser.add_argument("--batch-questions", action="store_true",
+                        help="Ask all sub-questions of a section in one analyst call (one image upload per section)")
+    parser.add_argument("--stream-pages", action="store_true",
+                        help="Single-paper Marker mode: run OCR in the background and start equation scanning and Architect batches as pages complete")
+    parser.add_argument("--early-analysis", action="store_true",
+                        help="With --stream-pages: start analysing sections of finished Architect batches before later pages are OCR'd; answers are reconciled with the final outline; early calls are per question (no --batch-questions) and write no --stream drafts")
+    parser.add_argument("--page-queue-size", type=int, default=PAGE_STREAM_QUEUE_SIZE,
+                        help="Max OCR pages buffered ahead of the consumer in --stream-pages mode (backpressure)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Reuse the saved outline and skip sub-questions already completed in a previous run")
+    parser.add_argument("--no-llm-cache", action="store_true", help="Ignore and do not update the on-disk LLM response cache")
+    parser.add_argument("--rpm", type=float, default=API_REQUESTS_PER_MIN,
+                        help="API requests per minute shared by all callers (0 = unlimited)")
+    parser.add_argument("--tpm", type=float, default=API_TOKENS_PER_MIN,
+                        help="API tokens per minute shared by all callers (default: unlimited)")
+    args = parser.parse_args()
+    # 批量模式已在论文间重叠OCR与分析，不使用页面流水线
+    if not args.pdf and (args.stream_pages or args.early_analysis):
+        print("ℹ️  批量模式不支持 --stream-pages / --early-analysis，已忽略")
+        args.stream_pages = args.early_analysis = False
+    # 提前分析依赖页面流水线
+    elif args.early_analysis and not args.stream_pages:
+        print("ℹ️  --early-analysis 需要页面流水线，已自动启用 --stream-pages")
+        args.stream_pages = True
+    if args.early_analysis and (args.batch_questions or args.stream):
+        print("ℹ️  提前分析的请求逐题进行：不合并为 --batch-questions 请求，--stream 时不写草稿")
+
+    api_key = os.getenv("OPENROUTER_API_KEY")
+    if not api_key:
+        print("Error: OPENROUTER_API_KEY not found in environment.")
+        return
+
+    client = OpenAI(
+        base_url=OPENROUTER_BASE_URL,
+        api_key=api_key,
+    )
+    # 按服务商配额配置全局共享的限速器
+    API_RATE_LIMITER.configure(args.rpm, args.tpm)
+    # LLM响应缓存：相同提示词重跑时直接复用
+    global LLM_CACHE
+    LLM_CACHE = None if args.no_llm_cache else LLMCache()
 
-    pdf_proc.close()
-    print(f"完成! 请查看目录: {paper_folder}")
+    try:
+        if args.pdf:
+            pdf_path = Path(args.pdf)
+            if process_paper(pdf_path, args, client):
+                print(f"完成! 请查看目录: {Path(args.vault) / pdf_path.stem}")
+        else:
+            pdf_paths = collect_batch_pdfs(args)
+            if not pdf_paths:
+                print("未找到待处理的PDF")
+                return
+            run_batch(pdf_paths, args, client)
+    finally:
+        if LLM_CACHE is not None:
+            print(f"💾 {LLM_CACHE.summary()}")
+            LLM_CACHE.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,79 @@
+"""
+section去重基准测试
+
+生成N个合成SectionIntent（图表、章节关键词、自由标题混合，含近似重复），
+分别用逐个比较（use_index=False）与索引候选查找（use_index=True）运行 deduplicate_sections，
+报告耗时并校验两者结果一致。
+
+用法:
+    python scripts/bench_deduplicate_sections.py --sections 1000
+"""
+import argparse
+import contextlib
+import io
+import random
+import time
+
+from analyze_paper import SectionIntent, SubQuestion, deduplicate_sections
+
+TOPICS = ("synaptic plasticity", "energy landscape", "attractor dynamics", "spike timing",
+          "membrane potential", "network stability", "learning rule", "memory capacity",
+          "noise robustness", "phase transition", "sparse coding", "recurrent weights")
+VOCAB = ("hebbian oscillation gating entropy manifold kernel inhibitory excitatory cortex "
+         "retrieval storage pattern basin saddle jacobian eigen spectrum variance bias decay "
+         "threshold coupling delay feedback readout latent encoder decoder prior posterior").split()
+KEYWORDS = ("Introduction", "Methods", "Results", "Discussion", "Conclusion", "Background")
+
+
+def make_sections(count: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    sections = []
+    for i in range(count):
+        kind = rng.random()
+        if sections and kind < 0.15:
+            # 近似重复：在已有标题上做小改动
+            title = rng.choice(sections).section_title + rng.choice(["", " (cont.)", "s", " revisited"])
+            section_type = rng.choice(["figure", "text"])
+        elif kind < 0.4:
+            title = f"{rng.choice(['Fig.', 'Figure', 'Table', 'Eq.'])} {rng.randint(1, 400)}: {rng.choice(TOPICS)}"
+            section_type = "figure"
+        elif kind < 0.45:
+            title = f"{rng.choice(KEYWORDS)} - {rng.choice(TOPICS)}"
+            section_type = "text"
+        else:
+            words = rng.sample(VOCAB, rng.randint(3, 6))
+            title = " ".join(words).capitalize()
+            section_type = "text"
+        questions = [SubQuestion(question=f"{title} 问题 {q} {rng.choice(TOPICS)}", question_type="what")
+                     for q in range(rng.randint(2, 4))]
+        sections.append(SectionIntent(section_title=title, target_pages=[i % 30], filename_slug=f"s_{i}",
+                                      type=section_type, sub_questions=questions))
+    return sections
+
+
+def summarize(sections: list) -> list:
+    return [(s.section_title, s.type, [q.question for q in s.sub_questions]) for s in sections]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark deduplicate_sections")
+    parser.add_argument("--sections", type=int, nargs="+", default=[1000], help="Synthetic section counts")
+    args = parser.parse_args()
+
+    print(f"{'section数':>10}{'方式':>10}{'耗时(秒)':>12}{'保留数':>8}")
+    for count in args.sections:
+        results = {}
+        for use_index in (False, True):
+            sections = make_sections(count)
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                unique = deduplicate_sections(sections, use_index=use_index)
+                elapsed = time.perf_counter() - start
+            results[use_index] = summarize(unique)
+            label = "index" if use_index else "legacy"
+            print(f"{count:>10}{label:>10}{elapsed:>12.3f}{len(unique):>8}")
+        print(f"{'':>10}结果一致: {results[False] == results[True]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+公式智能分组基准测试
+
+生成N个合成公式（约300字符上下文），分别用 exact（默认：NumPy上界预筛 + 快速精确ratio）、
+sequence（旧版SequenceMatcher）和 tfidf（NumPy向量化关联度矩阵）运行 group_visual_elements，
+报告耗时、分组数，以及分组结果是否与sequence完全一致。
+注意tfidf的余弦分数整体高于SequenceMatcher，同一0.4阈值下分组数明显减少（50个公式约26→13）。
+
+用法:
+    python scripts/bench_equation_grouping.py --equations 50 200
+"""
+import argparse
+import random
+import time
+
+from analyze_paper import group_visual_elements
+
+WORDS = ("energy neuron potential membrane synaptic weight gradient loss hopfield attractor "
+         "field current voltage rate spike dynamics stability fixed point lyapunov").split()
+
+
+def make_equations(count: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    equations = []
+    for i in range(count):
+        numbered = rng.random() < 0.6
+        context = " ".join(rng.choice(WORDS) for _ in range(50))[:300]
+        equations.append({
+            "page": i // 6,
+            "equation_type": "numbered" if numbered else "unnumbered",
+            "equation_number": f"({i + 1})" if numbered else "",
+            "description": f"Equation ({i + 1}): {' '.join(rng.choice(WORDS) for _ in range(4))}"
+                           if numbered else "未编号公式",
+            "context": context,
+        })
+    return equations
+
+
+def group_members(groups: list, equations: list) -> list:
+    positions = {id(eq): idx for idx, eq in enumerate(equations)}
+    return [[positions[id(eq)] for eq in group["items"]] for group in groups]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark equation grouping")
+    parser.add_argument("--equations", type=int, nargs="+", default=[50, 200], help="Synthetic equation counts")
+    parser.add_argument("--methods", nargs="+", default=["exact", "sequence", "tfidf"],
+                        choices=["exact", "sequence", "tfidf"])
+    args = parser.parse_args()
+
+    print(f"{'公式数':>8}{'方式':>10}{'耗时(秒)':>12}{'分组数':>8}{'与sequence一致':>16}")
+    for count in args.equations:
+        equations = make_equations(count)
+        reference = None
+        for method in sorted(args.methods, key=lambda m: m != "sequence"):
+            start = time.perf_counter()
+            groups = group_visual_elements([], equations, similarity_method=method)["equation_groups"]
+            elapsed = time.perf_counter() - start
+            members = group_members(groups, equations)
+            if method == "sequence":
+                reference = members
+            if reference is None:
+                reference = group_members(group_visual_elements([], equations, similarity_method="sequence")
+                                          ["equation_groups"], equations)
+            same = "是" if members == reference else "否"
+            print(f"{count:>8}{method:>10}{elapsed:>12.3f}{len(groups):>8}{same:>16}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+公式扫描基准测试
+
+生成合成的Marker输出页面（正文、$$...$$显示公式、(n)编号标签、Eq. n 引用混合），
+对比旧版逐窗口扫描实现（LegacyEquationScanner，原样保留于此）与当前的单遍预编译扫描，
+报告每页耗时并校验结果一致。
+旧版重要符号表写成 r'\\\\sum' 等，匹配的是两个反斜杠，LaTeX中的 \\sum 永远不会命中；
+当前实现已修复，因此对照组为修复符号表后的旧版，同时报告未修复旧版的编号公式是否一致。
+单遍扫描的收益很小：200页时修复后的旧版约0.21毫秒/页，当前约0.17毫秒/页（约1.2倍）；
+与未修复的旧版相比没有可测的收益。两者的耗时主要都在_generate_description。
+
+用法:
+    python scripts/bench_equation_scanner.py --pages 200
+"""
+import argparse
+import random
+import re
+import time
+from typing import List
+
+from analyze_paper import EquationScanner
+
+WORDS = ("the energy of network state decreases under asynchronous update rule gradient "
+         "loss posterior we define probability estimation error variance model").split()
+FORMULAS = (r"E = -\frac{1}{2} \sum_{i,j} w_{ij} s_i s_j", r"x_{t+1} = x_t - \eta \nabla L(x_t)",
+            r"p(z|x) \propto p(x|z) p(z)", r"y = a + b", r"\mathcal{L} = \mathbb{E}_{q}[\log p]",
+            r"h_i^{new} = \tanh(W h_i + b)", r"\theta^* = \arg\min_\theta L",
+            r"\sum_{k} \alpha_k \phi_k(x) \cdot w_k")
+
+
+def make_page(rng: random.Random, number_start: int) -> str:
+    parts = []
+    number = number_start
+    for _ in range(rng.randint(4, 12)):
+        parts.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 160))))
+        if rng.random() < 0.3:
+            parts.append(f"as shown in Eq. {rng.randint(1, 40)}")
+        formula = rng.choice(FORMULAS)
+        style = rng.random()
+        if style < 0.4:
+            parts.append(f"$$\n{formula}\n$$ ({number})")
+            number += 1
+        elif style < 0.55:
+            parts.append(f"({number})\n$${formula}$$")
+            number += 1
+        else:
+            parts.append(f"$${formula}$$")
+    return "\n".join(parts)
+
+
+class LegacyEquationScanner(EquationScanner):
+    """改动前的实现：每个公式重新切片窗口、按行拆分并现场编译正则"""
+
+    def __init__(self, all_pages_text: List[str], symbol_prefix: str = r'\\'):
+        super().__init__(all_pages_text)
+        self.symbol_prefix = symbol_prefix
+
+    def scan_all_equations(self) -> List[dict]:
+        equations = []
+        for page_num, page_text in enumerate(self.all_pages_text):
+            numbered_eqs = self._extract_numbered_equations(page_text, page_num)
+            equations.extend(numbered_eqs)
+            equations.extend(self._extract_unnumbered_equations(page_text, page_num, numbered_eqs))
+        return equations
+
+    def _extract_numbered_equations(self, text: str, page_num: int) -> List[dict]:
+        numbered_equations = []
+        display_eqs = list(re.finditer(r'\$\$(.*?)\$\$', text, re.DOTALL))
+        number_pattern = r'\((\d+[a-z]?|[A-Z]\.\d+)\)'
+        ref_patterns = [r'(?:Equation|Eq\.?)\s+(\d+[a-z]?)', r'(?:式|公式)\s*\(?(\d+[a-z]?)\)?']
+        for eq_match in display_eqs:
+            eq_text = eq_match.group(1).strip()
+            eq_start, eq_end = eq_match.start(), eq_match.end()
+            context = text[max(0, eq_start - 150):min(len(text), eq_end + 150)]
+            equation_number = None
+            lines_before = text[max(0, eq_start - 500):eq_start].split('\n')
+            lines_after = text[eq_end:min(len(text), eq_end + 500)].split('\n')
+            for line in lines_after[:3]:
+                number_match = re.search(number_pattern, line)
+                if number_match:
+                    equation_number = number_match.group(1)
+                    break
+            if not equation_number:
+                for line in reversed(lines_before[-3:]):
+                    number_match = re.search(number_pattern, line)
+                    if number_match:
+                        equation_number = number_match.group(1)
+                        break
+            if not equation_number:
+                for ref_pattern in ref_patterns:
+                    ref_match = re.search(ref_pattern, context, re.IGNORECASE)
+                    if ref_match:
+                        equation_number = ref_match.group(1)
+                        break
+            if equation_number:
+                numbered_equations.append({
+                    "page": page_num, "equation_type": "numbered", "equation_number": equation_number,
+                    "equation_text": eq_text, "context": context,
+                    "description": self._generate_description(context, equation_number, is_numbered=True),
+                    "position": eq_start / max(len(text), 1)
+                })
+        return numbered_equations
+
+    def _extract_unnumbered_equations(self, text: str, page_num: int,
+                                      numbered_equations: List[dict]) -> List[dict]:
+        unnumbered_equations = []
+        numbered_texts = set(eq['equation_text'] for eq in numbered_equations)
+        for eq_match in re.finditer(r'\$\$(.*?)\$\$', text, re.DOTALL):
+            eq_text = eq_match.group(1).strip()
+            if eq_text in numbered_texts or not self._is_important_equation(eq_text):
+                continue
+            eq_start, eq_end = eq_match.start(), eq_match.end()
+            context = text[max(0, eq_start - 150):min(len(text), eq_end + 150)]
+            unnumbered_equations.append({
+                "page": page_num, "equation_type": "unnumbered", "equation_number": None,
+                "equation_text": eq_text, "context": context,
+                "description": self._generate_description(context, None, is_numbered=False),
+                "position": eq_start / max(len(text), 1)
+            })
+        return unnumbered_equations
+
+    def _is_important_equation(self, eq_text: str) -> bool:
+        if len(eq_text) < 20:
+            return False
+        names = ['sum', 'prod', 'int', 'frac', 'partial', 'nabla', 'Delta', 'max', 'min', 'arg',
+                 'mathbb', 'mathcal', 'alpha', 'beta', 'theta', 'sim', 'approx', 'rightarrow',
+                 'leftarrow', 'leq', 'geq']
+        for name in names:
+            if self.symbol_prefix + name in eq_text:
+                return True
+        if '_' in eq_text or '^' in eq_text:
+            if '=' in eq_text or '+' in eq_text or '-' in eq_text:
+                return True
+        return False
+
+
+def timed(scanner, repeat: int) -> tuple:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        equations = scanner.scan_all_equations()
+        best = min(best, time.perf_counter() - start)
+    return best, equations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark EquationScanner")
+    parser.add_argument("--pages", type=int, default=200, help="Synthetic page count")
+    parser.add_argument("--repeat", type=int, default=15, help="Runs per implementation (best is reported)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    pages = [make_page(rng, 1 + 6 * i) for i in range(args.pages)]
+
+    legacy_time, legacy = timed(LegacyEquationScanner(pages), args.repeat)
+    fixed_time, legacy_fixed = timed(LegacyEquationScanner(pages, symbol_prefix='\\'), args.repeat)
+    new_time, current = timed(EquationScanner(pages), args.repeat)
+
+    print(f"{'实现':<28}{'每页(毫秒)':>12}{'公式数':>8}")
+    print(f"{'legacy':<28}{legacy_time / args.pages * 1000:>12.3f}{len(legacy):>8}")
+    print(f"{'legacy（修复符号表）':<24}{fixed_time / args.pages * 1000:>12.3f}{len(legacy_fixed):>8}")
+    print(f"{'single-pass':<28}{new_time / args.pages * 1000:>12.3f}{len(current):>8}")
+    numbered = [eq for eq in legacy if eq["equation_type"] == "numbered"]
+    print(f"编号公式与旧版一致: {numbered == [eq for eq in current if eq['equation_type'] == 'numbered']}")
+    print(f"全部结果与修复符号表后的旧版一致: {legacy_fixed == current}")
+
+
+if __name__ == "__main__":
+    main()
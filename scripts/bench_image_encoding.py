@@ -0,0 +1,66 @@
+"""
+Analyst图片编码基准测试
+
+对示例PDF的前几页，按不同编码模式（格式/质量/最长边上限）渲染，
+报告每页平均负载大小（原始字节与base64）以及编码耗时，用于选择上传开销最小的配置。
+
+用法:
+    python scripts/bench_image_encoding.py --pdf paper.pdf --pages 5
+"""
+import argparse
+import time
+
+import fitz
+
+from analyze_paper import ImageEncoder
+
+# (格式, 质量, 最长边像素上限)
+MODES = [
+    ("png", None, None),    # 当前默认：300DPI无损PNG
+    ("png", None, 2048),
+    ("jpeg", 90, None),
+    ("jpeg", 85, 2048),
+    ("jpeg", 75, 1600),
+    ("webp", 80, 2048),
+    ("webp", 70, 1600),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark analyst image encoding modes")
+    parser.add_argument("--pdf", required=True, help="Path to PDF file")
+    parser.add_argument("--pages", type=int, default=5, help="Number of pages to encode")
+    parser.add_argument("--dpi", type=int, default=300, help="Render DPI")
+    args = parser.parse_args()
+
+    doc = fitz.open(args.pdf)
+    num_pages = min(args.pages, len(doc))
+
+    print("=" * 78)
+    print(f"📄 {args.pdf}  ({num_pages}页, {args.dpi}DPI)")
+    print("=" * 78)
+    print(f"{'模式':<22}{'平均字节':>12}{'base64':>12}{'相对PNG':>10}{'编码耗时':>12}")
+    print("-" * 78)
+
+    baseline = None
+    for fmt, quality, max_dim in MODES:
+        encoder = ImageEncoder(fmt=fmt, quality=quality or 85, max_dim=max_dim, dpi=args.dpi)
+        sizes = []
+        start = time.perf_counter()
+        for page_num in range(num_pages):
+            sizes.append(len(encoder.encode_bytes(doc, page_num)))
+        elapsed_ms = (time.perf_counter() - start) * 1000 / num_pages
+
+        avg_bytes = sum(sizes) / len(sizes)
+        b64_bytes = avg_bytes * 4 / 3
+        if baseline is None:
+            baseline = avg_bytes
+        label = f"{encoder.fmt}" + (f" q{quality}" if quality else "") + (f" ≤{max_dim}px" if max_dim else "")
+        print(f"{label:<22}{avg_bytes / 1024:>10.0f}KB{b64_bytes / 1024:>10.0f}KB"
+              f"{avg_bytes / baseline:>10.0%}{elapsed_ms:>10.0f}ms")
+
+    doc.close()
+
+
+if __name__ == "__main__":
+    main()
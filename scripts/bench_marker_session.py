@@ -0,0 +1,66 @@
+"""
+Marker Converter会话基准测试
+
+对比两种模式的开销：
+1. 旧模式：每页都重新创建PdfConverter（配置解析 + processor列表 + renderer + llm_service）
+2. 新模式：MarkerProcessor在_init_marker中创建一次Converter，所有页面复用
+
+用法:
+    python scripts/bench_marker_session.py --pdf paper.pdf --pages 5
+"""
+import argparse
+import time
+
+from analyze_paper import MarkerProcessor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Marker converter setup vs conversion time")
+    parser.add_argument("--pdf", required=True, help="Path to PDF file")
+    parser.add_argument("--pages", type=int, default=5, help="Number of pages to convert")
+    args = parser.parse_args()
+
+    proc = MarkerProcessor(args.pdf)
+    proc._init_marker()
+    num_pages = min(args.pages, proc.total_pages)
+
+    # 1. 旧模式的每页初始化开销：重复创建Converter
+    from marker.converters.pdf import PdfConverter
+    setup_times = []
+    for _ in range(num_pages):
+        start = time.perf_counter()
+        PdfConverter(
+            config=proc._config_parser.generate_config_dict(),
+            artifact_dict=proc._model_dict,
+            processor_list=proc._config_parser.get_processors(),
+            renderer=proc._config_parser.get_renderer(),
+            llm_service=proc._config_parser.get_llm_service(),
+        )
+        setup_times.append(time.perf_counter() - start)
+
+    # 2. 新模式：复用会话逐页转换
+    for page_num in range(num_pages):
+        proc._process_single_page(page_num)
+    convert_times = [t for _, t in proc.page_timings]
+
+    avg_setup = sum(setup_times) / len(setup_times)
+    avg_convert = sum(convert_times) / len(convert_times)
+
+    print("=" * 60)
+    print(f"📄 {args.pdf}  ({num_pages}页)")
+    print("=" * 60)
+    print(f"{'页码':<8}{'初始化(旧,每页)':>18}{'转换':>12}")
+    for (page_num, convert), setup in zip(proc.page_timings, setup_times):
+        print(f"{page_num + 1:<8}{setup:>17.2f}s{convert:>11.2f}s")
+    print("-" * 60)
+    print(f"会话初始化（新模式，仅一次）: {proc.session_setup_seconds:.2f}s")
+    print(f"平均每页初始化（旧模式）:     {avg_setup:.2f}s")
+    print(f"平均每页转换:                 {avg_convert:.2f}s")
+    print(f"初始化占单页总耗时比例（旧模式）: {avg_setup / (avg_setup + avg_convert):.1%}")
+    print(f"{num_pages}页共节省: {avg_setup * num_pages - proc.session_setup_seconds:.2f}s")
+
+    proc.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ Marker集成到论文分析工具 - 使用Marker替代PyMuPDF以获得公式识
 """
 import subprocess
 import sys
+import tempfile
 from pathlib import Path
 
 class MarkerProcessor:
@@ -14,9 +15,8 @@ class MarkerProcessor:
         if not self.marker_exe.exists():
             self.marker_exe = Path(sys.executable).parent / "marker_single"
         
-        # 设置输出目录
-        self.output_dir = Path("marker_temp_output")
-        self.output_dir.mkdir(exist_ok=True)
+        # 设置输出目录（每次运行独立，避免同一工作目录下的并发运行互相覆盖）
+        self.output_dir = Path(tempfile.mkdtemp(prefix="marker_run_"))
         
         # 获取PDF总页数（仍需PyMuPDF）
         import fitz
@@ -0,0 +1,56 @@
+"""
+测试批量子问题分析：与逐题模式共用提示词、API失败时不逐题回退、缺失的回答逐题补充
+"""
+import json
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+sys.path.insert(0, str(Path(__file__).parent))
+
+import analyze_paper
+from analyze_paper import AnalystAgent, SubQuestion
+
+
+def make_response(payload: dict):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps(payload, ensure_ascii=False)))],
+                           usage=None)
+
+
+def run_batch(monkeypatch, responses):
+    calls = []
+    
+    def fake_call(client, **kwargs):
+        calls.append(kwargs)
+        return responses.pop(0) if responses else None
+    
+    monkeypatch.setattr(analyze_paper, "call_api_with_retry", fake_call)
+    questions = [SubQuestion(question="机制是什么？", question_type="mechanism"),
+                 SubQuestion(question="有什么局限？", question_type="critique")]
+    answers = AnalystAgent(None).analyze_section_batch("IMG", questions, ["sub-q1", "sub-q2"])
+    return answers, calls
+
+
+def test_batch_prompt_shares_single_question_guidelines(monkeypatch):
+    _, calls = run_batch(monkeypatch, [])
+    system_prompt = calls[0]["messages"][0]["content"]
+    assert AnalystAgent._analysis_guidelines("见各问题的字数要求") in system_prompt
+    assert "第一性原理推导" in system_prompt and "是否存在替代解释模型" in system_prompt
+
+
+def test_api_failure_skips_pending_without_per_question_retry(monkeypatch):
+    answers, calls = run_batch(monkeypatch, [])
+    assert len(calls) == 1
+    assert all(AnalystAgent.SKIPPED_MARKER in answer for answer in answers)
+
+
+def test_missing_answer_falls_back_to_single_question(monkeypatch):
+    answer = "内容" * 600
+    answers, calls = run_batch(monkeypatch, [
+        make_response({"answers": [{"anchor_id": "sub-q1", "answer": answer}]}),
+        make_response({"answers": []}),
+        make_response({"answers": []}),
+        SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=answer))], usage=None),
+    ])
+    assert answers == [answer, answer]
+    # 3次批量请求 + 1次逐题请求（不带JSON格式）
+    assert len(calls) == 4 and "response_format" not in calls[-1]
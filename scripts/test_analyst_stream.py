@@ -0,0 +1,86 @@
+"""
+测试流式分析：最后一次尝试不中止、超限反馈按中止措辞、完整的流式结果写入LLM缓存
+"""
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+sys.path.insert(0, str(Path(__file__).parent))
+
+from openai.types.chat import ChatCompletionChunk
+from openai.types.chat.chat_completion_chunk import Choice, ChoiceDelta
+
+import analyze_paper
+from analyze_paper import AnalystAgent, LLMCache, RateLimiter, SubQuestion
+
+
+def make_chunk(text):
+    return ChatCompletionChunk(id="c", created=0, model="m", object="chat.completion.chunk",
+                               choices=[Choice(index=0, delta=ChoiceDelta(content=text))])
+
+
+class FakeStream:
+    def __init__(self, parts):
+        self.parts = parts
+        self.sent = 0
+    
+    def __iter__(self):
+        for part in self.parts:
+            self.sent += 1
+            yield make_chunk(part)
+    
+    def close(self):
+        pass
+
+
+class FakeClient:
+    """每次请求返回同一个回答（按段落分成多个chunk），记录请求的messages和实际发送的chunk数"""
+    
+    def __init__(self, answer, parts=10):
+        size = len(answer) // parts + 1
+        self.parts = [answer[k:k + size] for k in range(0, len(answer), size)]
+        self.requests = []
+        self.streams = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(with_raw_response=SimpleNamespace(create=self.create)))
+    
+    def create(self, **kwargs):
+        self.requests.append(kwargs["messages"])
+        stream = FakeStream(self.parts)
+        self.streams.append(stream)
+        return SimpleNamespace(headers={}, parse=lambda: stream)
+
+
+def setup(monkeypatch, tmp_path):
+    cache = LLMCache(tmp_path / "cache.sqlite3")
+    monkeypatch.setattr(analyze_paper, "LLM_CACHE", cache)
+    monkeypatch.setattr(analyze_paper, "API_RATE_LIMITER", RateLimiter(requests_per_min=None))
+    return cache
+
+
+def test_final_attempt_returns_complete_answer(monkeypatch, tmp_path):
+    setup(monkeypatch, tmp_path)
+    sub_q = SubQuestion(question="机制？", question_type="critique")
+    answer = "长" * (sub_q.validate_max * 2)
+    client = FakeClient(answer)
+    result = AnalystAgent(client, stream=True).analyze_section("IMG", sub_q)
+    
+    assert len(client.requests) == 3
+    # 前两次超限即中止，最后一次读完整个回答
+    assert all(stream.sent < len(client.parts) for stream in client.streams[:2])
+    assert client.streams[-1].sent == len(client.parts)
+    assert result.startswith(answer) and "字数警告" in result
+    feedback = client.requests[1][-1]["content"]
+    assert "已被中止" in feedback and f"（{sub_q.validate_max * 2}字）" not in feedback
+
+
+def test_completed_stream_is_cached(monkeypatch, tmp_path):
+    cache = setup(monkeypatch, tmp_path)
+    sub_q = SubQuestion(question="机制？", question_type="critique")
+    answer = "好" * sub_q.validate_min
+    client = FakeClient(answer)
+    first = AnalystAgent(client, stream=True).analyze_section("IMG", sub_q)
+    second = AnalystAgent(client, stream=True).analyze_section("IMG", sub_q)
+    assert first == second == answer
+    assert len(client.requests) == 1 and cache.hits == 1
+    # 非流式模式共用同一缓存条目
+    assert AnalystAgent(client).analyze_section("IMG", sub_q) == answer
+    assert len(client.requests) == 1
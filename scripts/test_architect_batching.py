@@ -0,0 +1,46 @@
+"""
+测试Architect按token预算分批与清单分配
+"""
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from analyze_paper import TokenBudgetBatcher, attach_batch_inventory, truncate_to_token_budget
+
+
+def test_plan_packs_pages_by_budget():
+    pages = ["a" * 3000, "b" * 3000, "c" * 30000, "d" * 300, "e" * 300]
+    batches = TokenBudgetBatcher.plan(pages, token_budget=2500)
+    assert [(b["start"], b["end"]) for b in batches] == [(0, 2), (2, 3), (3, 5)]
+    # 单页超出预算时独占一个批次并标记截断
+    assert [b["truncated"] for b in batches] == [False, True, False]
+
+
+def test_plan_respects_max_pages():
+    batches = TokenBudgetBatcher.plan(["x"] * 5, token_budget=10000, max_pages=2)
+    assert [(b["start"], b["end"]) for b in batches] == [(0, 2), (2, 4), (4, 5)]
+
+
+def test_incremental_add_matches_plan():
+    pages = ["p" * 1500 for _ in range(7)]
+    batcher = TokenBudgetBatcher(token_budget=1200)
+    batches = [b for b in (batcher.add(i, text) for i, text in enumerate(pages)) if b]
+    batches.append(batcher.flush())
+    assert batches == TokenBudgetBatcher.plan(pages, token_budget=1200)
+
+
+def test_inventory_follows_pages():
+    batch = {"start": 2, "end": 4}
+    figures = [{"page": 0, "caption": "Figure 1"}, {"page": 3, "caption": "Figure 2"}]
+    equations = [{"page": 2, "equation_type": "numbered", "description": "(1)"}]
+    groups = {"figure_groups": [{"pages": [0]}, {"pages": [3, 4]}], "equation_groups": []}
+    attach_batch_inventory(batch, figures, equations, groups)
+    assert batch["figures_list"] == [figures[1]]
+    assert batch["equations_list"] == equations
+    assert batch["visual_groups"] == {"figure_groups": [{"pages": [3, 4]}], "equation_groups": []}
+
+
+def test_truncate_to_token_budget():
+    text, truncated = truncate_to_token_budget("z" * 30000, 2500)
+    assert truncated and len(text) <= 7500
+    assert truncate_to_token_budget("short", 2500) == ("short", False)
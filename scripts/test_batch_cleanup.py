@@ -0,0 +1,72 @@
+"""
+测试中断与出错时的资源清理：prepare_paper出错关闭已打开的PDF，批量模式中断时关闭已预处理的下一篇
+"""
+import sys
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+sys.path.insert(0, str(Path(__file__).parent))
+
+import fitz
+import pytest
+
+import analyze_paper
+
+
+def make_pdf(path: Path, pages: int = 2) -> Path:
+    doc = fitz.open()
+    for page_num in range(pages):
+        doc.new_page().insert_text((72, 72), f"page {page_num}")
+    doc.save(str(path))
+    doc.close()
+    return path
+
+
+def test_prepare_paper_closes_documents_on_error(monkeypatch, tmp_path):
+    pdf_path = make_pdf(tmp_path / "paper.pdf")
+    registries = []
+    original_registry = analyze_paper.DocumentRegistry
+
+    def registry():
+        registries.append(original_registry())
+        return registries[-1]
+
+    class FailingScanner:
+        def __init__(self, *args, **kwargs):
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(analyze_paper, "USE_MARKER", False)
+    monkeypatch.setattr(analyze_paper, "DocumentRegistry", registry)
+    monkeypatch.setattr(analyze_paper, "FigureScanner", FailingScanner)
+    args = SimpleNamespace(vault=str(tmp_path / "vault"), image_spill_dir=None, image_spill_max_mb=10,
+                           image_format="png", image_quality=80, image_max_dim=None, image_dpi=72)
+
+    with pytest.raises(KeyboardInterrupt):
+        analyze_paper.prepare_paper(pdf_path, args)
+    assert registries and not registries[0]._docs
+
+
+def test_run_batch_finishes_prepared_paper_on_interrupt(monkeypatch, tmp_path):
+    finished = []
+    prepared = threading.Event()
+
+    def prepare(pdf_path, args, **kwargs):
+        if pdf_path.name == "b.pdf":
+            prepared.set()
+        return {"pdf_path": pdf_path}
+
+    def analyze(paper, args, client, interactive=True):
+        # 等下一篇在后台预处理完再中断
+        prepared.wait(timeout=5)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(analyze_paper, "USE_MARKER", False)
+    monkeypatch.setattr(analyze_paper, "prepare_paper", prepare)
+    monkeypatch.setattr(analyze_paper, "analyze_prepared_paper", analyze)
+    monkeypatch.setattr(analyze_paper, "finish_paper", lambda paper: finished.append(paper["pdf_path"].name))
+
+    pdf_paths = [tmp_path / "a.pdf", tmp_path / "b.pdf", tmp_path / "c.pdf"]
+    with pytest.raises(KeyboardInterrupt):
+        analyze_paper.run_batch(pdf_paths, SimpleNamespace(ocr_workers=1), client=None)
+    # 当前论文由finally清理，已在后台预处理完的下一篇由中断处理清理；第三篇从未开始
+    assert finished == ["a.pdf", "b.pdf"]
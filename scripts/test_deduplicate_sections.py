@@ -0,0 +1,52 @@
+"""
+测试section去重的索引查找与逐个比较结果一致
+"""
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from analyze_paper import SectionIntent, SubQuestion, deduplicate_sections
+
+
+def make_section(title, section_type="text", questions=("这部分展示了什么？",)):
+    return SectionIntent(
+        section_title=title, target_pages=[0], filename_slug="s", type=section_type,
+        sub_questions=[SubQuestion(question=q, question_type="what") for q in questions],
+    )
+
+
+def titles(sections):
+    return [(s.section_title, s.type, [q.question for q in s.sub_questions]) for s in sections]
+
+
+def run_both(build):
+    return [titles(deduplicate_sections(build(), use_index=flag)) for flag in (False, True)]
+
+
+def test_first_match_wins_over_later_index_hit():
+    # 第三个标题与第一个标题模糊相似，同时与第二个标题关键词相同；应合并到第一个
+    def build():
+        return [
+            make_section("Energy landscape overview"),
+            make_section("Discussion of energy"),
+            make_section("Energy landscape overview discussion", questions=("新的问题？",)),
+        ]
+    legacy, indexed = run_both(build)
+    assert legacy == indexed
+    assert len(indexed) == 2 and indexed[0][0] == "Energy landscape overview" and indexed[0][2] == ["这部分展示了什么？", "新的问题？"]
+
+
+def test_figure_and_keyword_index():
+    def build():
+        return [
+            make_section("Figure 3: energy landscape", "figure"),
+            make_section("Methods"),
+            make_section("figure3 detail", "figure"),
+            make_section("Our methods in depth"),
+            make_section("Completely unrelated title"),
+            make_section(""),
+            make_section(""),
+        ]
+    legacy, indexed = run_both(build)
+    assert legacy == indexed
+    assert [t[0] for t in indexed] == ["Figure 3: energy landscape", "Methods", "Completely unrelated title", ""]
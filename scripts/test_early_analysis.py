@@ -0,0 +1,197 @@
+"""
+测试提前分析的晚绑定对账：复用键一致的答案、后续合并新增的问题由调度器分析、孤立答案被保存
+"""
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent))
+
+import fitz
+
+from analyze_paper import (AnalysisJournal, AnalystScheduler, EarlyAnalysisPool, FileManager, Outline,
+                           SectionIntent, SubQuestion, deduplicate_sections, section_image_target)
+
+
+class FakeAnalyst:
+    stream = False
+    
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+    
+    def analyze_section(self, image_b64, sub_q, section_type="text", image_mime="image/png", label="", draft_path=None):
+        with self._lock:
+            self.calls.append(sub_q.question)
+        return f"答案: {sub_q.question}"
+
+
+class FakeProcessor:
+    def __init__(self, pages: int):
+        self.doc = fitz.open()
+        for _ in range(pages):
+            self.doc.new_page()
+        self.rendered = []
+    
+    def get_page_image(self, page_number, clip=None):
+        self.rendered.append(page_number)
+        return f"page-{page_number}"
+
+
+def make_section(title, page, questions):
+    return SectionIntent(section_title=title, target_pages=[page], filename_slug=title.replace(" ", "_"), type="text",
+                         sub_questions=[SubQuestion(question=q, question_type="mechanism") for q in questions])
+
+
+def make_outline(sections):
+    return Outline(paper_title="t", summary="s", sections=sections)
+
+
+def test_early_answers_are_reconciled_with_final_outline(tmp_path):
+    analyst = FakeAnalyst()
+    proc = FakeProcessor(3)
+    pool = EarlyAnalysisPool(analyst, proc, [], "image/png", max_workers=2)
+    
+    batch1 = make_outline([make_section("Energy landscape overview", 0, ["问题一", "问题二"])])
+    batch2 = make_outline([make_section("Energy landscape overview discussion", 0, ["完全不同的新问题"]),
+                           make_section("Learning rule", 2, ["问题四"])])
+    pool.add_outline(batch1, [])
+    # 等提前分析完成（否则未开始的孤立请求会在对账时被取消）
+    deadline = time.time() + 5
+    while len(analyst.calls) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    # 去重在副本上进行，批次大纲本身不被修改
+    assert [q.question for q in batch1.sections[0].sub_questions] == ["问题一", "问题二"]
+    
+    # 最终大纲：批次2的第一个section合并进批次1的section（新增一个问题），并去掉"问题二"模拟后续校验改写
+    final_sections = deduplicate_sections(batch1.sections + batch2.sections, verbose=False)
+    final_sections[0].sub_questions = [q for q in final_sections[0].sub_questions if q.question != "问题二"]
+    
+    early_answers = {}
+    jobs = []
+    for section_idx, section in enumerate(final_sections, 1):
+        page, region = section_image_target(section, proc.doc, [], [])
+        for idx, sub_q in enumerate(section.sub_questions, 1):
+            future = pool.claim(section, sub_q, page, region)
+            if future is not None:
+                early_answers[(section_idx, idx)] = future
+        jobs.append({"section": section, "section_idx": section_idx, "page": page, "region": region,
+                     "image_mime": "image/png"})
+    pool.release_unclaimed()
+    assert list(early_answers) == [(1, 1)]
+    
+    paper_folder = tmp_path / "paper"
+    paper_folder.mkdir()
+    journal = AnalysisJournal(paper_folder)
+    scheduler = AnalystScheduler(analyst, FileManager(tmp_path), paper_folder, "paper", max_workers=2, journal=journal,
+                                 pdf_proc=proc)
+    scheduler.run(jobs, early_answers=early_answers)
+    pool.report_orphans(paper_folder)
+    pool.close()
+    
+    # "问题一"只分析一次；合并新增的问题和批次2的问题由调度器分析
+    assert sorted(analyst.calls) == ["完全不同的新问题", "问题一", "问题二", "问题四"]
+    assert journal.get(1, 1, "问题一") == "答案: 问题一"
+    orphans = [json.loads(line) for line in (paper_folder / EarlyAnalysisPool.ORPHANS_FILENAME).read_text(encoding="utf-8").splitlines()]
+    assert [(o["question"], o["page"], o["answer"]) for o in orphans] == [("问题二", 0, "答案: 问题二")]
+
+
+class BlockingAnalyst(FakeAnalyst):
+    """记录同时进行的调用数；release之前所有调用阻塞"""
+    
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+        self.active = 0
+        self.max_active = 0
+    
+    def analyze_section(self, image_b64, sub_q, section_type="text", image_mime="image/png", label="", draft_path=None):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        self.release.wait(5)
+        with self._lock:
+            self.active -= 1
+        return super().analyze_section(image_b64, sub_q, section_type, image_mime, label, draft_path)
+
+
+def test_scheduler_shares_early_pool_executor(tmp_path):
+    analyst = BlockingAnalyst()
+    proc = FakeProcessor(2)
+    pool = EarlyAnalysisPool(analyst, proc, [], "image/png", max_workers=2)
+    pool.add_outline(make_outline([make_section("Early section", 0, ["早一", "早二", "早三"])]), [])
+    
+    section = make_section("Late section", 1, ["晚一", "晚二"])
+    paper_folder = tmp_path / "paper"
+    paper_folder.mkdir()
+    scheduler = AnalystScheduler(analyst, FileManager(tmp_path), paper_folder, "paper", max_workers=2, pdf_proc=proc)
+    runner = threading.Thread(target=scheduler.run, kwargs={
+        "jobs": [{"section": section, "section_idx": 1, "page": 1, "region": None, "image_mime": "image/png"}],
+        "executor": pool.executor})
+    runner.start()
+    time.sleep(0.2)
+    # 提前分析的请求仍在进行中，调度器的请求排在同一个线程池后面
+    assert analyst.max_active == 2
+    analyst.release.set()
+    runner.join(5)
+    pool.close()
+    assert analyst.max_active == 2
+    assert sorted(analyst.calls) == ["早一", "早三", "早二", "晚一", "晚二"]
+
+
+def test_abort_saves_in_flight_answers_without_waiting(tmp_path):
+    analyst = BlockingAnalyst()
+    proc = FakeProcessor(1)
+    pool = EarlyAnalysisPool(analyst, proc, [], "image/png", max_workers=1)
+    pool.add_outline(make_outline([make_section("Early section", 0, ["进行中", "未开始"])]), [])
+    deadline = time.time() + 5
+    while analyst.active < 1 and time.time() < deadline:
+        time.sleep(0.01)
+    
+    start = time.time()
+    pool.abort(tmp_path)
+    assert time.time() - start < 1
+    assert pool.reported
+    
+    analyst.release.set()
+    pool.executor.shutdown(wait=True)
+    orphans = [json.loads(line) for line in (tmp_path / EarlyAnalysisPool.ORPHANS_FILENAME).read_text(encoding="utf-8").splitlines()]
+    # 未开始的请求被取消，进行中的答案结束后追加保存
+    assert [o["answer"] for o in orphans] == ["答案: 进行中"]
+    assert analyst.calls == ["进行中"]
+
+
+def test_scheduler_renders_images_only_for_pending_questions(tmp_path):
+    analyst = FakeAnalyst()
+    proc = FakeProcessor(3)
+    paper_folder = tmp_path / "paper"
+    paper_folder.mkdir()
+    journal = AnalysisJournal(paper_folder)
+    journal.record(1, 1, "已完成", "旧答案")
+    jobs = [{"section": make_section("Done", 0, ["已完成"]), "section_idx": 1, "page": 0, "region": None,
+             "image_mime": "image/png"},
+            {"section": make_section("Pending", 2, ["待分析"]), "section_idx": 2, "page": 2, "region": None,
+             "image_mime": "image/png"}]
+    AnalystScheduler(analyst, FileManager(tmp_path), paper_folder, "paper", journal=journal, pdf_proc=proc).run(jobs)
+    # 断点日志中已完成的section不渲染图片
+    assert proc.rendered == [2]
+    assert analyst.calls == ["待分析"]
+
+
+def test_early_images_render_in_worker_when_request_starts(tmp_path):
+    analyst = BlockingAnalyst()
+    proc = FakeProcessor(1)
+    pool = EarlyAnalysisPool(analyst, proc, [], "image/png", max_workers=1)
+    pool.add_outline(make_outline([make_section("Early section", 0, ["一", "二", "三"])]), [])
+    # add_outline本身不渲染；排队的请求不持有图片
+    deadline = time.time() + 5
+    while analyst.active < 1 and time.time() < deadline:
+        time.sleep(0.01)
+    assert proc.rendered == [0]
+    analyst.release.set()
+    for future in pool._futures.values():
+        future.result(timeout=5)
+    pool.close()
+    assert proc.rendered == [0, 0, 0]
+    assert sorted(analyst.calls) == ["一", "三", "二"]
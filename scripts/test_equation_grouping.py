@@ -0,0 +1,95 @@
+"""
+测试公式关联度矩阵与贪心分组
+"""
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent))
+
+import pytest
+
+import random
+from difflib import SequenceMatcher
+
+from analyze_paper import EQUATION_SIMILARITY_METHOD, EquationSimilarity, _SequenceRatio, group_visual_elements
+from bench_equation_grouping import make_equations
+
+
+def make_equation(page, number, context, description=None):
+    return {
+        "page": page,
+        "equation_type": "numbered",
+        "equation_number": f"({number})",
+        "description": description or f"Equation ({number})",
+        "context": context,
+    }
+
+
+def test_groups_capped_at_four():
+    equations = [make_equation(0, i + 1, "energy function of the hopfield network") for i in range(6)]
+    groups = group_visual_elements([], equations, similarity_method="sequence")["equation_groups"]
+    assert [len(g["items"]) for g in groups] == [4, 2]
+    assert groups[0]["group_description"].startswith("Equation 1-4")
+
+
+def test_unrelated_equations_stay_single():
+    equations = [
+        make_equation(0, 1, "membrane potential dynamics", "alpha"),
+        make_equation(5, 7, "xyz qqq", "zzzz"),
+    ]
+    groups = group_visual_elements([], equations, similarity_method="sequence")["equation_groups"]
+    assert [g["group_type"] for g in groups] == ["single", "single"]
+
+
+def test_tfidf_matches_sequence_on_clear_cases():
+    pytest.importorskip("numpy")
+    equations = [make_equation(0, i + 1, "energy function of the hopfield network") for i in range(5)]
+    equations.append(make_equation(9, 40, "completely different words here", "zzzz"))
+    by_method = {
+        method: [[eq["equation_number"] for eq in g["items"]]
+                 for g in group_visual_elements([], equations, similarity_method=method)["equation_groups"]]
+        for method in ("sequence", "tfidf")
+    }
+    assert by_method["tfidf"] == by_method["sequence"]
+
+
+def group_numbers(equations, **kwargs):
+    return [[eq["equation_number"] or eq["description"] for eq in g["items"]]
+            for g in group_visual_elements([], equations, **kwargs)["equation_groups"]]
+
+
+def test_default_reproduces_sequence_groupings_on_bench_data():
+    # tfidf分数整体偏高，在基准数据上会把分组数减半；默认的快速路径必须保持旧版0.4阈值语义
+    assert EQUATION_SIMILARITY_METHOD == "exact"
+    equations = make_equations(80)
+    default = group_visual_elements([], equations)["equation_groups"]
+    sequence = group_visual_elements([], equations, similarity_method="sequence")["equation_groups"]
+    assert [g["items"] for g in default] == [g["items"] for g in sequence]
+    assert [g["similarity_score"] for g in default] == [g["similarity_score"] for g in sequence]
+    assert len(group_numbers(make_equations(50))) == 26
+
+
+def test_upper_bound_never_below_exact_score():
+    pytest.importorskip("numpy")
+    index = EquationSimilarity(make_equations(30), method="exact")
+    assert all(index.upper[i, j] >= index.pair(i, j) for i in range(30) for j in range(30))
+
+
+def test_fast_ratio_matches_sequence_matcher():
+    rng = random.Random(7)
+    ratio = _SequenceRatio()
+    for _ in range(3000):
+        alphabet = rng.choice(["ab", "abcdefgh ", "abcdefghijklmnopqrstuvwxyz ,.()0123"])
+        a = "".join(rng.choice(alphabet) for _ in range(rng.choice([0, 1, 30, 199, 200, 320])))
+        b = "".join(rng.choice(alphabet) for _ in range(rng.choice([0, 1, 30, 199, 200, 320])))
+        if a and rng.random() < 0.5:
+            start = rng.randrange(len(a))
+            b = a[start:start + 150] + b[:100]
+        assert ratio(a, b) == SequenceMatcher(None, a, b).ratio()
+
+
+def test_greedy_prefers_first_on_ties():
+    pytest.importorskip("numpy")
+    import numpy as np
+    index = EquationSimilarity([make_equation(0, i + 1, "x") for i in range(3)], method="tfidf")
+    index.matrix = np.array([[1.0, 0.5, 0.5], [0.5, 1.0, 0.1], [0.5, 0.1, 1.0]])
+    assert index.greedy_groups(threshold=0.4, max_size=2) == [[0, 1], [2]]
@@ -0,0 +1,71 @@
+"""
+测试公式扫描的编号查找与重要性判断
+"""
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent))
+
+import fitz
+
+from analyze_paper import EquationScanner
+
+
+def scan(text):
+    return [(eq["equation_type"], eq["equation_number"], eq["equation_text"])
+            for eq in EquationScanner([text]).scan_all_equations()]
+
+
+def test_number_after_then_before():
+    text = "intro\n$$E = -\\sum_i s_i$$ (1)\n(7) text\n$$y = x$$\nmore\nline\nthird\nfourth (9)"
+    assert scan(text) == [("numbered", "1", "E = -\\sum_i s_i"), ("numbered", "7", "y = x")]
+
+
+def test_after_window_limited_to_three_lines():
+    text = "$$a = b$$\none\ntwo\nthree (4)"
+    assert scan(text) == []
+
+
+def test_explicit_references():
+    assert scan("as in Eq. 12b below $$a = b$$") == [("numbered", "12b", "a = b")]
+    assert scan("由公式(3)可得\n\n\n\n$$a = b$$") == [("numbered", "3", "a = b")]
+
+
+def test_important_latex_commands():
+    # 仅含关键命令、无等号的公式也视为重要公式
+    assert scan("$$\\int_0^T \\alpha(t) \\, dt \\cdot w$$") == [
+        ("unnumbered", None, "\\int_0^T \\alpha(t) \\, dt \\cdot w")]
+    assert scan("$$x_1 x_2 x_3 x_4 x_5 x_6 x_7$$") == []
+
+
+def make_page(lines):
+    """lines: [(x, y, text)]，每个元素是PDF中独立的一行"""
+    doc = fitz.open()
+    page = doc.new_page()
+    for x, y, text in lines:
+        page.insert_text((x, y), text)
+    return doc
+
+
+def region(doc, number="3", position=0.5, equation_text="E = mc^2"):
+    scanner = EquationScanner([""], doc=doc)
+    return scanner._approximate_region({"page": 0, "equation_number": number, "position": position,
+                                        "equation_text": equation_text})
+
+
+def test_region_uses_right_aligned_tag_not_inline_reference():
+    doc = make_page([(72, 100, "from (3) we obtain the energy"), (200, 400, "E = mc^2"), (500, 400, "(3)")])
+    y0, y1 = region(doc)[1], region(doc)[3]
+    assert y0 < 400 < y1 and y0 > 150
+
+
+def test_region_grows_with_equation_rows():
+    doc = make_page([(200, 400, "a = b"), (500, 400, "(3)")])
+    single = region(doc)
+    aligned = region(doc, equation_text="a &= b \\\\ c &= d \\\\ e &= f")
+    assert aligned[3] - aligned[1] > single[3] - single[1] + 80
+
+
+def test_region_none_without_reliable_tag():
+    # 只有行内引用、或未编号公式时使用整页
+    assert region(make_page([(72, 100, "from (3) we obtain")])) is None
+    assert region(make_page([(200, 400, "a = b")]), number=None) is None
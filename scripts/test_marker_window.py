@@ -0,0 +1,33 @@
+"""
+测试Marker多页窗口输出的按页拆分
+"""
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from analyze_paper import split_paginated_markdown
+
+SEPARATOR = "-" * 48
+
+
+def test_split_paginated_markdown():
+    markdown = (
+        f"\n\n{{3}}{SEPARATOR}\n\n# Methods\n\n$$ x = 1 $$\n\n"
+        f"\n\n{{4}}{SEPARATOR}\n\nResults text\n\n"
+        f"\n\n{{5}}{SEPARATOR}\n\n"
+    )
+    pages = split_paginated_markdown(markdown, [3, 4, 5])
+    assert pages == ["# Methods\n\n$$ x = 1 $$", "Results text", ""]
+
+
+def test_split_paginated_markdown_mismatch():
+    markdown = f"\n\n{{3}}{SEPARATOR}\n\nonly one page\n\n"
+    # 缺页时返回None，调用方回退到逐页模式
+    assert split_paginated_markdown(markdown, [3, 4]) is None
+    assert split_paginated_markdown("no separators at all", [0]) is None
+
+
+if __name__ == "__main__":
+    test_split_paginated_markdown()
+    test_split_paginated_markdown_mismatch()
+    print("✅ 测试通过")
@@ -0,0 +1,62 @@
+"""
+测试页面图片缓存：键包含PDF内容哈希（同路径文件被替换后不读到旧图片），溢出目录按大小上限淘汰
+"""
+import os
+import sys
+import time
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent))
+
+import fitz
+
+from analyze_paper import DocumentRegistry, PageImageCache, PDFProcessor
+
+
+def write_pdf(path: Path, text: str):
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), text)
+    doc.save(path)
+    doc.close()
+
+
+def test_replaced_pdf_is_not_served_from_spill(tmp_path):
+    pdf_path = tmp_path / "paper.pdf"
+    spill_dir = tmp_path / "spill"
+    images = []
+    for text in ("first version", "revised version"):
+        write_pdf(pdf_path, text)
+        # 每次运行都是新的内存缓存，只有溢出目录跨运行保留
+        cache = PageImageCache(max_items=0, spill_dir=spill_dir)
+        proc = PDFProcessor(str(pdf_path), image_cache=cache)
+        images.append(proc.get_page_image(0))
+        proc.close()
+        assert cache.misses == 1 and cache.disk_hits == 0
+    assert images[0] != images[1]
+
+
+def test_fingerprint_computed_once_per_document(tmp_path):
+    pdf_path = tmp_path / "paper.pdf"
+    write_pdf(pdf_path, "hello")
+    registry = DocumentRegistry()
+    registry.acquire(pdf_path)
+    first = registry.fingerprint(pdf_path)
+    write_pdf(pdf_path, "changed under an open handle")
+    assert registry.fingerprint(pdf_path) == first
+    registry.close_all()
+    assert registry.fingerprint(pdf_path) != first
+
+
+def test_spill_dir_is_capped_by_lru(tmp_path):
+    cache = PageImageCache(max_items=0, spill_dir=tmp_path, spill_max_mb=1)
+    chunk = "A" * (400 * 1024)
+    cache.get_or_render(("a",), lambda: chunk)
+    cache.get_or_render(("b",), lambda: chunk)
+    # 读回"a"刷新其mtime，写入"c"超出1MB上限时淘汰最久未用的"b"
+    old = time.time() - 60
+    os.utime(cache._spill_path(("b",)), (old, old))
+    cache.get_or_render(("a",), lambda: "unused")
+    cache.get_or_render(("c",), lambda: chunk)
+    assert cache._spill_path(("a",)).exists()
+    assert not cache._spill_path(("b",)).exists()
+    assert cache._spill_path(("c",)).exists()
+    assert sum(p.stat().st_size for p in tmp_path.glob("*.b64")) <= 1024 * 1024
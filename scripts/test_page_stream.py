@@ -0,0 +1,131 @@
+"""
+测试页面流水线：有界队列背压、异常传递，以及缓存页与转换页按页码顺序产出
+"""
+import sys
+import threading
+import time
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent))
+
+import fitz
+import pytest
+from types import SimpleNamespace
+
+import analyze_paper
+from analyze_paper import MarkerProcessor, MarkerSession, Outline, PageStream, RunMetrics, consume_page_stream
+
+
+def test_page_stream_backpressure_and_order():
+    produced = []
+    
+    def pages():
+        for page_num in range(8):
+            produced.append(page_num)
+            yield page_num, f"page {page_num}"
+    
+    stream = PageStream(pages(), maxsize=2)
+    time.sleep(0.3)
+    # 队列容量2，外加生产线程手中等待放入的一页
+    assert len(produced) == 3
+    assert [page_num for page_num, _ in stream] == list(range(8))
+    stream.close()
+
+
+def test_page_stream_reraises_and_stops_early():
+    def failing():
+        yield 0, "ok"
+        raise RuntimeError("ocr failed")
+    
+    stream = PageStream(failing())
+    with pytest.raises(RuntimeError, match="ocr failed"):
+        list(stream)
+    stream.close()
+    
+    closed = threading.Event()
+    
+    def endless():
+        try:
+            page_num = 0
+            while True:
+                yield page_num, ""
+                page_num += 1
+        finally:
+            closed.set()
+    
+    stream = PageStream(endless(), maxsize=1)
+    next(iter(stream))
+    stream.close()
+    assert closed.is_set()
+
+
+class FakeCache:
+    def __init__(self, cached: dict):
+        self.cached = cached
+        self.stored = {}
+    
+    def get(self, key):
+        return self.cached.get(key)
+    
+    def put(self, key, text):
+        self.stored[key] = text
+
+
+def make_processor(total_pages: int, cached: dict) -> MarkerProcessor:
+    proc = MarkerProcessor.__new__(MarkerProcessor)
+    proc.total_pages = total_pages
+    proc.ocr_cache = FakeCache(cached)
+    proc.ocr_workers = 0
+    proc._worker_pool = None
+    proc.session = MarkerSession()
+    proc.page_window = 1
+    proc.page_timings = []
+    proc.session_setup_seconds = 0.0
+    proc._page_cache_keys = lambda: [f"k{p}" for p in range(total_pages)]
+    proc._init_marker = lambda: None
+    return proc
+
+
+def test_iter_pages_merges_cache_and_conversion_in_order():
+    proc = make_processor(5, {"k0": "c0", "k2": "c2"})
+    converted = []
+    
+    def fake_convert(page_nums):
+        for page_num in page_nums:
+            converted.append(page_num)
+            yield page_num, f"m{page_num}"
+    
+    proc._iter_convert_pages = fake_convert
+    pages = list(proc.iter_pages())
+    assert pages == [(0, "c0"), (1, "m1"), (2, "c2"), (3, "m3"), (4, "m4")]
+    assert converted == [1, 3, 4]
+    assert proc.ocr_cache.stored == {"k1": "m1", "k3": "m3", "k4": "m4"}
+    assert proc.cached_pages == 2
+
+
+def test_batches_group_only_their_own_equations(monkeypatch):
+    doc = fitz.open()
+    for _ in range(6):
+        doc.new_page()
+    pages = [(page_num, f"page {page_num} " + "text " * 200 + f"$$x_{page_num} = y$$ ({page_num + 1})")
+             for page_num in range(6)]
+    grouped = []
+    real_group = analyze_paper.group_visual_elements
+    
+    def recording_group(figures_list, equations_list, **kwargs):
+        grouped.append(sorted(eq["page"] for eq in equations_list))
+        return real_group(figures_list, equations_list, **kwargs)
+    
+    monkeypatch.setattr(analyze_paper, "group_visual_elements", recording_group)
+    monkeypatch.setattr(analyze_paper, "run_architect_batch",
+                        lambda architect, batch, *rest: Outline(paper_title="t", summary=str(batch["start"]), sections=[]))
+    paper = {"page_stream": PageStream(iter(pages)), "figures_list": [], "metrics": RunMetrics(),
+             "pdf_proc": SimpleNamespace(doc=doc, page_timings=[], cached_pages=0, session_setup_seconds=0.0)}
+    args = SimpleNamespace(architect_token_budget=500, architect_concurrency=1, include_appendix=False)
+    outlines = consume_page_stream(paper, args, architect=object())
+    
+    assert len(outlines) > 1
+    # 每个批次只对自己页码范围内的公式分组，最后对全部公式分组一次
+    assert grouped[:-1] == [[int(outline.summary) + k for k in range(len(group))]
+                            for outline, group in zip(outlines, grouped[:-1])]
+    assert sum(len(group) for group in grouped[:-1]) == 6
+    assert grouped[-1] == list(range(6))